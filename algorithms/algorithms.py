@@ -1,11 +1,17 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 
 from models.models import classifier, ReverseLayerF, Discriminator, RandomLayer, Discriminator_CDAN, \
-    codats_classifier, Discriminator_fea, Adapter,Discriminator_t
-from models.loss import MMD_loss, CORAL, ConditionalEntropyLoss, VAT, LMMD_loss, HoMM_loss
-from utils import EMA
+    codats_classifier, Discriminator_fea, Adapter, convert_domain_batchnorm, domain_split, \
+    joint_forward
+from models.loss import MMD_loss, CORAL, ConditionalEntropyLoss, VAT, LMMD_loss, HoMM_loss, FeatureMemoryBank, \
+    RunningMoments, DistillationLoss
+from models.teacher import frozen_teacher_outputs
+from models.knn_index import FeatureIndex
+from models.early_exit import EXIT_BLOCKS, BlockTaps, make_exit_heads
+from utils import WeightAveraging
 
 from torch.autograd import Variable
 
@@ -23,14 +29,99 @@ class Algorithm(torch.nn.Module):
     Subclasses should implement the update() method.
     """
 
+    # weight averaging used when the "weight_averaging" hparam is not set ('ema', 'swa', 'polyak' or None)
+    default_weight_averaging = None
+    # domains on which a frozen teacher (self.network_t) is run by update(), e.g. ('src', 'trg')
+    teacher_domains = ()
+    # pretrained teacher loaded by the KD trainers: 'uda' (domain-adapted) or 'src_only' (see TeacherRegistry)
+    teacher_kind = None
+    # update() takes the dataset indices of the target batch as trg_idx (the trainers then load them)
+    uses_target_index = False
+
     def __init__(self, configs):
         super(Algorithm, self).__init__()
         self.configs = configs
         self.cross_entropy = nn.CrossEntropyLoss()
+        self.weight_averaging = None
+        self._labels = {}
 
     def update(self, *args, **kwargs):
         raise NotImplementedError
 
+    def update_weight_averaging(self):
+        """Fold the current weights of self.network into its averaged copy; call after every update()."""
+        if self.weight_averaging is None:
+            self.weight_averaging = self.make_weight_averaging(self.network)
+            if self.weight_averaging is None:
+                return
+        self.weight_averaging.update(self.network)
+
+    def make_weight_averaging(self, model):
+        """WeightAveraging of model set up by the hparams, None when weight averaging is disabled."""
+        mode = self.hparams.get("weight_averaging", self.default_weight_averaging)
+        if mode in (None, "none"):
+            return None
+        return WeightAveraging(model, mode, decay=self.hparams.get("ema_decay", 0.998),
+                               swa_start=self.hparams.get("swa_start", 0), swa_freq=self.hparams.get("swa_freq", 1))
+
+    def constant_labels(self, n, value, device):
+        """Float label vector of length n filled with value, cached across steps."""
+        key = (n, value, str(device))
+        if key not in self._labels:
+            self._labels[key] = torch.full((n,), value, dtype=torch.float, device=device)
+        return self._labels[key]
+
+    def teacher_outputs(self, src_x, trg_x):
+        """Frozen teacher features and logits, {domain: (feat, logits)} for each of self.teacher_domains."""
+        self.network_t.eval()
+        return frozen_teacher_outputs(self.network_t, src_x, trg_x, self.teacher_domains)
+
+    def init_teacher(self, configs, network_t=None):
+        """Teacher of a KD algorithm: network_t when given (e.g. shared by several students), else a new CNN_T."""
+        if network_t is None:
+            from models import models
+            network_t = nn.Sequential(convert_domain_batchnorm(models.CNN_T(configs)), models.classifier_T(configs))
+        self.set_teacher(network_t)
+
+    def set_teacher(self, network_t):
+        """Replace the teacher by network_t, e.g. a TeacherEnsemble or the teacher of another algorithm."""
+        self.t_feature_extractor = network_t[0]
+        self.t_classifier = network_t[1]
+        self.network_t = network_t
+
+    def share_teacher(self, other):
+        """Use the frozen teacher of another algorithm, e.g. when several students distill from one teacher."""
+        self.set_teacher(other.network_t)
+
+    def pseudo_label_term(self, pseudo_labels, trg_feat=None, trg_pred=None):
+        """
+        Pseudo-label loss of the batch to add to the loss of update() and its logged value, (0, {}) when the trainer
+        passes no pseudo_labels. The target logits are trg_pred, else computed from trg_feat only when needed.
+        """
+        if pseudo_labels is None:
+            return 0., {}
+        if trg_pred is None:
+            trg_pred = self.classifier(trg_feat)
+        pseudo_label_loss = self.pseudo_label_loss(trg_pred, pseudo_labels)
+        return pseudo_label_loss, {'Pseudo_label_loss': pseudo_label_loss.item()}
+
+    def pseudo_label_loss(self, trg_pred, pseudo_labels):
+        """
+        Cross-entropy of the target logits on the confident stored pseudo-labels of the batch (a PseudoLabelBatch,
+        see models.pseudo_labels), weighted by the pseudo_label_wt hparam. The store is then refreshed with the logits.
+        """
+        pseudo_labels.observe(trg_pred)
+        mask = pseudo_labels.mask
+        if not mask.any():
+            return trg_pred.sum() * 0.0
+        return self.hparams.get("pseudo_label_wt", 1.0) * self.cross_entropy(trg_pred[mask], pseudo_labels.labels[mask])
+
+    def eval_network(self):
+        """Network used for evaluation: the averaged copy when weight averaging is enabled."""
+        if self.weight_averaging is None:
+            return self.network
+        return self.weight_averaging.averaged_model
+
 
 class Lower_Upper_bounds(Algorithm):
     """
@@ -41,7 +132,7 @@ class Lower_Upper_bounds(Algorithm):
     def __init__(self, backbone_fe, configs, hparams, device):
         super(Lower_Upper_bounds, self).__init__(configs)
 
-        self.feature_extractor = backbone_fe(configs)
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
         self.classifier = classifier(configs)
         self.network = nn.Sequential(self.feature_extractor, self.classifier)
 
@@ -76,10 +167,14 @@ class MMDA(Algorithm):
         super(MMDA, self).__init__(configs)
 
         self.mmd = MMD_loss()
-        self.coral = CORAL()
+        self.coral = CORAL(momentum=hparams.get("coral_momentum", None))
         self.cond_ent = ConditionalEntropyLoss()
 
-        self.feature_extractor = backbone_fe(configs)
+        # cross-batch memory of past features for the MMD estimate
+        self.src_memory = FeatureMemoryBank(hparams.get("memory_bank_size", 0))
+        self.trg_memory = FeatureMemoryBank(hparams.get("memory_bank_size", 0))
+
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
         self.classifier = classifier(configs)
         self.network = nn.Sequential(self.feature_extractor, self.classifier)
 
@@ -90,29 +185,30 @@ class MMDA(Algorithm):
         )
         self.hparams = hparams
 
-    def update(self, src_x, src_y, trg_x):
-        src_feat = self.feature_extractor(src_x)
+    def update(self, src_x, src_y, trg_x, pseudo_labels=None):
+        src_feat, trg_feat = joint_forward(self.feature_extractor, src_x, trg_x)
         src_pred = self.classifier(src_feat)
 
         src_cls_loss = self.cross_entropy(src_pred, src_y)
 
-        trg_feat = self.feature_extractor(trg_x)
-
         coral_loss = self.coral(src_feat, trg_feat)
-        mmd_loss = self.mmd(src_feat, trg_feat)
+        mmd_loss = self.mmd(src_feat, trg_feat, self.src_memory, self.trg_memory)
         cond_ent_loss = self.cond_ent(trg_feat)
 
+        pseudo_label_loss, pseudo_label_losses = self.pseudo_label_term(pseudo_labels, trg_feat)
         loss = self.hparams["coral_wt"] * coral_loss + \
                self.hparams["mmd_wt"] * mmd_loss + \
                self.hparams["cond_ent_wt"] * cond_ent_loss + \
-               self.hparams["src_cls_loss_wt"] * src_cls_loss
+               self.hparams["src_cls_loss_wt"] * src_cls_loss + \
+               pseudo_label_loss
 
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
 
-        return {'Total_loss': loss.item(), 'Coral_loss': coral_loss.item(), 'MMD_loss': mmd_loss.item(),
-                'cond_ent_wt': cond_ent_loss.item(), 'Src_cls_loss': src_cls_loss.item()}
+        losses = {'Total_loss': loss.item(), 'Coral_loss': coral_loss.item(), 'MMD_loss': mmd_loss.item(),
+                  'cond_ent_wt': cond_ent_loss.item(), 'Src_cls_loss': src_cls_loss.item()}
+        return {**losses, **pseudo_label_losses}
 
 
 class DANN(Algorithm):
@@ -123,7 +219,7 @@ class DANN(Algorithm):
     def __init__(self, backbone_fe, configs, hparams, device):
         super(DANN, self).__init__(configs)
 
-        self.feature_extractor = backbone_fe(configs)
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
         self.classifier = classifier(configs)
         self.network = nn.Sequential(self.feature_extractor, self.classifier)
 
@@ -142,7 +238,7 @@ class DANN(Algorithm):
         self.hparams = hparams
         self.device = device
 
-    def update(self, src_x, src_y, trg_x, step, epoch, len_dataloader):
+    def update(self, src_x, src_y, trg_x, step, epoch, len_dataloader, pseudo_labels=None):
         p = float(step + epoch * len_dataloader) / self.hparams["num_epochs"] + 1 / len_dataloader
         alpha = 2. / (1. + np.exp(-10 * p)) - 1
 
@@ -153,36 +249,37 @@ class DANN(Algorithm):
         domain_label_src = torch.ones(len(src_x)).to(self.device)
         domain_label_trg = torch.zeros(len(trg_x)).to(self.device)
 
-        src_feat = self.feature_extractor(src_x)
+        src_feat, trg_feat = joint_forward(self.feature_extractor, src_x, trg_x)
         src_pred = self.classifier(src_feat)
 
-        trg_feat = self.feature_extractor(trg_x)
-
         # Task classification  Loss
         src_cls_loss = self.cross_entropy(src_pred.squeeze(), src_y)
 
         # Domain classification loss
-        # source
         src_feat_reversed = ReverseLayerF.apply(src_feat, alpha)
-        src_domain_pred = self.domain_classifier(src_feat_reversed)
+        trg_feat_reversed = ReverseLayerF.apply(trg_feat, alpha)
+        src_domain_pred, trg_domain_pred = joint_forward(self.domain_classifier, src_feat_reversed, trg_feat_reversed)
+
+        # source
         src_domain_loss = self.cross_entropy(src_domain_pred, domain_label_src.long())
 
         # target
-        trg_feat_reversed = ReverseLayerF.apply(trg_feat, alpha)
-        trg_domain_pred = self.domain_classifier(trg_feat_reversed)
         trg_domain_loss = self.cross_entropy(trg_domain_pred, domain_label_trg.long())
 
         # Total domain loss
         domain_loss = src_domain_loss + trg_domain_loss
 
+        pseudo_label_loss, pseudo_label_losses = self.pseudo_label_term(pseudo_labels, trg_feat)
         loss = self.hparams["src_cls_loss_wt"] * src_cls_loss + \
-               self.hparams["domain_loss_wt"] * domain_loss
+               self.hparams["domain_loss_wt"] * domain_loss + \
+               pseudo_label_loss
 
         loss.backward()
         self.optimizer.step()
         self.optimizer_disc.step()
 
-        return {'Total_loss': loss.item(), 'Domain_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item()}
+        losses = {'Total_loss': loss.item(), 'Domain_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item()}
+        return {**losses, **pseudo_label_losses}
 
 
 class CDAN(Algorithm):
@@ -193,13 +290,19 @@ class CDAN(Algorithm):
     def __init__(self, backbone_fe, configs, hparams, device):
         super(CDAN, self).__init__(configs)
 
-        self.feature_extractor = backbone_fe(configs)
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
         self.classifier = classifier(configs)
         self.network = nn.Sequential(self.feature_extractor, self.classifier)
 
-        self.domain_classifier = Discriminator_CDAN(configs)
-        self.random_layer = RandomLayer([configs.features_len * configs.final_out_channels, configs.num_classes],
-                                        configs.features_len * configs.final_out_channels)
+        # condition the discriminator on the feature x prediction outer product, or on its randomized
+        # multilinear approximation when the outer product gets wider than cdan_max_multilinear_dim
+        feat_dim = configs.features_len * configs.final_out_channels
+        if feat_dim * configs.num_classes > hparams.get("cdan_max_multilinear_dim", 4096):
+            self.random_layer = RandomLayer([feat_dim, configs.num_classes], hparams.get("cdan_random_dim", 1024))
+            self.domain_classifier = Discriminator_CDAN(configs, input_dim=self.random_layer.output_dim)
+        else:
+            self.random_layer = None
+            self.domain_classifier = Discriminator_CDAN(configs)
 
         # optimizers
         self.optimizer = torch.optim.Adam(
@@ -217,27 +320,26 @@ class CDAN(Algorithm):
         self.criterion_cond = ConditionalEntropyLoss().to(device)
         self.device = device
 
-    def update(self, src_x, src_y, trg_x):
+    def multilinear_map(self, feat, pred):
+        if self.random_layer is not None:
+            return self.random_layer([feat, pred])
+        return torch.bmm(pred.unsqueeze(2), feat.unsqueeze(1)).view(-1, pred.size(1) * feat.size(1))
+
+    def update(self, src_x, src_y, trg_x, pseudo_labels=None):
         # prepare true domain labels
         domain_label_src = torch.ones(len(src_x)).to(self.device)
         domain_label_trg = torch.zeros(len(trg_x)).to(self.device)
         domain_label_concat = torch.cat((domain_label_src, domain_label_trg), 0).long()
 
-        # source features and predictions
-        src_feat = self.feature_extractor(src_x)
-        src_pred = self.classifier(src_feat)
-
-        # target features and predictions
-        trg_feat = self.feature_extractor(trg_x)
-        trg_pred = self.classifier(trg_feat)
-
-        # concatenate features and predictions
+        # source and target features and predictions
+        src_feat, trg_feat = joint_forward(self.feature_extractor, src_x, trg_x)
         feat_concat = torch.cat((src_feat, trg_feat), dim=0)
-        pred_concat = torch.cat((src_pred, trg_pred), dim=0)
+        pred_concat = self.classifier(feat_concat)
+        src_pred, trg_pred = torch.split(pred_concat, [len(src_x), len(trg_x)], dim=0)
 
         # Domain classification loss
-        feat_x_pred = torch.bmm(pred_concat.unsqueeze(2), feat_concat.unsqueeze(1)).detach()
-        disc_prediction = self.domain_classifier(feat_x_pred.view(-1, pred_concat.size(1) * feat_concat.size(1)))
+        feat_x_pred = self.multilinear_map(feat_concat, pred_concat)
+        disc_prediction = self.domain_classifier(feat_x_pred.detach())
         disc_loss = self.cross_entropy(disc_prediction, domain_label_concat)
 
         # update Domain classification
@@ -251,8 +353,7 @@ class CDAN(Algorithm):
         domain_label_concat = torch.cat((domain_label_src, domain_label_trg), 0)
 
         # Repeat predictions after updating discriminator
-        feat_x_pred = torch.bmm(pred_concat.unsqueeze(2), feat_concat.unsqueeze(1))
-        disc_prediction = self.domain_classifier(feat_x_pred.view(-1, pred_concat.size(1) * feat_concat.size(1)))
+        disc_prediction = self.domain_classifier(feat_x_pred)
         # loss of domain discriminator according to fake labels
 
         domain_loss = self.cross_entropy(disc_prediction, domain_label_concat)
@@ -264,27 +365,32 @@ class CDAN(Algorithm):
         loss_trg_cent = self.criterion_cond(trg_pred)
 
         # total loss
+        pseudo_label_loss, pseudo_label_losses = self.pseudo_label_term(pseudo_labels, trg_pred=trg_pred)
         loss = self.hparams["src_cls_loss_wt"] * src_cls_loss + self.hparams["domain_loss_wt"] * domain_loss + \
-               self.hparams["cond_ent_wt"] * loss_trg_cent
+               self.hparams["cond_ent_wt"] * loss_trg_cent + \
+               pseudo_label_loss
 
         # update feature extractor
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
 
-        return {'Total_loss': loss.item(), 'Domain_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item(),
-                'cond_ent_loss': loss_trg_cent.item()}
+        losses = {'Total_loss': loss.item(), 'Domain_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item(),
+                  'cond_ent_loss': loss_trg_cent.item()}
+        return {**losses, **pseudo_label_losses}
 
 
 class DIRT(Algorithm):
     """
     DIRT-T: https://arxiv.org/abs/1802.08735
     """
+    # the teacher of DIRT-T is an exponential moving average of the student
+    default_weight_averaging = "ema"
 
     def __init__(self, backbone_fe, configs, hparams, device):
         super(DIRT, self).__init__(configs)
 
-        self.feature_extractor = backbone_fe(configs)
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
         self.classifier = classifier(configs)
         self.network = nn.Sequential(self.feature_extractor, self.classifier)
 
@@ -306,29 +412,28 @@ class DIRT(Algorithm):
 
         # criterion
         self.criterion_cond = ConditionalEntropyLoss().to(device)
-        self.vat_loss = VAT(self.network, device).to(device)
+
+        # VAT mode: 'input' perturbs each domain's inputs separately, 'joint' perturbs source and
+        # target inputs in one batched pass, 'feature' perturbs the extracted features and only
+        # re-runs the classifier.
+        self.vat_mode = hparams.get("vat_mode", "input")
+        vat_model = self.classifier if self.vat_mode == "feature" else self.network
+        self.vat_loss = VAT(vat_model, device, epsilon=hparams.get("vat_epsilon", 3.5)).to(device)
 
         # device for further usage
         self.device = device
 
-        self.ema = EMA(0.998)
-        self.ema.register(self.network)
-
-    def update(self, src_x, src_y, trg_x):
+    def update(self, src_x, src_y, trg_x, pseudo_labels=None):
         # prepare true domain labels
         domain_label_src = torch.ones(len(src_x)).to(self.device)
         domain_label_trg = torch.zeros(len(trg_x)).to(self.device)
         domain_label_concat = torch.cat((domain_label_src, domain_label_trg), 0).long()
 
-        src_feat = self.feature_extractor(src_x)
-        src_pred = self.classifier(src_feat)
-
-        # target features and predictions
-        trg_feat = self.feature_extractor(trg_x)
-        trg_pred = self.classifier(trg_feat)
-
-        # concatenate features and predictions
+        # source and target features and predictions
+        src_feat, trg_feat = joint_forward(self.feature_extractor, src_x, trg_x)
         feat_concat = torch.cat((src_feat, trg_feat), dim=0)
+        pred_concat = self.classifier(feat_concat)
+        src_pred, trg_pred = torch.split(pred_concat, [len(src_x), len(trg_x)], dim=0)
 
         # Domain classification loss
         disc_prediction = self.domain_classifier(feat_concat.detach())
@@ -357,23 +462,31 @@ class DIRT(Algorithm):
         loss_trg_cent = self.criterion_cond(trg_pred)
 
         # Virual advariarial training loss
-        loss_src_vat = self.vat_loss(src_x, src_pred)
-        loss_trg_vat = self.vat_loss(trg_x, trg_pred)
-        total_vat = loss_src_vat + loss_trg_vat
+        if self.vat_mode == "input":
+            with domain_split(self.network, (len(src_x), 0)):
+                loss_src_vat = self.vat_loss(src_x, src_pred)
+            with domain_split(self.network, (0, len(trg_x))):
+                loss_trg_vat = self.vat_loss(trg_x, trg_pred)
+            total_vat = loss_src_vat + loss_trg_vat
+        else:
+            domain_sizes = (len(src_x), len(trg_x))
+            vat_inputs = feat_concat if self.vat_mode == "feature" else torch.cat((src_x, trg_x), dim=0)
+            with domain_split(self.network, domain_sizes):
+                total_vat = self.vat_loss(vat_inputs, pred_concat, domain_sizes=domain_sizes)
         # total loss
+        pseudo_label_loss, pseudo_label_losses = self.pseudo_label_term(pseudo_labels, trg_pred=trg_pred)
         loss = self.hparams["src_cls_loss_wt"] * src_cls_loss + self.hparams["domain_loss_wt"] * domain_loss + \
-               self.hparams["cond_ent_wt"] * loss_trg_cent + self.hparams["vat_loss_wt"] * total_vat
-
-        # update exponential moving average
-        self.ema(self.network)
+               self.hparams["cond_ent_wt"] * loss_trg_cent + self.hparams["vat_loss_wt"] * total_vat + \
+               pseudo_label_loss
 
         # update feature extractor
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
 
-        return {'Total_loss': loss.item(), 'Domain_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item(),
-                'cond_ent_loss': loss_trg_cent.item()}
+        losses = {'Total_loss': loss.item(), 'Domain_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item(),
+                  'cond_ent_loss': loss_trg_cent.item()}
+        return {**losses, **pseudo_label_losses}
 
 
 class HoMM(Algorithm):
@@ -386,7 +499,7 @@ class HoMM(Algorithm):
 
         self.coral = CORAL()
 
-        self.feature_extractor = backbone_fe(configs)
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
         self.classifier = classifier(configs)
         self.network = nn.Sequential(self.feature_extractor, self.classifier)
 
@@ -399,30 +512,33 @@ class HoMM(Algorithm):
         self.device = device
         self.HoMM_loss = HoMM_loss()
 
-    def update(self, src_x, src_y, trg_x):
-        # extract source features
-        src_feat = self.feature_extractor(src_x)
-        src_pred = self.classifier(src_feat)
+        # running moments of past features for the moment estimates
+        self.src_memory = RunningMoments(hparams.get("memory_bank_size", 0))
+        self.trg_memory = RunningMoments(hparams.get("memory_bank_size", 0))
 
-        # extract target features
-        trg_feat = self.feature_extractor(trg_x)
-        trg_pred = self.classifier(trg_feat)
+    def update(self, src_x, src_y, trg_x, pseudo_labels=None):
+        # extract source and target features
+        src_feat, trg_feat = joint_forward(self.feature_extractor, src_x, trg_x)
+        src_pred = self.classifier(src_feat)
 
         # calculate source classification loss
         src_cls_loss = self.cross_entropy(src_pred, src_y)
 
         # calculate lmmd loss
-        domain_loss = self.HoMM_loss(src_feat, trg_feat)
+        domain_loss = self.HoMM_loss(src_feat, trg_feat, self.src_memory, self.trg_memory)
 
         # calculate the total loss
+        pseudo_label_loss, pseudo_label_losses = self.pseudo_label_term(pseudo_labels, trg_feat)
         loss = self.hparams["domain_loss_wt"] * domain_loss + \
-               self.hparams["src_cls_loss_wt"] * src_cls_loss
+               self.hparams["src_cls_loss_wt"] * src_cls_loss + \
+               pseudo_label_loss
 
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
 
-        return {'Total_loss': loss.item(), 'HoMM_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item()}
+        losses = {'Total_loss': loss.item(), 'HoMM_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item()}
+        return {**losses, **pseudo_label_losses}
 
 
 class DDC(Algorithm):
@@ -433,7 +549,7 @@ class DDC(Algorithm):
     def __init__(self, backbone_fe, configs, hparams, device):
         super(DDC, self).__init__(configs)
 
-        self.feature_extractor = backbone_fe(configs)
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
         self.classifier = classifier(configs)
         self.network = nn.Sequential(self.feature_extractor, self.classifier)
 
@@ -446,29 +562,33 @@ class DDC(Algorithm):
         self.device = device
         self.mmd_loss = MMD_loss()
 
-    def update(self, src_x, src_y, trg_x):
-        # extract source features
-        src_feat = self.feature_extractor(src_x)
-        src_pred = self.classifier(src_feat)
+        # cross-batch memory of past features for the MMD estimate
+        self.src_memory = FeatureMemoryBank(hparams.get("memory_bank_size", 0))
+        self.trg_memory = FeatureMemoryBank(hparams.get("memory_bank_size", 0))
 
-        # extract target features
-        trg_feat = self.feature_extractor(trg_x)
+    def update(self, src_x, src_y, trg_x, pseudo_labels=None):
+        # extract source and target features
+        src_feat, trg_feat = joint_forward(self.feature_extractor, src_x, trg_x)
+        src_pred = self.classifier(src_feat)
 
         # calculate source classification loss
         src_cls_loss = self.cross_entropy(src_pred, src_y)
 
         # calculate mmd loss
-        domain_loss = self.mmd_loss(src_feat, trg_feat)
+        domain_loss = self.mmd_loss(src_feat, trg_feat, self.src_memory, self.trg_memory)
 
         # calculate the total loss
+        pseudo_label_loss, pseudo_label_losses = self.pseudo_label_term(pseudo_labels, trg_feat)
         loss = self.hparams["domain_loss_wt"] * domain_loss + \
-               self.hparams["src_cls_loss_wt"] * src_cls_loss
+               self.hparams["src_cls_loss_wt"] * src_cls_loss + \
+               pseudo_label_loss
 
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
 
-        return {'Total_loss': loss.item(), 'MMD_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item()}
+        losses = {'Total_loss': loss.item(), 'MMD_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item()}
+        return {**losses, **pseudo_label_losses}
 
 
 class CoDATS(Algorithm):
@@ -479,7 +599,7 @@ class CoDATS(Algorithm):
     def __init__(self, backbone_fe, configs, hparams, device):
         super(CoDATS, self).__init__(configs)
 
-        self.feature_extractor = backbone_fe(configs)
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
         # we replace the original classifier with codats the classifier
         # remember to use same name of self.classifier, as we use it for the model evaluation
         self.classifier = codats_classifier(configs)
@@ -500,7 +620,7 @@ class CoDATS(Algorithm):
         self.hparams = hparams
         self.device = device
 
-    def update(self, src_x, src_y, trg_x, step, epoch, len_dataloader):
+    def update(self, src_x, src_y, trg_x, step, epoch, len_dataloader, pseudo_labels=None):
         p = float(step + epoch * len_dataloader) / self.hparams["num_epochs"] + 1 / len_dataloader
         alpha = 2. / (1. + np.exp(-10 * p)) - 1
 
@@ -511,36 +631,97 @@ class CoDATS(Algorithm):
         domain_label_src = torch.ones(len(src_x)).to(self.device)
         domain_label_trg = torch.zeros(len(trg_x)).to(self.device)
 
-        src_feat = self.feature_extractor(src_x)
+        src_feat, trg_feat = joint_forward(self.feature_extractor, src_x, trg_x)
         src_pred = self.classifier(src_feat)
 
-        trg_feat = self.feature_extractor(trg_x)
-
         # Task classification  Loss
         src_cls_loss = self.cross_entropy(src_pred.squeeze(), src_y)
 
         # Domain classification loss
-        # source
         src_feat_reversed = ReverseLayerF.apply(src_feat, alpha)
-        src_domain_pred = self.domain_classifier(src_feat_reversed)
+        trg_feat_reversed = ReverseLayerF.apply(trg_feat, alpha)
+        src_domain_pred, trg_domain_pred = joint_forward(self.domain_classifier, src_feat_reversed, trg_feat_reversed)
+
+        # source
         src_domain_loss = self.cross_entropy(src_domain_pred, domain_label_src.long())
 
         # target
-        trg_feat_reversed = ReverseLayerF.apply(trg_feat, alpha)
-        trg_domain_pred = self.domain_classifier(trg_feat_reversed)
         trg_domain_loss = self.cross_entropy(trg_domain_pred, domain_label_trg.long())
 
         # Total domain loss
         domain_loss = src_domain_loss + trg_domain_loss
 
+        pseudo_label_loss, pseudo_label_losses = self.pseudo_label_term(pseudo_labels, trg_feat)
         loss = self.hparams["src_cls_loss_wt"] * src_cls_loss + \
-               self.hparams["domain_loss_wt"] * domain_loss
+               self.hparams["domain_loss_wt"] * domain_loss + \
+               pseudo_label_loss
 
         loss.backward()
         self.optimizer.step()
         self.optimizer_disc.step()
 
-        return {'Total_loss': loss.item(), 'Domain_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item()}
+        losses = {'Total_loss': loss.item(), 'Domain_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item()}
+        return {**losses, **pseudo_label_losses}
+
+
+class KNN_ST(Algorithm):
+    """
+    Self-training by kNN label propagation over the target domain: the target samples take the similarity-weighted
+    predictions of their nearest target neighbours (models.knn_index.FeatureIndex over the features of past steps) as
+    pseudo-labels, kept where they agree with the majority label of their cluster, and are pulled towards the
+    predictions of their neighbours (neighbourhood consistency, as in NRC https://arxiv.org/abs/2110.04202).
+    """
+    uses_target_index = True
+
+    def __init__(self, backbone_fe, configs, hparams, device):
+        super(KNN_ST, self).__init__(configs)
+
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
+        self.classifier = classifier(configs)
+        self.network = nn.Sequential(self.feature_extractor, self.classifier)
+
+        self.optimizer = torch.optim.Adam(
+            self.network.parameters(),
+            lr=hparams["learning_rate"],
+            weight_decay=hparams["weight_decay"]
+        )
+        self.hparams = hparams
+        self.device = device
+
+        self.trg_index = FeatureIndex(device, hparams.get("num_lists", 0), hparams.get("num_probes"))
+        self.num_neighbors = hparams.get("num_neighbors", 5)
+
+    def update(self, src_x, src_y, trg_x, trg_idx, pseudo_labels=None):
+        src_feat, trg_feat = joint_forward(self.feature_extractor, src_x, trg_x)
+        src_pred, trg_pred = joint_forward(self.classifier, src_feat, trg_feat)
+        trg_prob = F.softmax(trg_pred, dim=1)
+
+        src_cls_loss = self.cross_entropy(src_pred, src_y)
+
+        # the index holds the target features of the previous steps, it is ready after one pass over the target
+        pseudo_label_loss = nc_loss = torch.zeros((), device=trg_pred.device)
+        if self.trg_index.ready:
+            neighbor_probs = self.trg_index.neighbor_probs(trg_feat, self.num_neighbors, exclude=trg_idx)
+            knn_labels = neighbor_probs.argmax(dim=1)
+            mask = self.trg_index.select(trg_idx, knn_labels)
+            if mask.any():
+                pseudo_label_loss = self.cross_entropy(trg_pred[mask], knn_labels[mask])
+            nc_loss = -torch.log((trg_prob * neighbor_probs).sum(dim=1).clamp(min=1e-8)).mean()
+        self.trg_index.update(trg_idx, trg_feat, trg_prob)
+        # confident predictions of the trainer's pseudo-label store, when enabled, on top of the kNN ones
+        store_loss, store_losses = self.pseudo_label_term(pseudo_labels, trg_pred=trg_pred)
+
+        loss = self.hparams["src_cls_loss_wt"] * src_cls_loss + \
+               self.hparams["pseudo_label_wt"] * pseudo_label_loss + \
+               self.hparams["nc_loss_wt"] * nc_loss + \
+               store_loss
+
+        self.optimizer.zero_grad()
+        loss.backward()
+        self.optimizer.step()
+
+        return {'Total_loss': loss.item(), 'Src_cls_loss': src_cls_loss.item(),
+                'KNN_pseudo_label_loss': pseudo_label_loss.item(), 'NC_loss': nc_loss.item(), **store_losses}
 
 
 class UDA_KD(Algorithm):
@@ -548,31 +729,32 @@ class UDA_KD(Algorithm):
     AdvCDKD
     """
 
-    def __init__(self, backbone_fe, configs, hparams, device):
+    teacher_domains = ('src', 'trg')
+    teacher_kind = 'uda'
+
+    def __init__(self, backbone_fe, configs, hparams, device, network_t=None):
         super(UDA_KD, self).__init__(configs)
-        from models import models
-        self.t_feature_extractor = models.CNN_T(configs)
-        self.t_classifier = models.classifier_T(configs)
-        self.network_t = nn.Sequential(self.t_feature_extractor, self.t_classifier)
+        self.init_teacher(configs, network_t)
 
-        self.feature_extractor = backbone_fe(configs)
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
         self.classifier = classifier(configs)
         self.network = nn.Sequential(self.feature_extractor, self.classifier)
 
-        self.data_domain_classifier_t = Discriminator_t(configs)
-
         self.data_domain_classifier = Discriminator(configs)
         self.feature_domain_classifier = Discriminator_fea(configs)
         self.adapter = Adapter(configs)
 
-        self.optimizer = torch.optim.Adam(
-            list(self.network.parameters()) + list(self.adapter.parameters()),
-            lr=hparams["learning_rate"],
-            weight_decay=hparams["weight_decay"], betas=(0.5, 0.99)
-        )
+        # exit heads after the first CNN blocks, trained with the student for the early-exit cascade
+        self.exit_blocks = EXIT_BLOCKS if hparams.get("early_exit", False) else ()
+        self.exit_heads = make_exit_heads(self.feature_extractor, configs.num_classes, self.exit_blocks)
+        self.exit_kd_loss = DistillationLoss(hparams["temperature"], kind='vanilla')
+        # the heads are averaged with the network, so that they match the averaged backbone they exit from
+        self.exit_heads_averaging = None
 
-        self.optimizer_disc = torch.optim.Adam(
-            self.data_domain_classifier.parameters(),
+        # student, adapter, exit heads and data domain classifier are always stepped together
+        self.optimizer = torch.optim.Adam(
+            list(self.network.parameters()) + list(self.adapter.parameters()) + list(self.exit_heads.parameters()) +
+            list(self.data_domain_classifier.parameters()),
             lr=hparams["learning_rate"],
             weight_decay=hparams["weight_decay"], betas=(0.5, 0.99)
         )
@@ -586,105 +768,84 @@ class UDA_KD(Algorithm):
         self.hparams = hparams
         self.device = device
         self.temperature = hparams["temperature"]
+        self.kd_loss = DistillationLoss(self.temperature, kind='disentangled')
+        self.bce = nn.BCEWithLogitsLoss()
+        self.l1 = nn.L1Loss()
+        # the feature discriminator is updated every disc_update_every steps
+        self.disc_update_every = hparams.get("disc_update_every", 1)
 
 
-    def update(self, src_x, src_y, trg_x, step, epoch, len_dataloader):
+    def update(self, src_x, src_y, trg_x, step, epoch, len_dataloader, teacher_outputs=None):
         p = float(step + epoch * len_dataloader) / self.hparams["num_epochs"] + 1 / len_dataloader
         alpha = 2. / (1. + np.exp(-10 * p)) - 1
-        self.network_t.eval()
 
-        real_label = 1
-        fake_label = 0
+        # Teacher features (the real samples of the feature discriminator) and logits,
+        # computed here unless an AsyncTeacher already produced them
+        if teacher_outputs is None:
+            teacher_outputs = self.teacher_outputs(src_x, trg_x)
+        src_feat_t, src_pred_t = teacher_outputs['src']
+        trg_feat_t, trg_logits_t = teacher_outputs['trg']
+
+        # Student Forward, with its features mapped to the teacher feature space (the fake samples)
+        with BlockTaps(self.feature_extractor, self.exit_blocks) as taps:
+            src_feat, trg_feat = joint_forward(self.feature_extractor, src_x, trg_x)
+        src_feat_hint, trg_feat_hint = joint_forward(self.adapter, src_feat, trg_feat)
+        fea_hint = torch.concat((src_feat_hint, trg_feat_hint), dim=0).detach()
 
         ########################################################
         # (1) update D network: maximize log(D(fea_t)) + log(1-D(G(x))
-        # fea_t: feature from teacher network
-        # x: input data
-        # G(x): feature from student network
+        # real and fake batches go through D in a single forward pass
         ########################################################
-        self.optimizer_feat.zero_grad()
-
-        # Format Batch
-        src_feat_t = self.t_feature_extractor(src_x)
-        src_feat_t = Variable(src_feat_t, requires_grad=False)
-
-        trg_feat_t = self.t_feature_extractor(trg_x)
-        trg_feat_t = Variable(trg_feat_t, requires_grad=False)
-
-        f_domain_label = torch.full((src_x.shape[0]+trg_x.shape[0],), real_label, dtype=torch.float, device=self.device)
-
-        # Forward pass real batch through D
-        output = self.feature_domain_classifier(torch.concat((src_feat_t,trg_feat_t),dim=0)).view(-1)
-        # Calculate loss on all-real batch
-        errD_real = nn.BCELoss()(output, f_domain_label)
-        # Calculate gradients for D in backward pass
-        errD_real.backward()
-
-        # Train with all-fake batch, Generate fake features with G
-        # Student Forward
-        src_feat = self.feature_extractor(src_x)
-        src_feat_hint = self.adapter(src_feat)
-
-        trg_feat = self.feature_extractor(trg_x)
-        trg_feat_hint = self.adapter(trg_feat)
-
-        f_domain_label.fill_(fake_label)
-        # Classify all fake batch with D
-
-        fea_hint = torch.concat((src_feat_hint,trg_feat_hint),dim=0).detach()
-
-        output = self.feature_domain_classifier(fea_hint).view(-1)
-        # Calculate D's loss on the all-fake batch
-        errD_fake = nn.BCELoss()(output, f_domain_label)
-        # Calculate the gradients for this batch
-        errD_fake.backward()
-
-        # Add the gradients from all-real and all-fake batches
-        errD = errD_real + errD_fake
-        # Update D
-        self.optimizer_feat.step()
+        n = len(fea_hint)
+        real_label = self.constant_labels(n, 1., fea_hint.device)
+        fake_label = self.constant_labels(n, 0., fea_hint.device)
+
+        losses = {}
+        if step % self.disc_update_every == 0:
+            output = self.feature_domain_classifier(torch.concat((src_feat_t, trg_feat_t, fea_hint), dim=0)).view(-1)
+            errD = self.bce(output[:n], real_label) + self.bce(output[n:], fake_label)
+
+            self.optimizer_feat.zero_grad()
+            errD.backward()
+            self.optimizer_feat.step()
+            output = output[n:].detach()
+            losses['errD'] = errD.item()
+        else:
+            with torch.no_grad():
+                output = self.feature_domain_classifier(fea_hint).view(-1)
 
         ########################################################
         # (2) update G network: maximize log(D(G(x))
         ########################################################
-
-        # zero grad
         self.optimizer.zero_grad()
-        self.optimizer_disc.zero_grad()
 
-        src_pred_t = self.t_classifier(src_feat_t)
+        # the target KD term uses the source logits of teacher and student
         src_pred = self.classifier(src_feat)
+        trg_pred = src_pred
+        # teacher log-probabilities of the source logits, computed once for both KD terms and the exit heads
+        src_logp_t = self.kd_loss.teacher_log_probs(src_pred_t)
 
-        trg_pred_t = self.t_classifier(src_feat_t)
-        trg_pred = self.classifier(src_feat)
-
-        # fake labels are real for generator cost
-        f_domain_label.fill_(real_label)
-        # Since we just updated D, perform another forward pass of all-fake batch through D
-        output = self.feature_domain_classifier(fea_hint).view(-1)
-
-        # Calculate G's loss based on this output
-        errG = nn.BCELoss()(output, f_domain_label)
-        errL1 = nn.L1Loss()(src_feat_hint, src_feat_t) + nn.L1Loss()(trg_feat_hint,trg_feat_t)
+        # fake labels are real for generator cost (the student hints are detached, as before)
+        errG = self.bce(output, real_label)
+        errL1 = self.l1(src_feat_hint, src_feat_t) + self.l1(trg_feat_hint, trg_feat_t)
         errG = errG + errL1
 
         # Domain classification loss
         domain_label_src = torch.ones(len(src_x)).to(self.device)
         domain_label_trg = torch.zeros(len(trg_x)).to(self.device)
 
-        trg_feat = self.feature_extractor(trg_x)
+        src_feat_reversed = ReverseLayerF.apply(src_feat, alpha)
+        trg_feat_reversed = ReverseLayerF.apply(trg_feat, alpha)
+        src_domain_pred, trg_domain_pred = joint_forward(self.data_domain_classifier, src_feat_reversed,
+                                                         trg_feat_reversed)
 
         # source
-        src_feat_reversed = ReverseLayerF.apply(src_feat, alpha)
-        src_domain_pred = self.data_domain_classifier(src_feat_reversed)
         src_domain_loss = self.cross_entropy(src_domain_pred, domain_label_src.long())
 
         src_dis_pred_t = torch.nn.functional.softmax(src_domain_pred, dim=1)
         weights_src = 1 - torch.abs(src_dis_pred_t[:, 0] - src_dis_pred_t[:, 1])
 
         # target
-        trg_feat_reversed = ReverseLayerF.apply(trg_feat, alpha)
-        trg_domain_pred = self.data_domain_classifier(trg_feat_reversed)
         trg_domain_loss = self.cross_entropy(trg_domain_pred, domain_label_trg.long())
 
         trg_dis_pred_t = torch.nn.functional.softmax(trg_domain_pred,dim=1)
@@ -693,23 +854,9 @@ class UDA_KD(Algorithm):
         # Total domain loss
         domain_loss = src_domain_loss + trg_domain_loss
 
-        # Add KD loss
-        # Normal Knowledge
-        # soft_loss = torch.nn.functional.kl_div(src_pred_s_soften, src_pred_t_soften, reduction='batchmean', log_target=True)\
-        #             + torch.nn.functional.kl_div(trg_pred_s_soften, trg_pred_t_soften, reduction='batchmean', log_target=True)
-
         # Disentangled Knowledge
-        soft_loss_skd = torch.nn.functional.softmax(src_pred_t/self.temperature, dim=1) * \
-                     (torch.log(torch.nn.functional.softmax(src_pred_t/self.temperature, dim=1))
-                      - torch.nn.functional.log_softmax(src_pred/self.temperature, dim=1))
-        soft_loss_skd = (soft_loss_skd.sum(dim=1) * weights_src).sum(dim=0) / src_pred.size(0)
-        soft_loss_tkd = torch.nn.functional.softmax(trg_pred_t/self.temperature, dim=1) * \
-                     (torch.log(torch.nn.functional.softmax(trg_pred_t/self.temperature, dim=1))
-                      - torch.nn.functional.log_softmax(trg_pred/self.temperature, dim=1))
-        soft_loss_tkd = (soft_loss_tkd.sum(dim=1) * weights_trg).sum(dim=0) / trg_pred.size(0)
-        soft_loss = soft_loss_skd + soft_loss_tkd
-
-        kd_loss = soft_loss * self.temperature ** 2
+        kd_loss = self.kd_loss(src_pred, weights=weights_src, teacher_log_probs=src_logp_t) + \
+                  self.kd_loss(trg_pred, weights=weights_trg, teacher_log_probs=src_logp_t)
 
         # Task classification  Loss
         src_cls_loss = self.cross_entropy(src_pred.squeeze(), src_y)
@@ -720,13 +867,49 @@ class UDA_KD(Algorithm):
 
         loss = self.hparams["src_cls_loss_wt"] * src_cls_loss + (1-beta)* self.hparams["domain_loss_wt"] * domain_loss \
                + beta * kd_loss + errG
+        if self.exit_blocks:
+            trg_logp_t = self.exit_kd_loss.teacher_log_probs(trg_logits_t)
+            exit_loss = self.exit_loss(taps.outputs, src_y, src_logp_t, trg_logp_t)
+            loss = loss + self.hparams.get("early_exit_wt", 1.0) * exit_loss
+            losses['Exit_loss'] = exit_loss.item()
 
         loss.backward()
         self.optimizer.step()
-        self.optimizer_disc.step()
 
-        return {'Total_loss': loss.item(), 'Domain_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item(),
-                'KD_loss':kd_loss.item(), 'errD': errD.item(), 'errG':errG.item()}
+        losses.update({'Total_loss': loss.item(), 'Domain_loss': domain_loss.item(), 'Src_cls_loss': src_cls_loss.item(),
+                       'KD_loss':kd_loss.item(), 'errG':errG.item()})
+        return losses
+
+    def update_weight_averaging(self):
+        super(UDA_KD, self).update_weight_averaging()
+        if self.weight_averaging is not None and self.exit_blocks:
+            if self.exit_heads_averaging is None:
+                self.exit_heads_averaging = self.make_weight_averaging(self.exit_heads)
+            self.exit_heads_averaging.update(self.exit_heads)
+
+    def eval_exit_heads(self):
+        """Exit heads matching eval_network(): their averaged copy when weight averaging is enabled."""
+        if self.exit_heads_averaging is None:
+            return self.exit_heads
+        return self.exit_heads_averaging.averaged_model
+
+    def exit_loss(self, block_outputs, src_y, src_logp_t, trg_logp_t):
+        """
+        Mean over the exit heads of their source classification loss and their distillation of the teacher on both
+        domains, given as teacher log-probabilities (DistillationLoss.teacher_log_probs). Blocks that did not run
+        (skipped with from_prefix_activations) have no exit loss.
+        """
+        exit_losses = []
+        for name, head in zip(self.exit_blocks, self.exit_heads):
+            if name not in block_outputs:
+                continue
+            src_logits, trg_logits = torch.split(head(block_outputs[name]), [len(src_y), len(trg_logp_t)])
+            exit_losses.append(self.cross_entropy(src_logits, src_y) +
+                               self.exit_kd_loss(src_logits, teacher_log_probs=src_logp_t) +
+                               self.exit_kd_loss(trg_logits, teacher_log_probs=trg_logp_t))
+        if not exit_losses:
+            return src_logp_t.new_zeros(())
+        return torch.stack(exit_losses).mean()
 
 
 class JointUKD(Algorithm):
@@ -734,14 +917,13 @@ class JointUKD(Algorithm):
     JointUKD
     """
 
-    def __init__(self, backbone_fe, configs, hparams, device):
+    teacher_kind = 'uda'
+
+    def __init__(self, backbone_fe, configs, hparams, device, network_t=None):
         super(JointUKD, self).__init__(configs)
-        from models import models
-        self.t_feature_extractor = models.CNN_T(configs)
-        self.t_classifier = models.classifier_T(configs)
-        self.network_t = nn.Sequential(self.t_feature_extractor, self.t_classifier)
+        self.init_teacher(configs, network_t)
 
-        self.feature_extractor = backbone_fe(configs)
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
         self.classifier = classifier(configs)
         self.network = nn.Sequential(self.feature_extractor, self.classifier)
 
@@ -756,6 +938,7 @@ class JointUKD(Algorithm):
         self.hparams = hparams
         self.device = device
         self.temperature = hparams["temperature"]
+        self.kd_loss = DistillationLoss(self.temperature, kind='batchmean')
 
 
     def update(self, src_x, src_y, trg_x, step, epoch, len_dataloader):
@@ -767,31 +950,21 @@ class JointUKD(Algorithm):
         self.network_t.train()
 
         # Teacher inference on Source and Target
-        src_feat_t = self.t_feature_extractor(src_x)
-        src_pred_t = self.t_classifier(src_feat_t)
-        src_pred_t_soften = torch.nn.functional.log_softmax(src_pred_t/self.temperature,dim=1)
-
-        trg_feat_t = self.t_feature_extractor(trg_x)
-        trg_pred_t = self.t_classifier(trg_feat_t)
-        trg_pred_t_soften = torch.nn.functional.log_softmax(trg_pred_t / self.temperature, dim=1)
+        src_feat_t, trg_feat_t = joint_forward(self.t_feature_extractor, src_x, trg_x)
+        src_pred_t, trg_pred_t = joint_forward(self.t_classifier, src_feat_t, trg_feat_t)
 
         # Student inference on Source and Target
-        src_feat = self.feature_extractor(src_x)
-        src_pred = self.classifier(src_feat)
-        src_pred_s_soften = torch.nn.functional.log_softmax(src_pred / self.temperature, dim=1)
-
-        trg_feat = self.feature_extractor(trg_x)
-        trg_pred = self.classifier(trg_feat)
-        trg_pred_s_soft = torch.nn.functional.log_softmax(trg_pred / self.temperature, dim=1)
+        src_feat, trg_feat = joint_forward(self.feature_extractor, src_x, trg_x)
+        src_pred, trg_pred = joint_forward(self.classifier, src_feat, trg_feat)
 
         from mmd import MMD_loss
         mmd_loss = MMD_loss()(src_feat_t,trg_feat_t)
         loss_ce_t = self.cross_entropy(src_pred_t, src_y)
         loss_tda = mmd_loss + 0.8 * loss_ce_t
 
-        loss_tkd = torch.nn.functional.kl_div(trg_pred_s_soft, trg_pred_t_soften, reduction='batchmean', log_target=True)
+        loss_tkd = self.kd_loss(trg_pred, trg_pred_t)
 
-        loss_kd_src = torch.nn.functional.kl_div(src_pred_s_soften, src_pred_t_soften, reduction='batchmean', log_target=True)
+        loss_kd_src = self.kd_loss(src_pred, src_pred_t)
         loss_ce_s = self.cross_entropy(src_pred, src_y)
 
         loss_skd = loss_kd_src + 0.8 * loss_ce_s
@@ -810,18 +983,17 @@ class AAD(Algorithm):
     AAD
     """
 
-    def __init__(self, backbone_fe, configs, hparams, device):
+    teacher_domains = ('src',)
+    teacher_kind = 'src_only'
+
+    def __init__(self, backbone_fe, configs, hparams, device, network_t=None):
         super(AAD, self).__init__(configs)
-        from models import models
-        self.t_feature_extractor = models.CNN_T(configs)
-        self.t_classifier = models.classifier_T(configs)
-        self.network_t = nn.Sequential(self.t_feature_extractor, self.t_classifier)
+        self.init_teacher(configs, network_t)
 
-        self.feature_extractor = backbone_fe(configs)
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
         self.classifier = classifier(configs)
         self.network = nn.Sequential(self.feature_extractor, self.classifier)
 
-        self.data_domain_classifier = Discriminator(configs)
         self.feature_domain_classifier = Discriminator_fea(configs)
         self.adapter = Adapter(configs)
 
@@ -831,12 +1003,6 @@ class AAD(Algorithm):
             weight_decay=hparams["weight_decay"], betas=(0.5, 0.99)
         )
 
-        self.optimizer_disc = torch.optim.Adam(
-            self.data_domain_classifier.parameters(),
-            lr=hparams["learning_rate"],
-            weight_decay=hparams["weight_decay"], betas=(0.5, 0.99)
-        )
-
         self.optimizer_feat = torch.optim.Adam(
             self.feature_domain_classifier.parameters(),
             lr=hparams["learning_rate"],
@@ -846,83 +1012,51 @@ class AAD(Algorithm):
         self.hparams = hparams
         self.device = device
         self.temperature = hparams["temperature"]
+        self.kd_loss = DistillationLoss(self.temperature, kind='vanilla')
+        self.bce = nn.BCEWithLogitsLoss()
+        # the feature discriminator is updated every disc_update_every steps
+        self.disc_update_every = hparams.get("disc_update_every", 1)
 
 
-    def update(self, src_x, src_y, trg_x, step, epoch, len_dataloader):
-        p = float(step + epoch * len_dataloader) / self.hparams["num_epochs"] + 1 / len_dataloader
-        alpha = 2. / (1. + np.exp(-10 * p)) - 1
-        self.network_t.eval()
+    def update(self, src_x, src_y, trg_x, step, epoch, len_dataloader, teacher_outputs=None):
+        # Teacher features (the real samples of the feature discriminator) and logits,
+        # computed here unless an AsyncTeacher already produced them
+        if teacher_outputs is None:
+            teacher_outputs = self.teacher_outputs(src_x, trg_x)
+        src_feat_t, src_pred_t = teacher_outputs['src']
 
-        real_label = 1
-        fake_label = 0
+        # Student Forward, with its features mapped to the teacher feature space (the fake samples)
+        src_feat = self.feature_extractor(src_x)
+        src_feat_hint = self.adapter(src_feat)
+        src_pred = self.classifier(src_feat)
 
         ########################################################
         # (1) update D network: maximize log(D(fea_t)) + log(1-D(G(x))
-        # fea_t: feature from teacher network
-        # x: input data
-        # G(x): feature from student network
+        # real and fake batches go through D in a single forward pass
         ########################################################
-        self.optimizer_feat.zero_grad()
-
-        # Format Batch
-        src_feat_t = self.t_feature_extractor(src_x)
-        src_feat_t = Variable(src_feat_t, requires_grad=False)
-
-        f_domain_label = torch.full((src_x.shape[0],), real_label, dtype=torch.float, device=self.device)
-
-        # Forward pass real batch through D
-        output = self.feature_domain_classifier(src_feat_t).view(-1)
-        # Calculate loss on all-real batch
-        errD_real = nn.BCELoss()(output, f_domain_label)
-        # Calculate gradients for D in backward pass
-        errD_real.backward()
-
-        # Train with all-fake batch, Generate fake features with G
-        # Student Forward
-        src_feat = self.feature_extractor(src_x)
-        src_feat_hint = self.adapter(src_feat)
-
-        f_domain_label.fill_(fake_label)
-        # Classify all fake batch with D
+        n = len(src_x)
+        real_label = self.constant_labels(n, 1., src_x.device)
+        fake_label = self.constant_labels(n, 0., src_x.device)
 
-        output = self.feature_domain_classifier(src_feat_hint.detach()).view(-1)
-        # output = self.feature_domain_classifier(src_feat.detach()).view(-1)
-        # Calculate D's loss on the all-fake batch
-        errD_fake = nn.BCELoss()(output, f_domain_label)
-        # Calculate the gradients for this batch
-        errD_fake.backward()
+        losses = {}
+        if step % self.disc_update_every == 0:
+            output = self.feature_domain_classifier(torch.concat((src_feat_t, src_feat_hint.detach()), dim=0)).view(-1)
+            errD = self.bce(output[:n], real_label) + self.bce(output[n:], fake_label)
 
-        # Add the gradients from all-real and all-fake batches
-        errD = errD_real + errD_fake
-        # Update D
-        self.optimizer_feat.step()
+            self.optimizer_feat.zero_grad()
+            errD.backward()
+            self.optimizer_feat.step()
+            losses['errD'] = errD.item()
 
         ########################################################
-        # (2) update G network: maximize log(D(G(x))
+        # (2) update G network: maximize log(D(G(x)), through the updated D
         ########################################################
-
-        # zero grad
-        self.optimizer.zero_grad()
-        self.optimizer_disc.zero_grad()
-
-        src_pred_t = self.t_classifier(src_feat_t)
-        src_pred_t_soften = torch.nn.functional.log_softmax(src_pred_t / self.temperature, dim=1)
-
-
-        src_pred = self.classifier(src_feat)
-        src_pred_s_soften = torch.nn.functional.log_softmax(src_pred / self.temperature, dim=1)
-
         # fake labels are real for generator cost
-        f_domain_label.fill_(real_label)
-        # Since we just updated D, perform another forward pass of all-fake batch through D
         output = self.feature_domain_classifier(src_feat_hint).view(-1)
-
-        # Calculate G's loss based on this output
-        errG = nn.BCELoss()(output, f_domain_label)
+        errG = self.bce(output, real_label)
 
         # Add KD loss
-        soft_loss = torch.nn.functional.kl_div(src_pred_s_soften, src_pred_t_soften, reduction='batchmean', log_target=True)
-        kd_loss = soft_loss * self.temperature ** 2
+        kd_loss = self.kd_loss(src_pred, src_pred_t)
 
         # Task classification  Loss
         src_cls_loss = self.cross_entropy(src_pred.squeeze(), src_y)
@@ -930,11 +1064,13 @@ class AAD(Algorithm):
 
         loss = self.hparams["src_cls_loss_wt"] * src_cls_loss + self.hparams["soft_loss_wt"] * kd_loss + self.hparams ['errG'] * errG
 
+        self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
-        self.optimizer_disc.step()
 
-        return {'Total_loss': loss.item(), 'Src_cls_loss': src_cls_loss.item(), 'KD_loss':kd_loss.item(), 'errD': errD.item(), 'errG':errG.item() }
+        losses.update({'Total_loss': loss.item(), 'Src_cls_loss': src_cls_loss.item(), 'KD_loss':kd_loss.item(),
+                       'errG':errG.item()})
+        return losses
 
 
 class MobileDA(Algorithm):
@@ -942,20 +1078,20 @@ class MobileDA(Algorithm):
     MobileDA
     """
 
-    def __init__(self, backbone_fe, configs, hparams, device):
+    teacher_domains = ('trg',)
+    teacher_kind = 'src_only'
+
+    def __init__(self, backbone_fe, configs, hparams, device, network_t=None):
         super(MobileDA, self).__init__(configs)
-        from models import models
-        self.t_feature_extractor = models.CNN_T(configs)
-        self.t_classifier = models.classifier_T(configs)
-        self.network_t = nn.Sequential(self.t_feature_extractor, self.t_classifier)
+        self.init_teacher(configs, network_t)
 
-        self.feature_extractor = backbone_fe(configs)
+        self.feature_extractor = convert_domain_batchnorm(backbone_fe(configs), hparams.get("domain_specific_bn", False))
         self.classifier = classifier(configs)
         self.network = nn.Sequential(self.feature_extractor, self.classifier)
 
         self.domain_classifier = Discriminator(configs)
 
-        self.coral = CORAL()
+        self.coral = CORAL(momentum=hparams.get("coral_momentum", None))
 
         self.optimizer = torch.optim.Adam(
             self.network.parameters(),
@@ -966,31 +1102,27 @@ class MobileDA(Algorithm):
         self.hparams = hparams
         self.device = device
         self.temperature = hparams["temperature"]
+        self.kd_loss = DistillationLoss(self.temperature, kind='batchmean')
 
 
-    def update(self, src_x, src_y, trg_x, step, epoch, len_dataloader):
+    def update(self, src_x, src_y, trg_x, step, epoch, len_dataloader, teacher_outputs=None):
         p = float(step + epoch * len_dataloader) / self.hparams["num_epochs"] + 1 / len_dataloader
         alpha = 2. / (1. + np.exp(-10 * p)) - 1
 
         # zero grad
         self.optimizer.zero_grad()
-        self.network_t.eval()
 
-        trg_feat_t = self.t_feature_extractor(trg_x)
-        trg_pred_t = self.t_classifier(trg_feat_t)
-        trg_pred_t_soften = torch.nn.functional.log_softmax(trg_pred_t / self.temperature, dim=1)
+        # Frozen teacher on the target, computed here unless an AsyncTeacher already produced it
+        if teacher_outputs is None:
+            teacher_outputs = self.teacher_outputs(src_x, trg_x)
+        trg_feat_t, trg_pred_t = teacher_outputs['trg']
 
         # Student inference on Source and Target
-        src_feat = self.feature_extractor(src_x)
-        src_pred = self.classifier(src_feat)
-
-        trg_feat = self.feature_extractor(trg_x)
-        trg_pred = self.classifier(trg_feat)
-        trg_pred_s_soft = torch.nn.functional.log_softmax(trg_pred / self.temperature, dim=1)
+        src_feat, trg_feat = joint_forward(self.feature_extractor, src_x, trg_x)
+        src_pred, trg_pred = joint_forward(self.classifier, src_feat, trg_feat)
 
         loss_ce_s = self.cross_entropy(src_pred, src_y)
-        loss_soft = torch.nn.functional.kl_div(trg_pred_s_soft, trg_pred_t_soften, reduction='batchmean',
-                                              log_target=True)
+        loss_soft = self.kd_loss(trg_pred, trg_pred_t)
 
         loss_dc = self.coral(src_feat, trg_feat)
 
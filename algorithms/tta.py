@@ -0,0 +1,80 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from models.loss import ConditionalEntropyLoss
+
+
+class TestTimeAdaptation(nn.Module):
+    """
+    Source-free test-time adaptation of a trained nn.Sequential(feature_extractor, classifier) on a stream of
+    unlabeled target batches. Only the BatchNorm layers adapt:
+    'bn': their running statistics are re-estimated on the stream (a cumulative average over all adapted batches
+          when reset_stats, else an exponential one with `momentum` starting from the source statistics).
+    'entropy': additionally, their affine parameters take an Adam step per batch minimizing the conditional
+          entropy of the predictions.
+    All other layers stay frozen and in eval mode (no dropout). The network is adapted in place unless copy_network.
+    """
+
+    def __init__(self, network, mode="bn", lr=1e-3, reset_stats=True, momentum=0.1, copy_network=False):
+        super(TestTimeAdaptation, self).__init__()
+        if mode not in ("bn", "entropy"):
+            raise ValueError("Unknown test-time adaptation mode: {}".format(mode))
+        self.network = copy.deepcopy(network) if copy_network else network
+        self.mode = mode
+        self.bn_layers = [m for m in self.network.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        if not self.bn_layers:
+            raise ValueError("Test-time adaptation needs a network with BatchNorm layers")
+
+        for param in self.network.parameters():
+            param.requires_grad_(False)
+        for bn in self.bn_layers:
+            if reset_stats:
+                bn.reset_running_stats()
+                bn.momentum = None
+            else:
+                bn.momentum = momentum
+
+        self.optimizer = None
+        if mode == "entropy":
+            params = [p for bn in self.bn_layers if bn.affine for p in (bn.weight, bn.bias)]
+            for param in params:
+                param.requires_grad_(True)
+            self.optimizer = torch.optim.Adam(params, lr=lr)
+            self.entropy = ConditionalEntropyLoss()
+        self.network.eval()
+
+    def _bn_train(self, mode):
+        for bn in self.bn_layers:
+            bn.train(mode)
+
+    def adapt(self, x):
+        """Adapt on one unlabeled target batch, returns its logits under the batch statistics."""
+        self._bn_train(True)
+        if self.optimizer is None:
+            with torch.no_grad():
+                logits = self.network(x)
+        else:
+            logits = self.network(x)
+            loss = self.entropy(logits)
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+            logits = logits.detach()
+        self._bn_train(False)
+        return logits
+
+    def adapt_stream(self, batches):
+        """Adapt on each batch of an iterable of target batches (x or (x, y)), returns the number of samples."""
+        num_samples = 0
+        for batch in batches:
+            x = batch[0] if isinstance(batch, (tuple, list)) else batch
+            x = x.float().to(next(self.network.parameters()).device)
+            self.adapt(x)
+            num_samples += len(x)
+        return num_samples
+
+    def forward(self, x):
+        self.network.eval()
+        return self.network(x)
@@ -0,0 +1,99 @@
+"""
+Per-step time of the adversarial KD algorithms (UDA_KD, AAD): the update() of a previous revision of the repository
+(--baseline_rev, e.g. the last commit before the fused step) vs the current one. Each tree is timed in its own
+subprocess, importing its own algorithms, models and losses; the previous one is extracted with git archive. Runs on
+random data shaped like the chosen dataset.
+
+    python -m benchmarks.adv_kd_step --baseline_rev <revision> --dataset HAR --device cpu
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tarfile
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_tree(args):
+    """ms per update() of each algorithm, with the algorithms, models and configs of the tree on sys.path."""
+    sys.path.insert(0, args.tree)
+    import torch
+    from algorithms.algorithms import get_algorithm_class
+    from configs.data_model_configs import get_dataset_class
+    from configs.hparams import get_hparams_class
+    from models.models import get_backbone_class
+
+    device = torch.device(args.device)
+    configs = get_dataset_class(args.dataset)()
+    hparams_class = get_hparams_class(args.dataset)()
+    if args.backbone == "TCN":
+        configs.final_out_channels = configs.tcn_final_out_channles
+
+    timings = {}
+    for da_method in args.da_methods.split(","):
+        hparams = {**hparams_class.alg_hparams[da_method], **hparams_class.train_params}
+        torch.manual_seed(0)
+        algorithm = get_algorithm_class(da_method)(get_backbone_class(args.backbone), configs, hparams, device)
+        algorithm.to(device)
+        algorithm.train()
+        batch_size = hparams["batch_size"]
+        batch = (torch.randn(batch_size, configs.input_channels, configs.sequence_len, device=device),
+                 torch.randint(0, configs.num_classes, (batch_size,), device=device),
+                 torch.randn(batch_size, configs.input_channels, configs.sequence_len, device=device))
+
+        for i in range(args.warmup):
+            algorithm.update(*batch, i, 1, 10)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for i in range(args.iters):
+            algorithm.update(*batch, i, 1, 10)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        timings[da_method] = (time.perf_counter() - start) / args.iters * 1e3
+    print(json.dumps(timings))
+
+
+def run_tree(tree, args):
+    command = [sys.executable, os.path.abspath(__file__), '--tree', tree, '--baseline_rev', args.baseline_rev,
+               '--dataset', args.dataset, '--backbone', args.backbone, '--da_methods', args.da_methods,
+               '--warmup', str(args.warmup), '--iters', str(args.iters), '--device', args.device]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='HAR', type=str)
+    parser.add_argument('--backbone', default='CNN', type=str)
+    parser.add_argument('--da_methods', default='UDA_KD,AAD', type=str)
+    parser.add_argument('--baseline_rev', required=True, type=str, help='git revision of the previous step')
+    parser.add_argument('--warmup', default=5, type=int)
+    parser.add_argument('--iters', default=30, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--tree', default='', type=str, help='(internal) time the update() of this source tree')
+    args = parser.parse_args()
+
+    if args.tree:
+        time_tree(args)
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as baseline_dir:
+        archive = subprocess.run(['git', '-C', ROOT, 'archive', '--format=tar', args.baseline_rev], check=True,
+                                 stdout=subprocess.PIPE).stdout
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            if hasattr(tarfile, 'data_filter'):
+                tar.extractall(baseline_dir, filter='data')
+            else:
+                tar.extractall(baseline_dir)
+        previous = run_tree(baseline_dir, args)
+    current = run_tree(ROOT, args)
+
+    for da_method in args.da_methods.split(","):
+        print(f'{args.dataset} {da_method:<7} {args.baseline_rev}: {previous[da_method]:8.2f} ms   '
+              f'current: {current[da_method]:8.2f} ms   speedup: {previous[da_method] / current[da_method]:5.2f}x')
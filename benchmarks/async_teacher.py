@@ -0,0 +1,80 @@
+"""
+Epoch time of the KD algorithms with the frozen teacher run synchronously inside update() vs in a
+background worker (models.teacher.AsyncTeacher, thread and process backends) that overlaps with the
+student. Runs on random data shaped like the chosen dataset; overlap needs at least two free cores.
+
+    python -m benchmarks.async_teacher --dataset HAR --da_method UDA_KD --teacher_threads 1
+"""
+import argparse
+import time
+
+import torch
+from torch.utils.data import TensorDataset, DataLoader
+
+from algorithms.algorithms import get_algorithm_class
+from configs.data_model_configs import get_dataset_class
+from configs.hparams import get_hparams_class
+from models.models import get_backbone_class
+from models.teacher import AsyncTeacher
+
+
+def make_loader(configs, num_samples, batch_size):
+    dataset = TensorDataset(torch.randn(num_samples, configs.input_channels, configs.sequence_len),
+                            torch.randint(0, configs.num_classes, (num_samples,)))
+    return DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+
+
+def time_epochs(backend, args, device):
+    configs = get_dataset_class(args.dataset)()
+    hparams_class = get_hparams_class(args.dataset)()
+    hparams = {**hparams_class.alg_hparams[args.da_method], **hparams_class.train_params}
+    batch_size = hparams["batch_size"]
+
+    torch.manual_seed(0)
+    algorithm = get_algorithm_class(args.da_method)(get_backbone_class(args.backbone), configs, hparams, device)
+    algorithm.to(device)
+    algorithm.train()
+    src_dl = make_loader(configs, args.num_batches * batch_size, batch_size)
+    trg_dl = make_loader(configs, args.num_batches * batch_size, batch_size)
+
+    async_teacher = None
+    if backend != 'sync':
+        async_teacher = AsyncTeacher(algorithm.network_t, algorithm.teacher_domains, device, backend=backend,
+                                     num_threads=args.teacher_threads, queue_size=args.queue_size)
+    timings = []
+    for epoch in range(args.epochs):
+        joint_loaders = zip(src_dl, trg_dl)
+        joint_loaders = async_teacher(joint_loaders) if async_teacher else ((batch, None) for batch in joint_loaders)
+        start = time.perf_counter()
+        for step, (((src_x, src_y), (trg_x, _)), teacher_outputs) in enumerate(joint_loaders):
+            src_x, src_y, trg_x = src_x.float().to(device), src_y.long().to(device), trg_x.float().to(device)
+            algorithm.update(src_x, src_y, trg_x, step, epoch + 1, args.num_batches, teacher_outputs=teacher_outputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    if async_teacher is not None:
+        async_teacher.close()
+    # the first epoch includes the worker start-up
+    return min(timings[1:] or timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='HAR', type=str)
+    parser.add_argument('--backbone', default='CNN', type=str)
+    parser.add_argument('--da_method', default='UDA_KD', type=str, help='UDA_KD, AAD or MobileDA')
+    parser.add_argument('--num_batches', default=20, type=int)
+    parser.add_argument('--epochs', default=3, type=int)
+    parser.add_argument('--teacher_threads', default=1, type=int)
+    parser.add_argument('--queue_size', default=2, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    print(f'main threads: {torch.get_num_threads()}, teacher threads: {args.teacher_threads}')
+    backends = ['sync', 'thread', 'process'] if device.type == 'cpu' else ['sync', 'thread']
+    baseline = None
+    for backend in backends:
+        epoch_time = time_epochs(backend, args, device)
+        baseline = baseline or epoch_time
+        print(f'{args.da_method:<8} {backend:<8} epoch: {epoch_time * 1e3:9.1f} ms   speedup: {baseline / epoch_time:5.2f}x')
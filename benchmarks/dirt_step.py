@@ -0,0 +1,65 @@
+"""
+Step time of DIRT.update for each VAT mode ('input' is the original per-domain VAT, 'joint'
+batches source and target into one power iteration, 'feature' perturbs the extracted features
+and only re-runs the classifier). Runs on random data shaped like the chosen dataset.
+
+    python -m benchmarks.dirt_step --dataset HAR --backbone CNN --device cpu
+"""
+import argparse
+import time
+
+import torch
+
+from algorithms.algorithms import get_algorithm_class
+from configs.data_model_configs import get_dataset_class
+from configs.hparams import get_hparams_class
+from models.models import get_backbone_class
+
+
+def make_batch(configs, batch_size, device):
+    src_x = torch.randn(batch_size, configs.input_channels, configs.sequence_len, device=device)
+    src_y = torch.randint(0, configs.num_classes, (batch_size,), device=device)
+    trg_x = torch.randn(batch_size, configs.input_channels, configs.sequence_len, device=device)
+    return src_x, src_y, trg_x
+
+
+def time_mode(vat_mode, args, device):
+    configs = get_dataset_class(args.dataset)()
+    hparams_class = get_hparams_class(args.dataset)()
+    if args.backbone == "TCN":
+        configs.final_out_channels = configs.tcn_final_out_channles
+    hparams = {**hparams_class.alg_hparams["DIRT"], **hparams_class.train_params, "vat_mode": vat_mode}
+
+    torch.manual_seed(0)
+    algorithm = get_algorithm_class("DIRT")(get_backbone_class(args.backbone), configs, hparams, device)
+    algorithm.to(device)
+    algorithm.train()
+    batch = make_batch(configs, hparams["batch_size"], device)
+
+    for _ in range(args.warmup):
+        algorithm.update(*batch)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        algorithm.update(*batch)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.iters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='HAR', type=str)
+    parser.add_argument('--backbone', default='CNN', type=str)
+    parser.add_argument('--warmup', default=5, type=int)
+    parser.add_argument('--iters', default=30, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    baseline = None
+    for vat_mode in ['input', 'joint', 'feature']:
+        step_time = time_mode(vat_mode, args, device)
+        baseline = baseline or step_time
+        print(f'{vat_mode:<8} step: {step_time * 1e3:8.2f} ms   speedup: {baseline / step_time:5.2f}x')
@@ -0,0 +1,105 @@
+"""
+Microbenchmark of the KD loss used by UDA_KD: the previous inline disentangled KD term
+vs models.loss.DistillationLoss. Reports kernels launched (leaf operators on CPU) and peak
+memory (bytes allocated on CPU) per forward+backward step.
+
+    python -m benchmarks.kd_loss --batch_size 32 --num_classes 6 --device cpu
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+from torch.profiler import profile, ProfilerActivity
+
+from models.loss import DistillationLoss
+
+
+def legacy_kd_loss(src_pred, src_pred_t, trg_pred, trg_pred_t, weights_src, weights_trg, temperature):
+    soft_loss_skd = F.softmax(src_pred_t / temperature, dim=1) * \
+                    (torch.log(F.softmax(src_pred_t / temperature, dim=1))
+                     - F.log_softmax(src_pred / temperature, dim=1))
+    soft_loss_skd = (soft_loss_skd.sum(dim=1) * weights_src).sum(dim=0) / src_pred.size(0)
+    soft_loss_tkd = F.softmax(trg_pred_t / temperature, dim=1) * \
+                    (torch.log(F.softmax(trg_pred_t / temperature, dim=1))
+                     - F.log_softmax(trg_pred / temperature, dim=1))
+    soft_loss_tkd = (soft_loss_tkd.sum(dim=1) * weights_trg).sum(dim=0) / trg_pred.size(0)
+    return (soft_loss_skd + soft_loss_tkd) * temperature ** 2
+
+
+def fused_kd_loss(kd_loss):
+    def step(src_pred, src_pred_t, trg_pred, trg_pred_t, weights_src, weights_trg, temperature):
+        return kd_loss(src_pred, src_pred_t, weights=weights_src) + kd_loss(trg_pred, trg_pred_t, weights=weights_trg)
+    return step
+
+
+def make_inputs(batch_size, num_classes, device):
+    src_pred = torch.randn(batch_size, num_classes, device=device, requires_grad=True)
+    trg_pred = torch.randn(batch_size, num_classes, device=device, requires_grad=True)
+    src_pred_t = torch.randn(batch_size, num_classes, device=device)
+    trg_pred_t = torch.randn(batch_size, num_classes, device=device)
+    weights_src = torch.rand(batch_size, device=device)
+    weights_trg = torch.rand(batch_size, device=device)
+    return src_pred, src_pred_t, trg_pred, trg_pred_t, weights_src, weights_trg
+
+
+def run_step(fn, inputs, temperature):
+    loss = fn(*inputs, temperature)
+    loss.backward()
+    return loss
+
+
+def measure(name, fn, inputs, temperature, device, iters):
+    activities = [ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(ProfilerActivity.CUDA)
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated()
+
+    with profile(activities=activities, profile_memory=True) as prof:
+        run_step(fn, inputs, temperature)
+    events = prof.events()
+    if device.type == 'cuda':
+        launches = sum(1 for e in events if e.device_type.name == 'CUDA')
+        peak_memory = torch.cuda.max_memory_allocated() - base_memory
+    else:
+        # leaf aten operators, i.e. the ones that actually run a kernel
+        launches = sum(1 for e in events if e.name.startswith('aten::') and not e.cpu_children)
+        # bytes allocated during the step (the CPU allocator does not track a peak)
+        peak_memory = sum(e.cpu_memory_usage for e in events if not e.cpu_children and e.cpu_memory_usage > 0)
+
+    for _ in range(10):
+        run_step(fn, inputs, temperature)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        run_step(fn, inputs, temperature)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    step_time = (time.perf_counter() - start) / iters
+
+    print(f'{name:<20} kernels: {launches:>5}   memory: {peak_memory / 1024:8.1f} KiB   '
+          f'step: {step_time * 1e6:8.1f} us')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--num_classes', default=6, type=int)
+    parser.add_argument('--temperature', default=4, type=float)
+    parser.add_argument('--iters', default=200, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    inputs = make_inputs(args.batch_size, args.num_classes, device)
+    kd_loss = DistillationLoss(args.temperature, kind='disentangled')
+
+    legacy = legacy_kd_loss(*inputs, args.temperature)
+    fused = fused_kd_loss(kd_loss)(*inputs, args.temperature)
+    print(f'max abs difference between implementations: {(legacy - fused).abs().item():.2e}')
+
+    measure('legacy (UDA_KD)', legacy_kd_loss, inputs, args.temperature, device, args.iters)
+    measure('DistillationLoss', fused_kd_loss(kd_loss), inputs, args.temperature, device, args.iters)
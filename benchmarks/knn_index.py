@@ -0,0 +1,79 @@
+"""
+Query time of the IVF search of models.knn_index.FeatureIndex (default: sqrt(num_lists) probes) vs an exact search
+over all stored target features, for growing target sizes, with the recall of the exact k nearest neighbours and the
+number of candidates scanned per query. The index is filled through update() in training-sized batches, as KNN_ST
+does, from clustered random features shaped like the chosen dataset's.
+
+    python -m benchmarks.knn_index --dataset HAR --sizes 2000,20000,200000
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from configs.data_model_configs import get_dataset_class
+from models.knn_index import FeatureIndex
+
+
+def time_search(search, queries, iters, device):
+    search(queries)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        out = search(queries)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters, out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='HAR', type=str)
+    parser.add_argument('--sizes', default='2000,20000,200000', type=str)
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--num_neighbors', default=5, type=int)
+    parser.add_argument('--num_probes', default=None, type=int, help='lists scanned per query (default: sqrt(num_lists))')
+    parser.add_argument('--iters', default=20, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    configs = get_dataset_class(args.dataset)()
+    feature_dim = configs.final_out_channels * configs.features_len
+    torch.manual_seed(0)
+    print(f'{args.dataset} features: {feature_dim}, batch={args.batch_size}, k={args.num_neighbors}')
+
+    for size in map(int, args.sizes.split(',')):
+        centers = torch.randn(4 * configs.num_classes, feature_dim, device=device)
+        features = centers[torch.randint(0, len(centers), (size,), device=device)] + \
+                   torch.randn(size, feature_dim, device=device)
+        probs = F.softmax(torch.randn(size, configs.num_classes, device=device), dim=1)
+
+        index = FeatureIndex(device, num_probes=args.num_probes)
+        start = time.perf_counter()
+        for _ in range(2):  # rebuilt at the start of the second pass
+            for idx in torch.randperm(size, device=device).split(args.batch_size):
+                index.update(idx, features[idx], probs[idx])
+        fill = time.perf_counter() - start
+
+        query_idx = torch.randperm(size, device=device)[:args.batch_size]
+        queries = features[query_idx]
+        stored = F.normalize(features, dim=1)
+
+        def exact(queries):
+            sims = F.normalize(queries, dim=1) @ stored.t()
+            sims[torch.arange(len(queries)), query_idx] = float("-inf")
+            return sims.topk(args.num_neighbors, dim=1)
+
+        exact_time, (_, exact_neighbors) = time_search(exact, queries, args.iters, device)
+        ivf_time, (_, ivf_neighbors) = time_search(
+            lambda queries: index.search(queries, args.num_neighbors, exclude=query_idx), queries, args.iters, device)
+        recall = (ivf_neighbors[:, :, None] == exact_neighbors[:, None, :]).any(2).float().mean().item()
+        probed = (F.normalize(queries, dim=1) @ index.centroids.t()).topk(index.probes, dim=1).indices
+        scanned = (index.offsets[probed + 1] - index.offsets[probed]).sum(1).float().mean().item()
+
+        print(f'N={size:7d} lists={len(index.centroids):4d} probes={index.probes:3d}  exact {exact_time * 1e3:7.2f} ms  '
+              f'IVF {ivf_time * 1e3:7.2f} ms ({exact_time / ivf_time:5.1f}x, {scanned:7.0f} candidates per query)  '
+              f'recall@{args.num_neighbors} {recall:.3f}  two update passes {fill:.2f} s')
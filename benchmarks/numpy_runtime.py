@@ -0,0 +1,84 @@
+"""
+Parity and throughput of the PyTorch-free models.numpy_runtime.NumpyCNN vs the torch student (CNN + classifier,
+BatchNorm folded) for the HAR and EEG window shapes, and the import time of the runtime in a fresh interpreter.
+The BatchNorm statistics are randomized so that the folding is exercised.
+
+    python -m benchmarks.numpy_runtime --datasets HAR,EEG --batch_sizes 1,32,256
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+from configs.data_model_configs import get_dataset_class
+from models.export import export_numpy, fuse_for_inference
+from models.models import CNN, classifier
+from models.numpy_runtime import NumpyCNN
+
+
+def windows_per_second(predict, x, iters):
+    predict(x)
+    start = time.perf_counter()
+    for _ in range(iters):
+        predict(x)
+    return len(x) * iters / (time.perf_counter() - start)
+
+
+def import_time():
+    code = "import time; start = time.perf_counter(); import models.numpy_runtime; " \
+           "print((time.perf_counter() - start) * 1e3, 'torch' in __import__('sys').modules)"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.split()
+    return float(out[0]), out[1] == "True"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets', default='HAR,EEG', type=str)
+    parser.add_argument('--batch_sizes', default='1,32,256', type=str)
+    parser.add_argument('--num_samples', default=64, type=int)
+    parser.add_argument('--atol', default=1e-4, type=float)
+    parser.add_argument('--iters', default=20, type=int)
+    args = parser.parse_args()
+
+    import_ms, imports_torch = import_time()
+    print(f'import models.numpy_runtime: {import_ms:.1f} ms (numpy included), torch imported: {imports_torch}')
+
+    torch.manual_seed(0)
+    for dataset in args.datasets.split(','):
+        configs = get_dataset_class(dataset)()
+        network = nn.Sequential(CNN(configs), classifier(configs))
+        for m in network.modules():
+            if isinstance(m, nn.BatchNorm1d):
+                m.running_mean.normal_()
+                m.running_var.uniform_(0.5, 2)
+                nn.init.normal_(m.weight)
+                nn.init.normal_(m.bias)
+        network.eval()
+        fused = fuse_for_inference(network)
+
+        path = os.path.join(tempfile.mkdtemp(), f'{dataset}_cnn.npz')
+        export_numpy(network, path)
+        runtime = NumpyCNN.load(path)
+
+        x = torch.randn(args.num_samples, configs.input_channels, configs.sequence_len)
+        with torch.no_grad():
+            diff = np.abs(network(x).numpy() - runtime(x.numpy())).max()
+        print(f'{dataset} ({configs.input_channels}x{configs.sequence_len}): file {os.path.getsize(path) / 1024:.1f} KB, '
+              f'max |torch - numpy| {diff:.2e}')
+        if diff > args.atol:
+            raise RuntimeError(f'NumPy runtime differs from torch by {diff} > {args.atol} on {dataset}')
+
+        for batch_size in map(int, args.batch_sizes.split(',')):
+            xb = torch.randn(batch_size, configs.input_channels, configs.sequence_len)
+            with torch.no_grad():
+                torch_wps = windows_per_second(fused, xb, args.iters)
+            numpy_wps = windows_per_second(runtime, xb.numpy(), args.iters)
+            print(f'  batch {batch_size:4d}: torch {torch_wps:9.0f} windows/s  numpy {numpy_wps:9.0f} windows/s '
+                  f'({numpy_wps / torch_wps:.2f}x)')
@@ -0,0 +1,72 @@
+"""
+Step time of a KD algorithm fine-tuning a student on raw inputs vs from a PrefixActivationCache of its
+frozen CNN blocks up to --freeze_prefix (teacher outputs cached as well). Also reports the one-off cost
+and size of building the cache. Runs on random data shaped like the chosen dataset.
+
+    python -m benchmarks.prefix_cache --dataset EEG --da_method UDA_KD --freeze_prefix conv_block2
+"""
+import argparse
+import time
+
+import torch
+from torch.utils.data import TensorDataset, DataLoader
+
+from algorithms.algorithms import get_algorithm_class
+from configs.data_model_configs import get_dataset_class
+from configs.hparams import get_hparams_class
+from models.models import get_backbone_class, freeze_prefix, from_prefix_activations
+from models.prefix_cache import PrefixActivationCache
+
+
+def make_loader(configs, num_samples, batch_size):
+    dataset = TensorDataset(torch.randn(num_samples, configs.input_channels, configs.sequence_len),
+                            torch.randint(0, configs.num_classes, (num_samples,)))
+    return DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+
+
+def time_epoch(algorithm, batches, num_frozen, device):
+    start = time.perf_counter()
+    for step, (((src_x, src_y), (trg_x, _)), teacher_outputs) in enumerate(batches):
+        src_x, src_y, trg_x = src_x.float().to(device), src_y.long().to(device), trg_x.float().to(device)
+        with from_prefix_activations(algorithm.feature_extractor, num_frozen):
+            algorithm.update(src_x, src_y, trg_x, step, 1, 10, teacher_outputs=teacher_outputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='EEG', type=str)
+    parser.add_argument('--da_method', default='UDA_KD', type=str, help='UDA_KD, AAD or MobileDA')
+    parser.add_argument('--freeze_prefix', default='conv_block2', type=str)
+    parser.add_argument('--num_batches', default=10, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    configs = get_dataset_class(args.dataset)()
+    hparams_class = get_hparams_class(args.dataset)()
+    hparams = {**hparams_class.alg_hparams[args.da_method], **hparams_class.train_params}
+    batch_size = hparams["batch_size"]
+    src_dl = make_loader(configs, args.num_batches * batch_size, batch_size)
+    trg_dl = make_loader(configs, args.num_batches * batch_size, batch_size)
+
+    torch.manual_seed(0)
+    algorithm = get_algorithm_class(args.da_method)(get_backbone_class('CNN'), configs, hparams, device).to(device)
+    algorithm.train()
+    time_epoch(algorithm, ((batch, None) for batch in zip(src_dl, trg_dl)), 0, device)  # warm-up
+    raw = time_epoch(algorithm, ((batch, None) for batch in zip(src_dl, trg_dl)), 0, device)
+
+    num_frozen = freeze_prefix(algorithm.feature_extractor, args.freeze_prefix)
+    start = time.perf_counter()
+    cache = PrefixActivationCache(algorithm.feature_extractor, num_frozen, src_dl, trg_dl, device,
+                                  algorithm.network_t, algorithm.teacher_domains)
+    build = time.perf_counter() - start
+    time_epoch(algorithm, cache.batches(), num_frozen, device)  # warm-up
+    cached = time_epoch(algorithm, cache.batches(), num_frozen, device)
+
+    print(f'{args.dataset} {args.da_method}, frozen up to {args.freeze_prefix}, {args.num_batches} steps per epoch')
+    print(f'raw inputs      step: {raw / args.num_batches * 1e3:8.2f} ms')
+    print(f'cached prefix   step: {cached / args.num_batches * 1e3:8.2f} ms   speedup: {raw / cached:5.2f}x')
+    print(f'cache build: {build * 1e3:.0f} ms, size: {cache.nbytes() / 2 ** 20:.2f} MiB')
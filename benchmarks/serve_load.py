@@ -0,0 +1,89 @@
+"""
+Load generator for serve_model.py: concurrent keep-alive clients post random windows to /predict, then the client
+side p50/p99 latency and throughput are printed with the /metrics of the server (micro-batch sizes included).
+
+    python serve_model.py --checkpoint experiments_logs/exp1/run_1/2_to_11_run_0/checkpoint.pt &
+    python -m benchmarks.serve_load --concurrency 1,8,64 --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+
+async def http_request(reader, writer, method, path, body=b"", content_type="application/json"):
+    writer.write("{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n".format(
+        method, path, content_type, len(body)).encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, value = line.decode("latin-1").split(":", 1)
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    payload = json.loads(await reader.readexactly(length))
+    if status != 200:
+        raise RuntimeError("{} {}: {} {}".format(method, path, status, payload))
+    return payload
+
+
+async def connect(args):
+    if args.unix_socket:
+        return await asyncio.open_unix_connection(args.unix_socket)
+    return await asyncio.open_connection(args.host, args.port)
+
+
+async def client(args, window, num_requests, latencies):
+    reader, writer = await connect(args)
+    rng = np.random.default_rng()
+    for _ in range(num_requests):
+        x = rng.standard_normal((args.windows_per_request, *window), dtype=np.float32)
+        if args.format == "binary":
+            body, content_type = x.astype("<f4").tobytes(), "application/octet-stream"
+        else:
+            body, content_type = json.dumps({"x": x.tolist()}).encode(), "application/json"
+        start = time.perf_counter()
+        await http_request(reader, writer, "POST", "/predict", body, content_type)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def run(args):
+    reader, writer = await connect(args)
+    window = tuple((await http_request(reader, writer, "GET", "/health"))["window"])
+    print(f'window {window}, {args.windows_per_request} window(s) per request, {args.format} bodies')
+
+    for concurrency in map(int, args.concurrency.split(',')):
+        # warm-up, then measure from fresh server metrics
+        await asyncio.gather(*[client(args, window, 5, []) for _ in range(concurrency)])
+        await http_request(reader, writer, "DELETE", "/metrics")
+        latencies = []
+        start = time.perf_counter()
+        await asyncio.gather(*[client(args, window, args.requests // concurrency, latencies)
+                               for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        server = await http_request(reader, writer, "GET", "/metrics")
+
+        p50, p99 = np.percentile(np.array(latencies) * 1e3, [50, 99])
+        print(f'concurrency {concurrency:4d}: client p50 {p50:7.2f} ms  p99 {p99:7.2f} ms  '
+              f'{len(latencies) / elapsed:7.0f} requests/s | server p50 {server["latency_p50_ms"]:6.2f} ms  '
+              f'p99 {server["latency_p99_ms"]:6.2f} ms  mean batch {server["mean_batch_windows"]:5.1f} windows')
+    writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--unix_socket', default='', type=str)
+    parser.add_argument('--concurrency', default='1,8,64', type=str)
+    parser.add_argument('--requests', default=2000, type=int, help='Requests per concurrency level')
+    parser.add_argument('--windows_per_request', default=1, type=int)
+    parser.add_argument('--format', default='binary', type=str, help='binary (float32) or json bodies')
+    args = parser.parse_args()
+    asyncio.run(run(args))
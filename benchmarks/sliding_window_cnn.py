@@ -0,0 +1,64 @@
+"""
+models.streaming.SlidingWindowCNN vs per-window CNN.forward on overlapping windows of long random streams shaped
+like the chosen dataset's: the difference at the exact feature positions (0 up to float rounding), the logit
+difference and prediction agreement of the shared computation, and the speedup for several overlap ratios (the hop
+is rounded to the alignment of the CNN).
+
+    python -m benchmarks.sliding_window_cnn --dataset HAR --overlaps 0,0.5,0.75,0.9
+"""
+import argparse
+import time
+
+import torch
+from torch import nn
+
+from configs.data_model_configs import get_dataset_class
+from models.models import CNN, CNN_T, classifier, classifier_T
+from models.streaming import SlidingWindowCNN
+
+
+def timed(fn, *args):
+    fn(*args)
+    start = time.perf_counter()
+    out = fn(*args)
+    return time.perf_counter() - start, out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='HAR', type=str)
+    parser.add_argument('--teacher', action='store_true', help='CNN_T instead of the CNN student')
+    parser.add_argument('--overlaps', default='0,0.5,0.75,0.9', type=str)
+    parser.add_argument('--num_streams', default=4, type=int)
+    parser.add_argument('--stream_windows', default=64, type=int, help='Stream length, in windows')
+    parser.add_argument('--atol', default=1e-4, type=float)
+    args = parser.parse_args()
+
+    configs = get_dataset_class(args.dataset)()
+    torch.manual_seed(0)
+    feature_extractor, head = (CNN_T(configs), classifier_T(configs)) if args.teacher else \
+        (CNN(configs), classifier(configs))
+    for m in feature_extractor.modules():
+        if isinstance(m, nn.BatchNorm1d):
+            m.running_mean.normal_()
+            m.running_var.uniform_(0.5, 2)
+    model = SlidingWindowCNN(feature_extractor.eval(), head.eval(), configs.sequence_len)
+    stream = torch.randn(args.num_streams, configs.input_channels, configs.sequence_len * args.stream_windows)
+    print(f'{args.dataset} {type(feature_extractor).__name__}: window {configs.sequence_len}, alignment '
+          f'{model.alignment}, {len(model.exact_positions)}/{model.num_positions} exact feature positions')
+
+    for overlap in map(float, args.overlaps.split(',')):
+        hop = max(model.alignment, round(configs.sequence_len * (1 - overlap) / model.alignment) * model.alignment)
+        per_window_time, per_window = timed(lambda: model.head(model.per_window_features(stream, hop)))
+        shared_time, shared = timed(model, stream, hop)
+
+        exact = model.exact_positions
+        exact_diff = (model.window_features(stream, hop)[..., exact] -
+                      model.per_window_features(stream, hop)[..., exact]).abs().max().item()
+        agreement = (shared.argmax(-1) == per_window.argmax(-1)).float().mean().item()
+        print(f'overlap {1 - hop / configs.sequence_len:5.3f} (hop {hop:4d}, {shared.size(1)} windows): exact positions '
+              f'diff {exact_diff:.1e}, logits diff {(shared - per_window).abs().max().item():.1e}, '
+              f'agreement {agreement:.3f}, per-window {per_window_time * 1e3:8.1f} ms  shared '
+              f'{shared_time * 1e3:7.1f} ms ({per_window_time / shared_time:5.1f}x)')
+        if exact_diff > args.atol:
+            raise RuntimeError(f'Shared feature map differs at the exact positions by {exact_diff} > {args.atol}')
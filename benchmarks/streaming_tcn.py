@@ -0,0 +1,64 @@
+"""
+Stateful models.streaming.StreamingTCN vs TCN.forward recomputed over the sliding window (sequence_len samples of
+the chosen dataset) at every hop: the largest difference of their outputs over a random stream, and the outputs
+per second at several hop sizes. The BatchNorm statistics are randomized so that the folding is exercised.
+
+    python -m benchmarks.streaming_tcn --dataset HAR --hops 1,2,4,8
+"""
+import argparse
+import time
+
+import torch
+from torch import nn
+
+from configs.data_model_configs import get_dataset_class
+from models.models import TCN
+from models.streaming import StreamingTCN
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='HAR', type=str)
+    parser.add_argument('--hops', default='1,2,4,8', type=str)
+    parser.add_argument('--num_streams', default=1, type=int)
+    parser.add_argument('--num_outputs', default=200, type=int)
+    parser.add_argument('--atol', default=1e-4, type=float)
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    configs = get_dataset_class(args.dataset)()
+    torch.manual_seed(0)
+    tcn = TCN(configs)
+    for m in tcn.modules():
+        if isinstance(m, nn.BatchNorm1d):
+            m.running_mean.normal_()
+            m.running_var.uniform_(0.5, 2)
+    tcn = tcn.to(device).eval()
+    streaming = StreamingTCN(tcn)
+    window = configs.sequence_len
+    print(f'{args.dataset}: window {window}, receptive field {streaming.receptive_field}, '
+          f'{args.num_streams} stream(s)')
+
+    for hop in map(int, args.hops.split(',')):
+        stream = torch.randn(args.num_streams, configs.input_channels, window + hop * args.num_outputs, device=device)
+        ends = range(window + hop - 1, stream.size(2), hop)
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            windowed = torch.stack([tcn(stream[:, :, end + 1 - window:end + 1]) for end in ends], dim=-1)
+        windowed_time = time.perf_counter() - start
+
+        # warm up the buffers with the first window, as a deployed stream would be
+        streaming.reset(args.num_streams, device)
+        streaming.step(stream[:, :, :window])
+        start = time.perf_counter()
+        streamed = torch.stack([streaming.step(stream[:, :, end + 1 - hop:end + 1]) for end in ends], dim=-1)
+        streaming_time = time.perf_counter() - start
+
+        diff = (windowed - streamed).abs().max().item()
+        print(f'hop {hop:2d}: max |windowed - streaming| {diff:.2e}  windowed {len(ends) / windowed_time:8.0f} '
+              f'outputs/s  streaming {len(ends) / streaming_time:8.0f} outputs/s '
+              f'({windowed_time / streaming_time:.1f}x)')
+        if diff > args.atol:
+            raise RuntimeError(f'Streaming TCN differs from the windowed one by {diff} > {args.atol}')
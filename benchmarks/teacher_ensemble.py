@@ -0,0 +1,63 @@
+"""
+Forward time of an ensemble of K CNN_T teachers: a Python loop over the K teachers vs the fused
+models.teacher.TeacherEnsemble (grouped convolutions, one batched classifier matmul), next to a
+single teacher. Also reports the largest difference between the averaged logits of both.
+
+    python -m benchmarks.teacher_ensemble --dataset HAR --num_teachers 4 --device cpu
+"""
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from configs.data_model_configs import get_dataset_class
+from models.models import CNN_T, classifier_T
+from models.teacher import TeacherEnsemble
+
+
+def time_forward(forward, x, warmup, iters, device):
+    with torch.no_grad():
+        for _ in range(warmup):
+            forward(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(iters):
+            forward(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='HAR', type=str)
+    parser.add_argument('--num_teachers', default=4, type=int)
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--warmup', default=5, type=int)
+    parser.add_argument('--iters', default=30, type=int)
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    configs = get_dataset_class(args.dataset)()
+    teachers = [nn.Sequential(CNN_T(configs), classifier_T(configs)).to(device).eval()
+                for _ in range(args.num_teachers)]
+    ensemble = TeacherEnsemble(teachers).to(device).eval()
+    x = torch.randn(args.batch_size, configs.input_channels, configs.sequence_len, device=device)
+
+    def loop(x):
+        return torch.stack([teacher(x) for teacher in teachers]).mean(0)
+
+    single = time_forward(teachers[0], x, args.warmup, args.iters, device)
+    looped = time_forward(loop, x, args.warmup, args.iters, device)
+    fused = time_forward(ensemble, x, args.warmup, args.iters, device)
+    with torch.no_grad():
+        max_diff = (loop(x) - ensemble(x)).abs().max().item()
+
+    print(f'{args.dataset} K={args.num_teachers} batch={args.batch_size}')
+    print(f'single teacher   {single * 1e3:8.2f} ms')
+    print(f'loop of K        {looped * 1e3:8.2f} ms   ({looped / single:4.2f}x single)')
+    print(f'TeacherEnsemble  {fused * 1e3:8.2f} ms   ({fused / single:4.2f}x single, {looped / fused:4.2f}x faster than loop)')
+    print(f'max abs difference of averaged logits: {max_diff:.2e}')
@@ -1,3 +1,6 @@
+import copy
+
+
 def get_dataset_class(dataset_name):
     """Return the algorithm class with the given name."""
     if dataset_name not in globals():
@@ -6,6 +9,30 @@ def get_dataset_class(dataset_name):
 
 feature_dim = 16  #[16, 32,64]
 
+
+def with_feature_dim(configs, dim):
+    """Copy of the dataset configs with the student width (mid_channels / final_out_channels) set from dim."""
+    configs = copy.deepcopy(configs)
+    configs.mid_channels = dim
+    configs.final_out_channels = dim * 2
+    return configs
+
+
+def with_student_arch(configs, channels, kernels, features_len):
+    """
+    Copy of the dataset configs with a CNN student architecture: output channels and kernel size of each block
+    and number of positions of the last block kept in the features. The positions are flattened into
+    final_out_channels, so that the teacher, the adapter and the discriminators keep the features_len of the dataset.
+    """
+    configs = copy.deepcopy(configs)
+    configs.student_channels = tuple(channels)
+    configs.student_kernels = tuple(kernels)
+    configs.student_features_len = features_len
+    configs.mid_channels = channels[0]
+    configs.final_out_channels = channels[-1] * features_len // configs.features_len
+    return configs
+
+
 class HAR():
     def __init__(self):
         super(HAR, self)
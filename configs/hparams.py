@@ -21,13 +21,14 @@ class HAR():
             'MobileDA':     {'learning_rate': 1e-2, 'temperature': 2},
             'JointUKD':     {'learning_rate': 1e-2, 'temperature': 20},
             'AAD':          {'learning_rate': 1e-2, 'temperature': 4, 'src_cls_loss_wt': 1, 'soft_loss_wt': 1, 'errG': 0.1},
-            'DANN':         {'learning_rate': 1e-2, 'src_cls_loss_wt': 1, 'domain_loss_wt': 1},
-            'DDC':          {'learning_rate': 5e-3, 'src_cls_loss_wt': 6.24, 'domain_loss_wt': 6.36},
-            'HoMM':         {'learning_rate': 1e-3, 'src_cls_loss_wt': 2.15, 'domain_loss_wt': 9.13},
-            'CoDATS':       {'learning_rate': 1e-3, 'src_cls_loss_wt': 6.21, 'domain_loss_wt': 1.72},
-            'MMDA':         {'learning_rate': 1e-3, 'src_cls_loss_wt': 6.13, 'mmd_wt': 2.37, 'coral_wt': 8.63, 'cond_ent_wt': 7.16},
-            'CDAN':         {'learning_rate': 1e-2, 'src_cls_loss_wt': 5.19, 'domain_loss_wt': 2.91, 'cond_ent_wt': 1.73},
-            'DIRT':         {'learning_rate': 5e-4, 'src_cls_loss_wt': 7.00, 'domain_loss_wt': 4.51, 'cond_ent_wt': 0.79, 'vat_loss_wt': 9.31}
+            'DANN':         {'learning_rate': 1e-2, 'src_cls_loss_wt': 1, 'domain_loss_wt': 1, 'pseudo_label_wt': 1},
+            'DDC':          {'learning_rate': 5e-3, 'src_cls_loss_wt': 6.24, 'domain_loss_wt': 6.36, 'pseudo_label_wt': 1},
+            'HoMM':         {'learning_rate': 1e-3, 'src_cls_loss_wt': 2.15, 'domain_loss_wt': 9.13, 'pseudo_label_wt': 1},
+            'CoDATS':       {'learning_rate': 1e-3, 'src_cls_loss_wt': 6.21, 'domain_loss_wt': 1.72, 'pseudo_label_wt': 1},
+            'MMDA':         {'learning_rate': 1e-3, 'src_cls_loss_wt': 6.13, 'mmd_wt': 2.37, 'coral_wt': 8.63, 'cond_ent_wt': 7.16, 'pseudo_label_wt': 1},
+            'CDAN':         {'learning_rate': 1e-2, 'src_cls_loss_wt': 5.19, 'domain_loss_wt': 2.91, 'cond_ent_wt': 1.73, 'pseudo_label_wt': 1},
+            'DIRT':         {'learning_rate': 5e-4, 'src_cls_loss_wt': 7.00, 'domain_loss_wt': 4.51, 'cond_ent_wt': 0.79, 'vat_loss_wt': 9.31, 'pseudo_label_wt': 1},
+            'KNN_ST':       {'learning_rate': 1e-3, 'src_cls_loss_wt': 1, 'pseudo_label_wt': 1, 'nc_loss_wt': 1, 'num_neighbors': 5},
         }
 
 
@@ -46,13 +47,14 @@ class EEG():
             'MobileDA':     {'learning_rate': 1e-2,     'temperature': 2},
             'JointUKD':     {'learning_rate': 1e-2,     'temperature': 20},
             'AAD':          {'learning_rate': 1e-2, 'temperature': 4, 'src_cls_loss_wt': 1, 'soft_loss_wt': 1, 'errG': 0.1},
-            'DANN':         {'learning_rate': 0.0005,   'src_cls_loss_wt': 8,       'domain_loss_wt': 0.1, },
-            'DDC':          {'learning_rate': 0.0005,   'src_cls_loss_wt': 2.951,   'domain_loss_wt': 8.923, },
-            'HoMM':         {'learning_rate': 0.0005,   'src_cls_loss_wt': 0.197,   'domain_loss_wt': 1.102, },
-            'CoDATS':       {'learning_rate': 0.01,     'src_cls_loss_wt': 9.239,   'domain_loss_wt': 1.342, },
-            'MMDA':         {'learning_rate': 0.0005,   'src_cls_loss_wt': 4.48,    'mmd_wt': 5.951, 'coral_wt': 3.36, 'cond_ent_wt': 6.13, },
-            'CDAN':         {'learning_rate': 0.001,    'src_cls_loss_wt': 6.803,   'domain_loss_wt': 4.726, 'cond_ent_wt': 1.307, },
-            'DIRT':         {'learning_rate': 0.005,    'src_cls_loss_wt': 9.183,   'domain_loss_wt': 7.411, 'cond_ent_wt': 2.564, 'vat_loss_wt': 3.583, },
+            'DANN':         {'learning_rate': 0.0005,   'src_cls_loss_wt': 8,       'domain_loss_wt': 0.1, 'pseudo_label_wt': 1, },
+            'DDC':          {'learning_rate': 0.0005,   'src_cls_loss_wt': 2.951,   'domain_loss_wt': 8.923, 'pseudo_label_wt': 1, },
+            'HoMM':         {'learning_rate': 0.0005,   'src_cls_loss_wt': 0.197,   'domain_loss_wt': 1.102, 'pseudo_label_wt': 1, },
+            'CoDATS':       {'learning_rate': 0.01,     'src_cls_loss_wt': 9.239,   'domain_loss_wt': 1.342, 'pseudo_label_wt': 1, },
+            'MMDA':         {'learning_rate': 0.0005,   'src_cls_loss_wt': 4.48,    'mmd_wt': 5.951, 'coral_wt': 3.36, 'cond_ent_wt': 6.13, 'pseudo_label_wt': 1, },
+            'CDAN':         {'learning_rate': 0.001,    'src_cls_loss_wt': 6.803,   'domain_loss_wt': 4.726, 'cond_ent_wt': 1.307, 'pseudo_label_wt': 1, },
+            'DIRT':         {'learning_rate': 0.005,    'src_cls_loss_wt': 9.183,   'domain_loss_wt': 7.411, 'cond_ent_wt': 2.564, 'vat_loss_wt': 3.583, 'pseudo_label_wt': 1, },
+            'KNN_ST':       {'learning_rate': 1e-3, 'src_cls_loss_wt': 1, 'pseudo_label_wt': 1, 'nc_loss_wt': 1, 'num_neighbors': 5},
         }
 
 
@@ -70,13 +72,14 @@ class HHAR_SA():
             'MobileDA':     {'learning_rate': 1e-2,     'temperature': 2},
             'JointUKD':     {'learning_rate': 1e-2,     'temperature': 20},
             'AAD':          {'learning_rate': 1e-2, 'temperature': 4, 'src_cls_loss_wt': 1, 'soft_loss_wt': 1, 'errG': 0.1},
-            'DANN':         {'learning_rate': 0.0005,   'src_cls_loss_wt': 1.0,     'domain_loss_wt': 1.0},
-            'DDC':          {'learning_rate': 0.01,     'src_cls_loss_wt':  0.1593, 'domain_loss_wt': 0.2048},
-            'HoMM':         {'learning_rate':0.001,     'src_cls_loss_wt': 0.2429,  'domain_loss_wt': 0.9824},
-            'CoDATS':       {'learning_rate': 0.0005,   'src_cls_loss_wt': 0.5416,  'domain_loss_wt': 0.5582},
-            'MMDA':         {'learning_rate': 0.001,    'src_cls_loss_wt': 0.9505,  'mmd_wt': 0.5476,           'cond_ent_wt': 0.5167,  'coral_wt': 0.5838, },
-            'CDAN':         {'learning_rate': 0.001,    'src_cls_loss_wt': 0.6636,  'domain_loss_wt': 0.1954,   'cond_ent_wt':0.0124},
-            'DIRT':         {'learning_rate': 0.001,    'src_cls_loss_wt': 0.9752,  'domain_loss_wt': 0.3892,   'cond_ent_wt': 0.09228,  'vat_loss_wt': 0.1947}
+            'DANN':         {'learning_rate': 0.0005,   'src_cls_loss_wt': 1.0,     'domain_loss_wt': 1.0, 'pseudo_label_wt': 1},
+            'DDC':          {'learning_rate': 0.01,     'src_cls_loss_wt':  0.1593, 'domain_loss_wt': 0.2048, 'pseudo_label_wt': 1},
+            'HoMM':         {'learning_rate':0.001,     'src_cls_loss_wt': 0.2429,  'domain_loss_wt': 0.9824, 'pseudo_label_wt': 1},
+            'CoDATS':       {'learning_rate': 0.0005,   'src_cls_loss_wt': 0.5416,  'domain_loss_wt': 0.5582, 'pseudo_label_wt': 1},
+            'MMDA':         {'learning_rate': 0.001,    'src_cls_loss_wt': 0.9505,  'mmd_wt': 0.5476,           'cond_ent_wt': 0.5167,  'coral_wt': 0.5838, 'pseudo_label_wt': 1, },
+            'CDAN':         {'learning_rate': 0.001,    'src_cls_loss_wt': 0.6636,  'domain_loss_wt': 0.1954,   'cond_ent_wt':0.0124, 'pseudo_label_wt': 1},
+            'DIRT':         {'learning_rate': 0.001,    'src_cls_loss_wt': 0.9752,  'domain_loss_wt': 0.3892,   'cond_ent_wt': 0.09228,  'vat_loss_wt': 0.1947, 'pseudo_label_wt': 1},
+            'KNN_ST':       {'learning_rate': 1e-3, 'src_cls_loss_wt': 1, 'pseudo_label_wt': 1, 'nc_loss_wt': 1, 'num_neighbors': 5},
         }
 
 
@@ -94,11 +97,12 @@ class FD():
             'MobileDA': {'learning_rate': 1e-2, 'temperature': 2},
             'JointUKD': {'learning_rate': 1e-2, 'temperature': 20},
             'AAD':      {'learning_rate': 1e-2, 'temperature': 4, 'src_cls_loss_wt': 1, 'soft_loss_wt': 1, 'errG': 0.1},
-            'DANN':         {'learning_rate': 0.0005,   'src_cls_loss_wt': 0.9603,  'domain_loss_wt':0.9238},
-            'DDC':          {'learning_rate': 0.01,     'src_cls_loss_wt':  0.1593, 'domain_loss_wt': 0.2048},
-            'HoMM':         {'learning_rate':0.001,     'src_cls_loss_wt': 0.2429,  'domain_loss_wt': 0.9824},
-            'CoDATS':       {'learning_rate': 0.0005,   'src_cls_loss_wt': 0.5416,  'domain_loss_wt': 0.5582},
-            'MMDA':         {'learning_rate': 0.001,    'src_cls_loss_wt': 0.9505,  'mmd_wt': 0.5476,           'cond_ent_wt': 0.5167,  'coral_wt': 0.5838, },
-            'CDAN':         {'learning_rate': 0.001,    'src_cls_loss_wt': 0.5,  'domain_loss_wt': 0.1,   'cond_ent_wt':0.1},
-            'DIRT':         {'learning_rate': 0.001,    'src_cls_loss_wt': 1.0,  'domain_loss_wt': 0.5,   'cond_ent_wt': 0.1,  'vat_loss_wt': 0.1}
+            'DANN':         {'learning_rate': 0.0005,   'src_cls_loss_wt': 0.9603,  'domain_loss_wt':0.9238, 'pseudo_label_wt': 1},
+            'DDC':          {'learning_rate': 0.01,     'src_cls_loss_wt':  0.1593, 'domain_loss_wt': 0.2048, 'pseudo_label_wt': 1},
+            'HoMM':         {'learning_rate':0.001,     'src_cls_loss_wt': 0.2429,  'domain_loss_wt': 0.9824, 'pseudo_label_wt': 1},
+            'CoDATS':       {'learning_rate': 0.0005,   'src_cls_loss_wt': 0.5416,  'domain_loss_wt': 0.5582, 'pseudo_label_wt': 1},
+            'MMDA':         {'learning_rate': 0.001,    'src_cls_loss_wt': 0.9505,  'mmd_wt': 0.5476,           'cond_ent_wt': 0.5167,  'coral_wt': 0.5838, 'pseudo_label_wt': 1, },
+            'CDAN':         {'learning_rate': 0.001,    'src_cls_loss_wt': 0.5,  'domain_loss_wt': 0.1,   'cond_ent_wt':0.1, 'pseudo_label_wt': 1},
+            'DIRT':         {'learning_rate': 0.001,    'src_cls_loss_wt': 1.0,  'domain_loss_wt': 0.5,   'cond_ent_wt': 0.1,  'vat_loss_wt': 0.1, 'pseudo_label_wt': 1},
+            'KNN_ST':       {'learning_rate': 1e-3, 'src_cls_loss_wt': 1, 'pseudo_label_wt': 1, 'nc_loss_wt': 1, 'num_neighbors': 5},
         }
\ No newline at end of file
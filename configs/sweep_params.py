@@ -46,12 +46,22 @@ sweep_alg_hparams = {
             'domain_loss_wt':   {'distribution': 'uniform', 'min': 1e-2, 'max': 10},
             'cond_ent_wt':      {'distribution': 'uniform', 'min': 1e-2, 'max': 10},
             'vat_loss_wt':      {'distribution': 'uniform', 'min': 1e-2, 'max': 10},
+            'vat_mode':         {'values': ['input', 'joint', 'feature']},
+        },
+
+        'KNN_ST': {
+            'learning_rate':    {'values': [1e-2, 5e-3, 1e-3, 5e-4]},
+            'src_cls_loss_wt':  {'distribution': 'uniform', 'min': 1e-1, 'max': 10},
+            'pseudo_label_wt':  {'distribution': 'uniform', 'min': 1e-2, 'max': 10},
+            'nc_loss_wt':       {'distribution': 'uniform', 'min': 1e-2, 'max': 10},
+            'num_neighbors':    {'values': [3, 5, 10]},
         },
 
         'HoMM': {
             'learning_rate':    {'values': [1e-2, 5e-3, 1e-3, 5e-4]},
             'src_cls_loss_wt':  {'distribution': 'uniform', 'min': 1e-1, 'max': 10},
             'hommd_wt':         {'distribution': 'uniform', 'min': 1e-2, 'max': 10},
+            'memory_bank_size': {'values': [0, 64, 128, 256]},
         },
 
         'MMDA': {
@@ -60,6 +70,8 @@ sweep_alg_hparams = {
             'coral_wt':         {'distribution': 'uniform', 'min': 1e-2, 'max': 10},
             'cond_ent_wt':      {'distribution': 'uniform', 'min': 1e-2, 'max': 10},
             'mmd_wt':           {'distribution': 'uniform', 'min': 1e-2, 'max': 10},
+            'memory_bank_size': {'values': [0, 128, 256, 512]},
+            'coral_momentum':   {'values': [0.0, 0.9, 0.99]},
         },
 
         'DSAN': {
@@ -72,6 +84,12 @@ sweep_alg_hparams = {
             'learning_rate':    {'values': [1e-2, 5e-3, 1e-3, 5e-4]},
             'src_cls_loss_wt':  {'distribution': 'uniform', 'min': 1e-1, 'max': 10},
             'mmd_wt':           {'distribution': 'uniform', 'min': 1e-2, 'max': 10},
+            'memory_bank_size': {'values': [0, 128, 256, 512]},
         },
 }
 
+
+# swept with --pseudo_labels only: the weight of the stored pseudo-label term (Algorithm.pseudo_label_term)
+sweep_pseudo_label_hparams = {
+        'pseudo_label_wt':  {'distribution': 'uniform', 'min': 1e-2, 'max': 10},
+}
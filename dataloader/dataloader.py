@@ -11,8 +11,10 @@ import random
 
 
 class Load_Dataset(Dataset):
-    def __init__(self, dataset, normalize):
+    def __init__(self, dataset, normalize, return_index=False):
         super(Load_Dataset, self).__init__()
+        # with return_index, samples are (x, y, index in the dataset), e.g. to key a PseudoLabelStore
+        self.return_index = return_index
 
         X_train = dataset["samples"]
         y_train = dataset["labels"]
@@ -48,19 +50,21 @@ class Load_Dataset(Dataset):
             output = self.transform(self.x_data[index].view(self.num_channels, -1, 1))
             self.x_data[index] = output.view(self.x_data[index].shape)
 
+        if self.return_index:
+            return self.x_data[index].float(), self.y_data[index].long(), index
         return self.x_data[index].float(), self.y_data[index].long()
 
     def __len__(self):
         return self.len
 
 
-def data_generator(data_path, domain_id, dataset_configs, hparams):
+def data_generator(data_path, domain_id, dataset_configs, hparams, return_index=False):
     # loading path
     train_dataset = torch.load(os.path.join(data_path, "train_" + domain_id + ".pt"))
     test_dataset = torch.load(os.path.join(data_path, "test_" + domain_id + ".pt"))
 
     # Loading datasets
-    train_dataset = Load_Dataset(train_dataset, dataset_configs.normalize)
+    train_dataset = Load_Dataset(train_dataset, dataset_configs.normalize, return_index)
     test_dataset = Load_Dataset(test_dataset, dataset_configs.normalize)
 
     # Dataloaders
@@ -0,0 +1,133 @@
+import os
+import time
+import argparse
+import warnings
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+import sklearn.exceptions
+from sklearn.metrics import accuracy_score, f1_score
+
+from configs.data_model_configs import get_dataset_class
+from configs.hparams import get_hparams_class
+from dataloader.dataloader import data_generator
+from models.models import network_from_checkpoint, CNN_T, classifier_T
+from models.early_exit import EXIT_BLOCKS, EarlyExitCascade, make_exit_heads
+from models.teacher import teacher_checkpoint_paths, load_teacher
+
+warnings.filterwarnings("ignore", category=sklearn.exceptions.UndefinedMetricWarning)
+
+
+def load_cascade(args, configs, src_id, trg_id, device):
+    '''
+    Student, exit heads and teacher of a UDA_KD checkpoint trained with --early_exit; the teacher is the one saved
+    with the student unless --teacher_checkpoints is given
+    '''
+    checkpoint = torch.load(args.student_checkpoint.format(src=src_id, trg=trg_id), map_location="cpu")
+    student_configs = SimpleNamespace(**checkpoint["configs"])
+    student = network_from_checkpoint(checkpoint, "CNN")
+
+    model_dict = checkpoint["model_dict"]
+    exit_heads = make_exit_heads(student[0], student_configs.num_classes)
+    if "exit_heads_dict" in checkpoint:
+        exit_heads.load_state_dict(checkpoint["exit_heads_dict"])
+    elif checkpoint["hparams"].get("weight_averaging") not in (None, "none"):
+        raise ValueError("The checkpoint holds the live exit heads only, which do not match its averaged network: "
+                         "retrain it to save the averaged heads")
+    else:
+        exit_heads.load_state_dict({k[len("exit_heads."):]: v for k, v in model_dict.items()
+                                    if k.startswith("exit_heads.")})
+
+    teacher = None
+    if not args.no_teacher:
+        teacher = nn.Sequential(CNN_T(configs), classifier_T(configs))
+        if args.teacher_checkpoints:
+            teacher_dir = os.path.join(args.save_dir, args.dataset, "Teacher_CNN")
+            teacher = load_teacher(teacher, teacher_checkpoint_paths(args.teacher_checkpoints, teacher_dir, src_id, trg_id))
+        else:
+            teacher.load_state_dict({k[len("network_t."):]: v for k, v in model_dict.items()
+                                     if k.startswith("network_t.")})
+    return EarlyExitCascade(student, exit_heads, teacher, EXIT_BLOCKS).to(device).eval()
+
+
+def evaluate_cascade(cascade, data_loader, threshold, device):
+    '''
+    Predictions, labels and exit stages of the test windows at a threshold, and the mean time per window (ms) of
+    the batched cascade
+    '''
+    preds, labels, stages, elapsed = [], [], [], 0.
+    for x, y in data_loader:
+        x = x.float().to(device)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        logits, stage = cascade(x, threshold)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed += time.perf_counter() - start
+        preds.append(logits.argmax(dim=1).cpu().numpy())
+        labels.append(y.view(-1).numpy())
+        stages.append(stage.cpu().numpy())
+    labels = np.concatenate(labels)
+    return np.concatenate(preds), labels, np.concatenate(stages), elapsed / len(labels) * 1e3
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # ========  Experiments Name ================
+    parser.add_argument('--save_dir',               default='experiments_logs',         type=str, help='Directory containing all experiments')
+    parser.add_argument('--experiment_description', default='HAR',                      type=str, help='Name of your experiment (HAR, HHAR_SA, FD, EEG')
+    parser.add_argument('--run_description',        default='Early_exit_CNN',           type=str, help='name of your runs, ')
+
+    # ========= Checkpoints ======================
+    parser.add_argument('--student_checkpoint',     required=True,                      type=str, help='UDA_KD checkpoint.pt trained with --early_exit, with {src}/{trg} placeholders')
+    parser.add_argument('--teacher_checkpoints',    default='',                         type=str, help='Teacher checkpoints under <save_dir>/<dataset>/Teacher_CNN with {src}/{trg} placeholders (default: the teacher saved with the student)')
+    parser.add_argument('--no_teacher',             action='store_true',                          help='Never escalate to the teacher, the student classifier is the last stage')
+
+    # ========= Select the DATASET ==============
+    parser.add_argument('--data_path',              default=r'./data',                  type=str, help='Path containing dataset')
+    parser.add_argument('--dataset',                default='HAR',                      type=str, help='Dataset of choice: (HAR, HHAR_SA, FD, EEG)')
+    parser.add_argument('--scenarios',              default='',                         type=str, help='Comma-separated scenarios, e.g. 2_to_11 (default: those of the dataset configs)')
+
+    # ========= Cascade =========================
+    parser.add_argument('--thresholds',             default='0.5,0.7,0.8,0.9,0.95,0.99,1.01', type=str, help='Comma-separated confidence thresholds (above 1: student classifier or teacher only)')
+    parser.add_argument('--device',                 default='cpu',                      type=str, help='cpu or cuda')
+
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    configs = get_dataset_class(args.dataset)()
+    hparams = {"batch_size": get_hparams_class(args.dataset)().train_params["batch_size"]}
+    scenarios = configs.scenarios
+    if args.scenarios:
+        scenarios = [tuple(scenario.split("_to_")) for scenario in args.scenarios.split(",")]
+    log_dir = os.path.join(args.save_dir, args.experiment_description, args.run_description)
+    os.makedirs(log_dir, exist_ok=True)
+
+    rows = []
+    window = (configs.input_channels, configs.sequence_len)
+    for src_id, trg_id in scenarios:
+        _, trg_test_dl = data_generator(os.path.join(args.data_path, args.dataset), trg_id, configs, hparams)
+        cascade = load_cascade(args, configs, src_id, trg_id, device)
+        stage_flops = np.array(cascade.stage_flops(window))
+        for threshold in map(float, args.thresholds.split(",")):
+            preds, labels, stages, latency = evaluate_cascade(cascade, trg_test_dl, threshold, device)
+            exits = np.bincount(stages, minlength=len(cascade.stages)) / len(stages)
+            row = {"scenario": f"{src_id}_to_{trg_id}", "threshold": threshold,
+                   "acc": accuracy_score(labels, preds) * 100, "f1": f1_score(labels, preds, average="macro") * 100,
+                   "mflops_per_window": float(exits @ stage_flops) / 1e6, "latency_ms_per_window": latency}
+            row.update({f"exit_{stage}": fraction for stage, fraction in zip(cascade.stages, exits)})
+            rows.append(row)
+
+    results = pd.DataFrame(rows)
+    mean_results = results.drop(columns="scenario").groupby("threshold").mean().reset_index()
+    with pd.ExcelWriter(os.path.join(log_dir, "early_exit_results.xlsx")) as writer:
+        results.to_excel(writer, sheet_name="scenarios", index=False)
+        mean_results.to_excel(writer, sheet_name="mean", index=False)
+    print("MFLOPs per window leaving at " + ", ".join(f"{stage}: {flops / 1e6:.3f}"
+                                                     for stage, flops in zip(cascade.stages, stage_flops)))
+    print(mean_results.to_string(index=False, float_format="%.3f"))
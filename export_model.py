@@ -0,0 +1,79 @@
+import os
+import json
+import argparse
+
+import torch
+
+from models.models import network_from_checkpoint
+from models.export import fuse_for_inference, export_torchscript, export_onnx, export_numpy, max_abs_difference
+from models.numpy_runtime import NumpyCNN
+from utils import count_parameters, measure_latency
+
+
+def check_onnx(network, path, x):
+    '''
+    Largest difference between the network and the ONNX model run by onnxruntime, None when it is not installed
+    '''
+    try:
+        import onnxruntime
+    except ImportError:
+        return None
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+    return max_abs_difference(network, lambda x: session.run(None, {"x": x.cpu().numpy()})[0], x.cpu())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint',             required=True,                      type=str, help='checkpoint.pt saved by save_checkpoint (or the teacher registry)')
+    parser.add_argument('--backbone',               default='CNN',                      type=str, help='Backbone of the checkpoint: (CNN - RESNET18 - TCN - RESNET34 -RESNET1D_WANG)')
+    parser.add_argument('--save_dir',               default='exported_models',          type=str, help='Directory of the exported models')
+    parser.add_argument('--formats',                default='torchscript,onnx',         type=str, help='Comma-separated export formats: (torchscript - onnx - numpy, CNN only)')
+    parser.add_argument('--num_samples',            default=64,                         type=int, help='Random windows of the equivalence check')
+    parser.add_argument('--atol',                   default=1e-4,                       type=float, help='Largest absolute logit difference accepted by the equivalence check')
+    parser.add_argument('--device',                 default='cpu',                      type=str, help='cpu or cuda')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    configs = checkpoint["configs"]
+    network = network_from_checkpoint(checkpoint, args.backbone).to(device).eval()
+    fused = fuse_for_inference(network)
+
+    os.makedirs(args.save_dir, exist_ok=True)
+    window = (1, configs["input_channels"], configs["sequence_len"])
+    example = torch.randn(*window, device=device)
+    x = torch.randn(args.num_samples, *window[1:], device=device)
+
+    report = {"checkpoint": args.checkpoint, "backbone": args.backbone, "parameters": count_parameters(fused),
+              "max_abs_diff": {"folded": max_abs_difference(network, fused, x)},
+              "latency_ms": {"checkpoint": measure_latency(network, window, device),
+                             "folded": measure_latency(fused, window, device)}}
+    formats = args.formats.split(",")
+    if "torchscript" in formats:
+        path = os.path.join(args.save_dir, "model_torchscript.pt")
+        scripted = export_torchscript(fused, example, path)
+        report["max_abs_diff"]["torchscript"] = max_abs_difference(network, scripted, x)
+        report["latency_ms"]["torchscript"] = measure_latency(scripted, window, device)
+    if "numpy" in formats:
+        runtime = NumpyCNN.load(export_numpy(fused, os.path.join(args.save_dir, "model.npz")))
+        report["max_abs_diff"]["numpy"] = max_abs_difference(network, lambda x: runtime(x.cpu().numpy()), x.cpu())
+        report["latency_ms"]["numpy"] = measure_latency(lambda x: runtime(x.numpy()), window, torch.device("cpu"))
+    if "onnx" in formats:
+        try:
+            path = export_onnx(fused, example, os.path.join(args.save_dir, "model.onnx"))
+        except ImportError as e:
+            print(f"ONNX export skipped, missing exporter dependency: {e}")
+        else:
+            onnx_diff = check_onnx(network, path, x)
+            if onnx_diff is None:
+                print("onnxruntime is not installed, the ONNX model is not checked")
+            else:
+                report["max_abs_diff"]["onnx"] = onnx_diff
+
+    with open(os.path.join(args.save_dir, "export_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+    failed = {name: diff for name, diff in report["max_abs_diff"].items() if diff > args.atol}
+    if failed:
+        raise RuntimeError(f"Exported models differ from the checkpoint by more than {args.atol}: {failed}")
@@ -0,0 +1,60 @@
+import os
+import json
+import argparse
+
+import pandas as pd
+import torch
+import torch.nn as nn
+
+from configs.data_model_configs import get_dataset_class
+from models.models import get_backbone_class, classifier, classifier_T
+from models.profiler import profile_model, compare_profiles
+
+
+def build_network(backbone, configs):
+    '''
+    nn.Sequential(backbone, classifier) as the trainers build it; CNN_T gets the teacher classifier
+    '''
+    if backbone == "TCN":
+        configs.final_out_channels = configs.tcn_final_out_channles
+    head = classifier_T(configs) if backbone == "CNN_T" else classifier(configs)
+    return nn.Sequential(get_backbone_class(backbone)(configs), head)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save_dir',               default='experiments_logs',         type=str, help='Directory containing all experiments')
+    parser.add_argument('--experiment_description', default='Profiles',                 type=str, help='Name of the experiment directory of the profiles')
+    parser.add_argument('--dataset',                default='HAR',                      type=str, help='Comma-separated datasets: (HAR, HHAR_SA, FD, EEG)')
+    parser.add_argument('--backbones',              default='CNN_T,CNN,TCN,RESNET18,RESNET1D_WANG', type=str, help='Comma-separated backbones of models/models.py')
+    parser.add_argument('--teacher',                default='CNN_T',                    type=str, help='Backbone the others are compared to (compression and speedup)')
+    parser.add_argument('--batch_sizes',            default='1,32,256',                 type=str, help='Comma-separated batch sizes of the CPU latency')
+    parser.add_argument('--iters',                  default=20,                         type=int, help='Timed forward passes per batch size')
+    args = parser.parse_args()
+
+    device = torch.device("cpu")
+    batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+    log_dir = os.path.join(args.save_dir, args.experiment_description)
+    os.makedirs(log_dir, exist_ok=True)
+
+    for dataset in args.dataset.split(","):
+        summaries, layer_tables = {}, {}
+        for backbone in args.backbones.split(","):
+            configs = get_dataset_class(dataset)()
+            network = build_network(backbone, configs)
+            summaries[backbone], layers = profile_model(network, (configs.input_channels, configs.sequence_len),
+                                                        device, batch_sizes, iters=args.iters)
+            layer_tables[backbone] = pd.DataFrame(layers)
+        if args.teacher in summaries:
+            for backbone, summary in summaries.items():
+                summary.update(compare_profiles(summaries[args.teacher], summary))
+
+        results = pd.DataFrame.from_dict(summaries, orient="index")
+        with pd.ExcelWriter(os.path.join(log_dir, f"profile_{dataset}.xlsx")) as writer:
+            results.to_excel(writer, sheet_name="summary", index_label="backbone")
+            for backbone, layers in layer_tables.items():
+                layers.to_excel(writer, sheet_name=backbone, index=False)
+        with open(os.path.join(log_dir, f"profile_{dataset}.json"), "w") as f:
+            json.dump(summaries, f, indent=2)
+        print(f"==== {dataset} ====")
+        print(results.to_string(float_format="%.4g"))
@@ -0,0 +1,124 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from models.profiler import count_flops
+
+# CNN blocks followed by an exit head
+EXIT_BLOCKS = ("conv_block1", "conv_block2")
+
+
+class ExitHead(nn.Module):
+    """Lightweight classifier on the activations of an intermediate block: global average pooling and a Linear."""
+
+    def __init__(self, in_channels, num_classes):
+        super(ExitHead, self).__init__()
+        self.pool = nn.AdaptiveAvgPool1d(1)
+        self.logits = nn.Linear(in_channels, num_classes)
+
+    def forward(self, x):
+        return self.logits(self.pool(x).flatten(1))
+
+
+def make_exit_heads(backbone, num_classes, blocks=EXIT_BLOCKS):
+    """An ExitHead for each of the blocks of a CNN, sized by the last Conv1d of the block."""
+    if blocks and not set(blocks) <= set(getattr(backbone, "blocks", ())):
+        raise ValueError("Early exits need a backbone with the sequential blocks {}, not {}".format(
+            blocks, type(backbone).__name__))
+    heads = []
+    for name in blocks:
+        convs = [m for m in getattr(backbone, name).modules() if isinstance(m, nn.Conv1d)]
+        heads.append(ExitHead(convs[-1].out_channels, num_classes))
+    return nn.ModuleList(heads)
+
+
+class BlockTaps(object):
+    """Outputs of the named blocks of a backbone in the forward passes run inside the with statement."""
+
+    def __init__(self, backbone, blocks):
+        self.backbone = backbone
+        self.blocks = blocks
+        self.outputs = {}
+        self.handles = []
+
+    def _hook(self, name):
+        def hook(module, inputs, output):
+            self.outputs[name] = output
+        return hook
+
+    def __enter__(self):
+        self.outputs = {}
+        self.handles = [getattr(self.backbone, name).register_forward_hook(self._hook(name)) for name in self.blocks]
+        return self
+
+    def __exit__(self, *exc):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+class EarlyExitCascade(nn.Module):
+    """
+    Confidence-gated cascade of a CNN student with exit heads after some of its blocks, and optionally its teacher.
+    A window leaves at the first exit (then the final student classifier) whose softmax confidence reaches the
+    threshold; with a teacher, the windows the final student classifier is not confident about are escalated to it.
+    Each stage only runs on the windows left, compacted into a smaller batch.
+    """
+
+    def __init__(self, student, exit_heads, teacher=None, exit_blocks=EXIT_BLOCKS):
+        super(EarlyExitCascade, self).__init__()
+        self.student = student
+        self.exit_heads = nn.ModuleDict(dict(zip(exit_blocks, exit_heads)))
+        self.teacher = teacher
+        # stage of every exit: the exit heads in order, then the student classifier, then the teacher
+        self.stages = list(exit_blocks) + ["student"] + (["teacher"] if teacher is not None else [])
+
+    @torch.no_grad()
+    def forward(self, x, threshold):
+        """Logits (N, num_classes) of the windows x and the index in self.stages of the stage each one left at."""
+        feature_extractor, classifier = self.student
+        logits, stage = None, torch.full((len(x),), len(self.stages) - 1, dtype=torch.long, device=x.device)
+        remaining = torch.arange(len(x), device=x.device)
+        h = x
+
+        def exit_confident(out, stage_index, last=False):
+            nonlocal logits, remaining, h
+            if logits is None:
+                logits = out.new_zeros(len(x), out.size(1))
+            done = torch.ones(len(out), dtype=torch.bool, device=out.device) if last else \
+                F.softmax(out, dim=1).max(dim=1)[0] >= threshold
+            logits[remaining[done]] = out[done]
+            stage[remaining[done]] = stage_index
+            remaining, h = remaining[~done], h[~done]
+            return len(remaining) == 0
+
+        for name in feature_extractor.blocks:
+            h = getattr(feature_extractor, name)(h)
+            if name in self.exit_heads and exit_confident(self.exit_heads[name](h), self.stages.index(name)):
+                return logits, stage
+        features = feature_extractor.adaptive_pool(h)
+        out = classifier(features.reshape(features.size(0), -1))
+        if exit_confident(out, self.stages.index("student"), last=self.teacher is None):
+            return logits, stage
+        logits[remaining] = self.teacher(x[remaining])
+        return logits, stage
+
+    def stage_flops(self, window):
+        """FLOPs (count_flops) of a window (C, L) leaving at each stage, with the exit heads on its way."""
+        feature_extractor, classifier = self.student
+        x = torch.zeros(1, *window, device=next(self.student.parameters()).device)
+        flops, total = [], 0
+        for name in feature_extractor.blocks:
+            total += count_flops(getattr(feature_extractor, name), x)
+            with torch.no_grad():
+                x = getattr(feature_extractor, name)(x)
+            if name in self.exit_heads:
+                total += count_flops(self.exit_heads[name], x)
+                flops.append(total)
+        with torch.no_grad():
+            features = feature_extractor.adaptive_pool(x)
+        total += count_flops(classifier, features.reshape(1, -1))
+        flops.append(total)
+        if self.teacher is not None:
+            flops.append(total + count_flops(self.teacher, torch.zeros(1, *window, device=x.device)))
+        return flops
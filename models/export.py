@@ -0,0 +1,130 @@
+import copy
+
+import numpy as np
+import torch
+from torch import nn
+
+try:
+    from torch.nn.utils import parametrize
+except ImportError:  # PyTorch < 1.9, weight_norm is hook-based only
+    parametrize = None
+
+from models.models import Chomp1d, CNN
+from models.numpy_runtime import FORMAT_VERSION
+
+# (conv, batchnorm) attribute pairs of the residual blocks (BasicBlock, BasicBlock1d, BasicBlock1d_wang)
+BLOCK_CONV_BN = (("conv1", "bn1"), ("conv2", "bn2"))
+
+
+def fold_batchnorm(conv, bn):
+    """Conv1d computing conv then bn with its running statistics (for DomainBatchNorm1d, the target ones)."""
+    fused = nn.Conv1d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                      dilation=conv.dilation, groups=conv.groups, bias=True, padding_mode=conv.padding_mode)
+    with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        bias = -bn.running_mean * scale
+        if bn.affine:
+            scale = scale * bn.weight
+            bias = bias * bn.weight + bn.bias
+        fused.weight.copy_(conv.weight * scale[:, None, None])
+        conv_bias = conv.bias if conv.bias is not None else torch.zeros_like(bias)
+        fused.bias.copy_(conv_bias * scale + bias)
+    return fused.to(conv.weight.device)
+
+
+def remove_weight_norms(module):
+    """Bake the weight_norm of the layers of module (hook-based or parametrization) into their weights."""
+    for m in module.modules():
+        if parametrize is not None and parametrize.is_parametrized(m, "weight"):
+            parametrize.remove_parametrizations(m, "weight", leave_parametrized=True)
+        elif hasattr(m, "weight_g"):
+            torch.nn.utils.remove_weight_norm(m)
+    return module
+
+
+def _fold_sequential(seq):
+    children = list(seq.named_children())
+    for i, (name, child) in enumerate(children):
+        if isinstance(child, nn.Dropout):
+            setattr(seq, name, nn.Identity())
+        if not isinstance(child, nn.Conv1d):
+            continue
+        # the channel-wise BatchNorm commutes with the Chomp1d cropping of the TCN blocks
+        j = i + 1
+        while j < len(children) and isinstance(children[j][1], Chomp1d):
+            j += 1
+        if j < len(children) and isinstance(children[j][1], nn.BatchNorm1d):
+            setattr(seq, name, fold_batchnorm(child, children[j][1]))
+            setattr(seq, children[j][0], nn.Identity())
+
+
+def fuse_for_inference(network):
+    """
+    Frozen eval-mode copy of a network for deployment: BatchNorm1d layers folded into the preceding Conv1d (in
+    nn.Sequential blocks as in CNN, CNN_T, TCN and the ResNet downsamples, and conv1/bn1, conv2/bn2 of the residual
+    blocks), Dropout removed and weight_norm baked into the weights.
+    """
+    # hook-based weight_norm keeps the weight computed at the last forward, a non-leaf tensor deepcopy refuses: the
+    # copy gets it detached, the network is left untouched
+    memo = {id(m.weight): m.weight.detach().clone() for m in network.modules()
+            if hasattr(m, "weight_g") and not isinstance(m.weight, nn.Parameter)}
+    network = remove_weight_norms(copy.deepcopy(network, memo)).eval()
+    for module in list(network.modules()):
+        if isinstance(module, nn.Sequential):
+            _fold_sequential(module)
+        for conv_name, bn_name in BLOCK_CONV_BN:
+            conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+            if isinstance(conv, nn.Conv1d) and isinstance(bn, nn.BatchNorm1d):
+                setattr(module, conv_name, fold_batchnorm(conv, bn))
+                setattr(module, bn_name, nn.Identity())
+    return network.requires_grad_(False)
+
+
+def export_torchscript(network, example, path):
+    """Trace (CNN runs its blocks in a Python loop), freeze and save the network; returns the loaded module."""
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(network, example))
+    torch.jit.save(traced, path)
+    return torch.jit.load(path, map_location=example.device)
+
+
+def export_onnx(network, example, path, opset_version=11):
+    """Export the network to ONNX with a dynamic batch dimension."""
+    with torch.no_grad():
+        torch.onnx.export(network, example, path, input_names=["x"], output_names=["logits"],
+                          dynamic_axes={"x": {0: "batch"}, "logits": {0: "batch"}}, opset_version=opset_version)
+    return path
+
+
+def export_numpy(network, path):
+    """
+    Save nn.Sequential(CNN, classifier), with BatchNorm folded, as the arrays of models.numpy_runtime.NumpyCNN
+    (float32 .npz). Returns the path.
+    """
+    feature_extractor, head = fuse_for_inference(network).cpu()
+    if not isinstance(feature_extractor, CNN):
+        raise ValueError("The NumPy runtime supports the CNN backbone only, not {}".format(
+            type(feature_extractor).__name__))
+    arrays = {"format_version": np.array(FORMAT_VERSION), "num_blocks": np.array(len(feature_extractor.blocks)),
+              "features_len": np.array(feature_extractor.adaptive_pool.output_size)}
+    for i, name in enumerate(feature_extractor.blocks):
+        layers = [m for m in getattr(feature_extractor, name) if not isinstance(m, nn.Identity)]
+        conv, relu, pool = layers
+        if not (isinstance(conv, nn.Conv1d) and isinstance(relu, nn.ReLU) and isinstance(pool, nn.MaxPool1d)) \
+                or conv.groups != 1 or conv.dilation != (1,) or pool.dilation != 1:
+            raise ValueError("Unexpected layers in the {} of the CNN: {}".format(name, layers))
+        arrays["block{}.weight".format(i)] = conv.weight.numpy().astype(np.float32)
+        arrays["block{}.bias".format(i)] = conv.bias.numpy().astype(np.float32)
+        arrays["block{}.config".format(i)] = np.array([conv.stride[0], conv.padding[0], pool.kernel_size,
+                                                       pool.stride, pool.padding])
+    arrays["fc.weight"] = head.logits.weight.numpy().astype(np.float32)
+    arrays["fc.bias"] = head.logits.bias.numpy().astype(np.float32)
+    with open(path, "wb") as f:
+        np.savez(f, **arrays)
+    return path
+
+
+def max_abs_difference(reference, exported, x):
+    """Largest absolute difference between the outputs of two modules (or callables) on x."""
+    with torch.no_grad():
+        return (reference(x) - torch.as_tensor(exported(x))).abs().max().item()
@@ -0,0 +1,168 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+class FeatureIndex(object):
+    """
+    In-memory approximate nearest-neighbour index (cosine similarity, IVF-style) over the features of a dataset,
+    keyed by dataset index, with a class-probability vector per sample for label propagation.
+    update() writes the detached features and probabilities a training step already computed. After the first pass
+    over the samples, and then every as many writes as stored rows (about once per epoch), rebuild() re-clusters the
+    stored features with a few k-means steps into num_lists lists (default sqrt(N)), warm-started from the previous
+    centroids, so no separate feature extraction pass is needed; the lists give the cluster labels of select().
+    search() only scans the num_probes lists closest to each query (default sqrt(num_lists)), O(num_probes * N /
+    num_lists) per query, i.e. O(N^0.75) with the default sizes; this keeps the recall of the exact neighbours above
+    0.9 (see benchmarks/knn_index.py). num_probes=0 opts in to an exact search, one matrix product of the queries
+    with all the listed features.
+    """
+
+    def __init__(self, device, num_lists=0, num_probes=None, kmeans_iters=5):
+        self.device = device
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.kmeans_iters = kmeans_iters
+        self.features = None
+        self.probs = None
+        self.filled = torch.zeros(0, dtype=torch.bool, device=device)
+        self.num_written = 0
+        self.centroids = None
+        # lists in CSR layout: the listed dataset indices sorted by list, list i at list_rows[offsets[i]:offsets[i+1]]
+        self.offsets = None
+        self.list_rows = None
+        self.list_features = None  # their features, contiguous per list
+        self.assignments = None
+        self.positions = None  # position of each sample in list_rows, -1 when not listed
+        self.cluster_labels = None
+
+    def __len__(self):
+        return int(self.filled.sum())
+
+    @property
+    def ready(self):
+        return self.offsets is not None
+
+    @property
+    def probes(self):
+        """Number of lists scanned per query, all of them for an exact search."""
+        num_lists = len(self.centroids)
+        if self.num_probes is None:
+            return min(int(math.ceil(math.sqrt(num_lists))), num_lists)
+        return min(self.num_probes or num_lists, num_lists)
+
+    def _reserve(self, size, feature_dim, num_classes):
+        if self.features is None:
+            self.features = torch.zeros(0, feature_dim, device=self.device)
+            self.probs = torch.zeros(0, num_classes, device=self.device)
+        if size <= len(self.filled):
+            return
+        grow = max(size, 2 * len(self.filled)) - len(self.filled)
+        self.features = torch.cat((self.features, self.features.new_zeros(grow, feature_dim)))
+        self.probs = torch.cat((self.probs, self.probs.new_zeros(grow, num_classes)))
+        self.filled = torch.cat((self.filled, self.filled.new_zeros(grow)))
+        if self.assignments is not None:
+            self.assignments = torch.cat((self.assignments, self.assignments.new_full((grow,), -1)))
+            self.positions = torch.cat((self.positions, self.positions.new_full((grow,), -1)))
+
+    @torch.no_grad()
+    def update(self, idx, features, probs):
+        """Store the features and class probabilities of the samples idx, re-clustering once per pass over them."""
+        idx = idx.to(self.device)
+        features = features.detach().reshape(len(idx), -1)
+        self._reserve(int(idx.max()) + 1, features.size(1), probs.size(1))
+        # samples written before: the first pass is complete
+        revisited = bool(self.filled[idx].any())
+        self.features[idx] = F.normalize(features.float(), dim=1)
+        self.probs[idx] = probs.detach().float()
+        if self.assignments is not None:
+            # samples keep their list until the next rebuild, but are searched with their new features
+            positions = self.positions[idx]
+            listed = positions >= 0
+            self.list_features[positions[listed]] = self.features[idx][listed]
+        self.filled[idx] = True
+        self.num_written += len(idx)
+        if revisited and self.num_written >= len(self):
+            self.rebuild()
+
+    @torch.no_grad()
+    def rebuild(self):
+        rows = self.filled.nonzero().squeeze(1)
+        features = self.features[rows]
+        num_lists = min(self.num_lists or int(math.sqrt(len(rows))), len(rows))
+        if self.centroids is None or len(self.centroids) != num_lists:
+            centroids = features[torch.randperm(len(rows), device=self.device)[:num_lists]]
+        else:
+            centroids = self.centroids
+        for _ in range(self.kmeans_iters):
+            assignments = (features @ centroids.t()).argmax(dim=1)
+            sums = torch.zeros_like(centroids).index_add_(0, assignments, features)
+            counts = torch.bincount(assignments, minlength=num_lists)
+            # empty lists keep their centroid
+            centroids = torch.where(counts[:, None] > 0, F.normalize(sums, dim=1), centroids)
+        assignments = (features @ centroids.t()).argmax(dim=1)
+
+        counts = torch.bincount(assignments, minlength=num_lists)
+        order = torch.argsort(assignments)
+
+        self.centroids = centroids
+        self.offsets = torch.cat((counts.new_zeros(1), torch.cumsum(counts, 0)))
+        self.list_rows = rows[order]
+        self.list_features = features[order]
+        self.assignments = torch.full((len(self.filled),), -1, dtype=torch.long, device=self.device)
+        self.assignments[rows] = assignments
+        self.positions = torch.full((len(self.filled),), -1, dtype=torch.long, device=self.device)
+        self.positions[rows[order]] = torch.arange(len(rows), device=self.device)
+        # majority label of each list, from the summed probabilities of its members
+        class_sums = torch.zeros(num_lists, self.probs.size(1), device=self.device).index_add_(0, assignments,
+                                                                                             self.probs[rows])
+        self.cluster_labels = class_sums.argmax(dim=1)
+        self.num_written = 0
+
+    @torch.no_grad()
+    def search(self, queries, k, exclude=None):
+        """
+        Approximate k nearest stored samples of each query by cosine similarity: (similarities, dataset indices),
+        both B x k, padded with (-inf, -1) when the probed lists hold fewer than k candidates. Samples exclude[i]
+        (e.g. the query itself) are skipped for query i.
+        """
+        queries = F.normalize(queries.detach().reshape(len(queries), -1).float(), dim=1)
+        num_probes = self.probes
+        if num_probes == len(self.centroids):
+            sims = queries @ self.list_features.t()
+            if exclude is not None:
+                sims = sims.masked_fill(self.list_rows[None, :] == exclude.to(self.device)[:, None], float("-inf"))
+            sims, positions = sims.topk(min(k, sims.size(1)), dim=1)
+            return sims, self.list_rows[positions].masked_fill(torch.isinf(sims), -1)
+
+        probed = (queries @ self.centroids.t()).topk(num_probes, dim=1).indices
+        # the probed ranges of each query laid end to end, padded to the longest concatenation of the batch
+        starts = self.offsets[probed]
+        lengths = self.offsets[probed + 1] - starts
+        ends = torch.cumsum(lengths, dim=1)
+        steps = torch.arange(int(ends[:, -1].max()), device=self.device).repeat(len(queries), 1)
+        probe = torch.searchsorted(ends, steps, right=True)
+        valid = probe < num_probes
+        probe = probe.clamp(max=num_probes - 1)
+        positions = (starts.gather(1, probe) + steps - (ends - lengths).gather(1, probe)).masked_fill(~valid, 0)
+        candidates = self.list_rows[positions].masked_fill(~valid, -1)
+        if exclude is not None:
+            valid &= candidates != exclude.to(self.device)[:, None]
+        sims = torch.bmm(self.list_features[positions], queries[:, :, None]).squeeze(2)
+        sims = sims.masked_fill(~valid, float("-inf"))
+        sims, positions = sims.topk(min(k, sims.size(1)), dim=1)
+        neighbors = candidates.gather(1, positions).masked_fill(torch.isinf(sims), -1)
+        return sims, neighbors
+
+    @torch.no_grad()
+    def neighbor_probs(self, queries, k, exclude=None):
+        """Similarity-weighted mean class probabilities of the k neighbours of each query (kNN label propagation)."""
+        sims, neighbors = self.search(queries, k, exclude)
+        weights = sims.clamp(min=0).masked_fill(neighbors < 0, 0)
+        probs = (weights[:, :, None] * self.probs[neighbors.clamp(min=0)]).sum(1)
+        return probs / weights.sum(1, keepdim=True).clamp(min=1e-8)
+
+    def select(self, idx, labels):
+        """Mask of the samples idx whose labels agree with the majority label of their list (cluster-based)."""
+        assignments = self.assignments[idx.to(self.device)]
+        return (assignments >= 0) & (self.cluster_labels[assignments.clamp(min=0)] == labels)
@@ -15,20 +15,28 @@ class ConditionalEntropyLoss(torch.nn.Module):
 
 
 class VAT(nn.Module):
-    def __init__(self, model, device):
+    """
+    Virtual adversarial training loss. `model` maps X to logits: the full network for
+    input-space perturbations, or only the classifier head when X are features.
+    Passing `domain_sizes` lets several domains share one power-iteration pass over a
+    concatenated batch; the loss is then the sum of the per-domain means.
+    """
+
+    def __init__(self, model, device, epsilon=3.5):
         super(VAT, self).__init__()
         self.n_power = 1
         self.XI = 1e-6
         self.model = model
-        self.epsilon = 3.5
+        self.epsilon = epsilon
         self.device = device
 
-    def forward(self, X, logit):
-        vat_loss = self.virtual_adversarial_loss(X, logit)
+    def forward(self, X, logit, domain_sizes=None):
+        vat_loss = self.virtual_adversarial_loss(X, logit, domain_sizes)
         return vat_loss
 
     def generate_virtual_adversarial_perturbation(self, x, logit):
         d = torch.randn_like(x, device=self.device)
+        x = x.detach()
 
         for _ in range(self.n_power):
             d = self.XI * self.get_normalized_vector(d).requires_grad_()
@@ -39,20 +47,21 @@ class VAT(nn.Module):
 
         return self.epsilon * self.get_normalized_vector(d)
 
-    def kl_divergence_with_logit(self, q_logit, p_logit):
+    def kl_divergence_with_logit(self, q_logit, p_logit, domain_sizes=None):
         q = F.softmax(q_logit, dim=1)
-        qlogq = torch.mean(torch.sum(q * F.log_softmax(q_logit, dim=1), dim=1))
-        qlogp = torch.mean(torch.sum(q * F.log_softmax(p_logit, dim=1), dim=1))
-        return qlogq - qlogp
+        kl = torch.sum(q * (F.log_softmax(q_logit, dim=1) - F.log_softmax(p_logit, dim=1)), dim=1)
+        if domain_sizes is None:
+            return torch.mean(kl)
+        return sum(torch.mean(chunk) for chunk in torch.split(kl, list(domain_sizes)))
 
     def get_normalized_vector(self, d):
         return F.normalize(d.view(d.size(0), -1), p=2, dim=1).reshape(d.size())
 
-    def virtual_adversarial_loss(self, x, logit):
-        r_vadv = self.generate_virtual_adversarial_perturbation(x, logit)
+    def virtual_adversarial_loss(self, x, logit, domain_sizes=None):
         logit_p = logit.detach()
+        r_vadv = self.generate_virtual_adversarial_perturbation(x, logit_p)
         logit_m = self.model(x + r_vadv)
-        loss = self.kl_divergence_with_logit(logit_p, logit_m)
+        loss = self.kl_divergence_with_logit(logit_p, logit_m, domain_sizes)
         return loss
 
 
@@ -89,37 +98,109 @@ class MMD_loss(nn.Module):
         loss = delta.dot(delta.T)
         return loss
 
-    def forward(self, source, target):
+    def banked_rbf_mmd2(self, source, target, source_bank, target_bank):
+        """
+        rbf MMD between the current batch plus the features of a FeatureMemoryBank, per domain. Only the kernel rows
+        of the current batch are computed, O(B * (B + K)); the gradient-free bank x bank blocks are replaced by the
+        running means of the batch x bank blocks kept by the banks.
+        """
+        sq, tq = source_bank.features, target_bank.features
+        bs, bt, ks, kt = len(source), len(target), len(sq), len(tq)
+        rows = torch.cat([source, target], dim=0)
+        cols = torch.cat([source, target, sq.to(source.dtype), tq.to(target.dtype)], dim=0)
+        l2_distance = ((rows ** 2).sum(1, keepdim=True) + (cols ** 2).sum(1) - 2 * rows @ cols.t()).clamp(min=0)
+        bandwidth = torch.sum(l2_distance.data) / (l2_distance.numel() - len(rows))
+        bandwidth /= self.kernel_mul ** (self.kernel_num // 2)
+        kernels = sum(torch.exp(-l2_distance / (bandwidth * self.kernel_mul ** i)) for i in range(self.kernel_num))
+
+        s_rows, t_rows = kernels[:bs], kernels[bs:]
+        s_cols, t_cols, sq_cols, tq_cols = slice(0, bs), slice(bs, bs + bt), slice(bs + bt, bs + bt + ks), \
+            slice(bs + bt + ks, None)
+        ss_bank, tt_bank = s_rows[:, sq_cols].mean(), t_rows[:, tq_cols].mean()
+        st_bank = (s_rows[:, tq_cols].sum() + t_rows[:, sq_cols].sum()) / (bs * kt + bt * ks)
+
+        # bank x bank blocks: kernel_num on the diagonal, the running off-diagonal means elsewhere
+        ss_qq = ks * self.kernel_num + (ks * ks - ks) * source_bank.running_kernel_mean("self", ss_bank, bs)
+        tt_qq = kt * self.kernel_num + (kt * kt - kt) * target_bank.running_kernel_mean("self", tt_bank, bt)
+        st_qq = ks * kt * source_bank.running_kernel_mean("cross", st_bank, bs)
+
+        ns, nt = bs + ks, bt + kt
+        XX = (s_rows[:, s_cols].sum() + 2 * s_rows[:, sq_cols].sum() + ss_qq) / (ns * ns)
+        YY = (t_rows[:, t_cols].sum() + 2 * t_rows[:, tq_cols].sum() + tt_qq) / (nt * nt)
+        XY = (s_rows[:, t_cols].sum() + s_rows[:, tq_cols].sum() + t_rows[:, sq_cols].sum() + st_qq) / (ns * nt)
+        return XX + YY - 2 * XY
+
+    def forward(self, source, target, source_bank=None, target_bank=None):
+        """
+        MMD of the batches; with FeatureMemoryBanks (rbf only), of the batches plus the features of the banks. The rbf
+        MMD of the batches alone is gradient-free, as it always was (the tuned weights of DDC and MMDA assume it);
+        it only backpropagates once banks are given.
+        """
+        banked = source_bank is not None and source_bank.size > 0
+        if banked:
+            loss = None
+            if source_bank.num_filled > 0 and target_bank.num_filled > 0:
+                loss = self.banked_rbf_mmd2(source, target, source_bank, target_bank)
+            if self.training:
+                source_bank.enqueue(source)
+                target_bank.enqueue(target)
+            if loss is not None:
+                return loss
         if self.kernel_type == 'linear':
             return self.linear_mmd2(source, target)
         elif self.kernel_type == 'rbf':
             batch_size = int(source.size()[0])
             kernels = self.guassian_kernel(
                 source, target, kernel_mul=self.kernel_mul, kernel_num=self.kernel_num, fix_sigma=self.fix_sigma)
-            with torch.no_grad():
+            with torch.set_grad_enabled(banked and torch.is_grad_enabled()):
                 XX = torch.mean(kernels[:batch_size, :batch_size])
                 YY = torch.mean(kernels[batch_size:, batch_size:])
                 XY = torch.mean(kernels[:batch_size, batch_size:])
                 YX = torch.mean(kernels[batch_size:, :batch_size])
                 loss = torch.mean(XX + YY - XY - YX)
-            torch.cuda.empty_cache()
             return loss
 
 
 class CORAL(nn.Module):
-    def __init__(self):
+    """
+    CORAL loss. With `momentum` set, the per-batch covariances are blended into running
+    covariances (one per domain), so the statistics are averaged over many batches. The
+    gradient flows through the current batch at full weight (not scaled by 1 - momentum),
+    so the loss weight keeps its meaning whatever the momentum.
+    """
+
+    def __init__(self, momentum=None):
         super(CORAL, self).__init__()
+        self.momentum = momentum
+        self.register_buffer('running_cov_src', None, persistent=False)
+        self.register_buffer('running_cov_trg', None, persistent=False)
+
+    @staticmethod
+    def covariance(x):
+        xm = torch.mean(x, 0, keepdim=True) - x
+        return xm.t() @ xm
+
+    def running_covariance(self, name, cov):
+        running = getattr(self, name)
+        if running is None or running.shape != cov.shape:
+            setattr(self, name, cov.detach())
+            return cov
+        blended = self.momentum * running + (1 - self.momentum) * cov.detach()
+        setattr(self, name, blended)
+        return blended + (cov - cov.detach())
 
     def forward(self, source, target):
         d = source.size(1)
 
         # source covariance
-        xm = torch.mean(source, 0, keepdim=True) - source
-        xc = xm.t() @ xm
+        xc = self.covariance(source)
 
         # target covariance
-        xmt = torch.mean(target, 0, keepdim=True) - target
-        xct = xmt.t() @ xmt
+        xct = self.covariance(target)
+
+        if self.momentum is not None and self.training:
+            xc = self.running_covariance('running_cov_src', xc)
+            xct = self.running_covariance('running_cov_trg', xct)
 
         # frobenius norm between source and target
         loss = torch.mean(torch.mul((xc - xct), (xc - xct)))
@@ -127,6 +208,126 @@ class CORAL(nn.Module):
         return loss
 
 
+class DistillationLoss(nn.Module):
+    """
+    KL(teacher || student) between logits softened by `temperature`.
+    kind='batchmean':    KL averaged over the batch.
+    kind='vanilla':      the batchmean KL scaled by T^2 (Hinton et al.).
+    kind='disentangled': per-sample KL weighted by `weights`, summed and divided by the batch size, scaled by T^2.
+    Teacher log-probabilities can be computed once with `teacher_log_probs()` and passed back in,
+    e.g. when the same teacher logits are distilled into several terms or are cached.
+    """
+
+    def __init__(self, temperature, kind='vanilla'):
+        super(DistillationLoss, self).__init__()
+        if kind not in ('batchmean', 'vanilla', 'disentangled'):
+            raise ValueError("Unknown distillation loss: {}".format(kind))
+        self.temperature = temperature
+        self.kind = kind
+
+    def teacher_log_probs(self, teacher_logits):
+        return F.log_softmax(teacher_logits / self.temperature, dim=1)
+
+    def forward(self, student_logits, teacher_logits=None, weights=None, teacher_log_probs=None):
+        if teacher_log_probs is None:
+            teacher_log_probs = self.teacher_log_probs(teacher_logits)
+        student_log_probs = F.log_softmax(student_logits / self.temperature, dim=1)
+
+        # per-sample KL, reduced with the (optional) sample weights in one dot product
+        kl = torch.sum(teacher_log_probs.exp() * (teacher_log_probs - student_log_probs), dim=1)
+        loss = kl.sum() if weights is None else torch.dot(kl, weights)
+
+        scale = 1. if self.kind == 'batchmean' else self.temperature ** 2
+        return loss * (scale / student_logits.size(0))
+
+
+class FeatureMemoryBank(nn.Module):
+    """
+    FIFO queue of detached features from past batches of one domain (as in MoCo), read by MMD_loss with the
+    current batch, which only carries gradients. The bank also keeps the running means of the batch x bank kernel
+    blocks, standing in for the gradient-free bank x bank block. A bank of size 0 keeps nothing.
+    """
+
+    def __init__(self, size=0):
+        super(FeatureMemoryBank, self).__init__()
+        self.size = size
+        self.ptr = 0
+        self.num_filled = 0
+        self.kernel_means = {}
+        self.register_buffer('queue', None, persistent=False)
+
+    def reset(self):
+        self.ptr = 0
+        self.num_filled = 0
+        self.kernel_means = {}
+
+    @property
+    def features(self):
+        return self.queue[:self.num_filled]
+
+    @torch.no_grad()
+    def enqueue(self, feat):
+        feat = feat.detach().reshape(feat.size(0), -1)[-self.size:]
+        if self.queue is None or self.queue.shape[1] != feat.size(1):
+            self.queue = feat.new_zeros(self.size, feat.size(1))
+            self.reset()
+        idx = (torch.arange(feat.size(0), device=feat.device) + self.ptr) % self.size
+        self.queue.index_copy_(0, idx, feat.to(self.queue.dtype))
+        self.ptr = (self.ptr + feat.size(0)) % self.size
+        self.num_filled = min(self.num_filled + feat.size(0), self.size)
+
+    def running_kernel_mean(self, name, batch_mean, batch_size):
+        """
+        Running mean of a batch x bank kernel block, updated with batch_mean at the rate the queue turns over
+        (a fraction batch_size / size per step), before the estimate is returned (detached).
+        """
+        batch_mean = batch_mean.detach()
+        if name not in self.kernel_means:
+            self.kernel_means[name] = batch_mean
+        elif self.training:
+            rate = min(1., batch_size / self.size)
+            self.kernel_means[name] = self.kernel_means[name] + rate * (batch_mean - self.kernel_means[name])
+        return self.kernel_means[name]
+
+
+class RunningMoments(nn.Module):
+    """
+    Running (detached) raw moments E[x], E[x x] and E[x x x] of the features of past batches of one domain, averaged
+    over about `size` samples: the exact average until `size` samples are seen, then a moving average renewing a
+    fraction batch_size / size per step. It stands for a memory bank of `size` features in HoMM_loss, in O(L^3)
+    memory whatever the size. A size of 0 keeps nothing.
+    """
+
+    def __init__(self, size=0):
+        super(RunningMoments, self).__init__()
+        self.size = size
+        self.count = 0
+        self.moments = None
+
+    @staticmethod
+    def batch_moments(x):
+        x = x.reshape(x.size(0), -1)
+        n = x.size(0)
+        return x.mean(0), x.t() @ x / n, torch.einsum('bi,bj,bk->ijk', x, x, x) / n
+
+    def combine(self, moments, batch_size):
+        """Moments of the current batch (moments, with gradients) plus the samples of the running moments."""
+        if self.count == 0:
+            return moments
+        w = self.count / (self.count + batch_size)
+        return tuple((1 - w) * m + w * r for m, r in zip(moments, self.moments))
+
+    @torch.no_grad()
+    def update(self, moments, batch_size):
+        moments = tuple(m.detach() for m in moments)
+        if self.moments is None or self.moments[0].shape != moments[0].shape:
+            self.moments, self.count = moments, min(batch_size, self.size)
+            return
+        rate = batch_size / (self.count + batch_size) if self.count < self.size else min(1., batch_size / self.size)
+        self.moments = tuple(r + rate * (m - r) for m, r in zip(moments, self.moments))
+        self.count = min(self.count + batch_size, self.size)
+
+
 ### FOR DCAN #######################
 def EntropyLoss(input_):
     mask = input_.ge(0.0000001)
@@ -179,11 +380,29 @@ def MMD_reg(source, target, kernel_mul=2.0, kernel_num=5, fix_sigma=None):
 
 
 ### FOR HoMM #######################
+def central_third_moment(m1, m2, m3):
+    """E[(x - m1)(x - m1)(x - m1)] from the raw moments m1 = E[x], m2 = E[x x], m3 = E[x x x]."""
+    t = torch.einsum('i,jk->ijk', m1, m2)
+    return m3 - t - t.permute(1, 0, 2) - t.permute(1, 2, 0) + 2 * torch.einsum('i,j,k->ijk', m1, m1, m1)
+
+
 class HoMM_loss(nn.Module):
     def __init__(self):
         super(HoMM_loss, self).__init__()
 
-    def forward(self, xs, xt):
+    def forward(self, xs, xt, src_moments=None, trg_moments=None):
+        """
+        Third-order moment matching of the batches; with RunningMoments (updated here in training), of the batches
+        plus the past samples the running moments summarize.
+        """
+        if src_moments is not None and src_moments.size > 0:
+            batch_s, batch_t = RunningMoments.batch_moments(xs), RunningMoments.batch_moments(xt)
+            HR_Xs = central_third_moment(*src_moments.combine(batch_s, len(xs)))
+            HR_Xt = central_third_moment(*trg_moments.combine(batch_t, len(xt)))
+            if self.training:
+                src_moments.update(batch_s, len(xs))
+                trg_moments.update(batch_t, len(xt))
+            return torch.mean((HR_Xs - HR_Xt) ** 2)
         xs = xs - torch.mean(xs, axis=0)
         xt = xt - torch.mean(xt, axis=0)
         xs = torch.unsqueeze(xs, axis=-1)
@@ -4,6 +4,8 @@ import math
 from torch.autograd import Function
 from torch.nn.utils import weight_norm
 import torch.nn.functional as F
+from contextlib import contextmanager
+from types import SimpleNamespace
 
 
 # from utils import weights_init
@@ -21,43 +23,39 @@ def get_backbone_class(backbone_name):
 
 ########## CNN #############################
 class CNN(nn.Module):
+    """
+    Three conv blocks of mid_channels, mid_channels * 2 and final_out_channels. Students of other depths, widths and
+    kernel sizes (see with_student_arch) set student_channels and student_kernels per block, and
+    student_features_len positions of the last block flattened into the features, in the configs.
+    """
+
     def __init__(self, configs):
         super(CNN, self).__init__()
-
-        self.conv_block1 = nn.Sequential(
-            nn.Conv1d(configs.input_channels, configs.mid_channels, kernel_size=configs.kernel_size,
-                      stride=configs.stride, bias=False, padding=(configs.kernel_size // 2)),
-            nn.BatchNorm1d(configs.mid_channels),
-            nn.ReLU(),
-            nn.MaxPool1d(kernel_size=2, stride=2, padding=1),
-            nn.Dropout(configs.dropout)
-        )
-
-        self.conv_block2 = nn.Sequential(
-            nn.Conv1d(configs.mid_channels, configs.mid_channels * 2, kernel_size=8, stride=1, bias=False, padding=4),
-            nn.BatchNorm1d(configs.mid_channels * 2),
-            nn.ReLU(),
-            nn.MaxPool1d(kernel_size=2, stride=2, padding=1)
-        )
-
-        self.conv_block3 = nn.Sequential(
-            nn.Conv1d(configs.mid_channels * 2, configs.final_out_channels, kernel_size=8, stride=1, bias=False,
-                      padding=4),
-            nn.BatchNorm1d(configs.final_out_channels),
-            nn.ReLU(),
-            nn.MaxPool1d(kernel_size=2, stride=2, padding=1),
-        )
-
-        self.adaptive_pool = nn.AdaptiveAvgPool1d(configs.features_len)
-
-        # weights_init(self.conv_block1)
-        # weights_init(self.conv_block2)
-        # weights_init(self.conv_block3)
+        channels = getattr(configs, "student_channels", None) or \
+            (configs.mid_channels, configs.mid_channels * 2, configs.final_out_channels)
+        kernels = getattr(configs, "student_kernels", None) or (configs.kernel_size, 8, 8)
+        # run in order by forward(); the ones before first_block are skipped (see from_prefix_activations)
+        self.blocks = tuple("conv_block{}".format(i + 1) for i in range(len(channels)))
+
+        in_channels = configs.input_channels
+        for i, (out_channels, kernel_size) in enumerate(zip(channels, kernels)):
+            layers = [nn.Conv1d(in_channels, out_channels, kernel_size=kernel_size,
+                                stride=configs.stride if i == 0 else 1, bias=False, padding=(kernel_size // 2)),
+                      nn.BatchNorm1d(out_channels),
+                      nn.ReLU(),
+                      nn.MaxPool1d(kernel_size=2, stride=2, padding=1)]
+            if i == 0:
+                layers.append(nn.Dropout(configs.dropout))
+            setattr(self, self.blocks[i], nn.Sequential(*layers))
+            in_channels = out_channels
+
+        self.adaptive_pool = nn.AdaptiveAvgPool1d(getattr(configs, "student_features_len", configs.features_len))
+        self.first_block = 0
 
     def forward(self, x_in):
-        x = self.conv_block1(x_in)
-        x = self.conv_block2(x)
-        x = self.conv_block3(x)
+        x = x_in
+        for name in self.blocks[self.first_block:]:
+            x = getattr(self, name)(x)
         x = self.adaptive_pool(x)
         x_flat = x.reshape(x.shape[0], -1)
         return x_flat
@@ -458,6 +456,147 @@ class RESNET1D_WANG(nn.Module):
         x_flat = x.reshape(x.shape[0], -1)
         return x_flat
 
+########## Joint source/target forward #####################
+class DomainBatchNorm1d(nn.BatchNorm1d):
+    """
+    BatchNorm1d that normalizes the source and target parts of a concatenated batch separately
+    (see joint_forward), so one forward pass behaves like two separate ones. With domain_specific=True
+    the source part keeps its own running statistics (running_mean_src / running_var_src) and the
+    standard running statistics are the target ones; the affine parameters are shared.
+    Outside joint_forward it behaves as a plain BatchNorm1d.
+    """
+
+    def __init__(self, num_features, eps=1e-5, momentum=0.1, affine=True, track_running_stats=True,
+                 domain_specific=False):
+        super(DomainBatchNorm1d, self).__init__(num_features, eps, momentum, affine, track_running_stats)
+        self.domain_specific = domain_specific and track_running_stats
+        self.domain_sizes = None
+        if self.domain_specific:
+            self.register_buffer("running_mean_src", torch.zeros(num_features))
+            self.register_buffer("running_var_src", torch.ones(num_features))
+
+    @classmethod
+    def from_batchnorm(cls, bn, domain_specific=False):
+        new_bn = cls(bn.num_features, bn.eps, bn.momentum, bn.affine, bn.track_running_stats, domain_specific)
+        if bn.affine:
+            new_bn.weight, new_bn.bias = bn.weight, bn.bias
+        if bn.track_running_stats:
+            new_bn.running_mean, new_bn.running_var = bn.running_mean, bn.running_var
+            new_bn.num_batches_tracked = bn.num_batches_tracked
+        if new_bn.domain_specific:
+            new_bn.running_mean_src = bn.running_mean.clone()
+            new_bn.running_var_src = bn.running_var.clone()
+        return new_bn
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of plain BatchNorm1d layers have no source statistics: start them from the shared ones
+        if self.domain_specific:
+            for name in ("running_mean", "running_var"):
+                if prefix + name + "_src" not in state_dict and prefix + name in state_dict:
+                    state_dict[prefix + name + "_src"] = state_dict[prefix + name].clone()
+        super(DomainBatchNorm1d, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _normalize(self, x, running_mean, running_var):
+        momentum = 0.0 if self.momentum is None else self.momentum
+        if self.training and self.track_running_stats:
+            self.num_batches_tracked.add_(1)
+            if self.momentum is None:
+                momentum = 1.0 / float(self.num_batches_tracked)
+        return F.batch_norm(x, running_mean, running_var, self.weight, self.bias,
+                            self.training or not self.track_running_stats, momentum, self.eps)
+
+    def forward(self, input):
+        if self.domain_sizes is None or not (self.training or self.domain_specific):
+            return super(DomainBatchNorm1d, self).forward(input)
+        self._check_input_dim(input)
+
+        if self.domain_specific:
+            stats = [(self.running_mean_src, self.running_var_src), (self.running_mean, self.running_var)]
+        else:
+            stats = [(self.running_mean, self.running_var)] * 2
+        chunks = torch.split(input, list(self.domain_sizes), dim=0)
+        out = [self._normalize(chunk, mean, var) for chunk, (mean, var) in zip(chunks, stats) if len(chunk) > 0]
+        return out[0] if len(out) == 1 else torch.cat(out, dim=0)
+
+
+def convert_domain_batchnorm(module, domain_specific=False):
+    """Replace the BatchNorm1d layers of `module` (in place) by DomainBatchNorm1d layers sharing their parameters."""
+    for name, child in module.named_children():
+        if isinstance(child, nn.BatchNorm1d) and not isinstance(child, DomainBatchNorm1d):
+            setattr(module, name, DomainBatchNorm1d.from_batchnorm(child, domain_specific))
+        else:
+            convert_domain_batchnorm(child, domain_specific)
+    return module
+
+
+@contextmanager
+def domain_split(module, domain_sizes):
+    """Within this context the DomainBatchNorm1d layers of `module` see batches as (source, target) chunks."""
+    layers = [m for m in module.modules() if isinstance(m, DomainBatchNorm1d)]
+    for layer in layers:
+        layer.domain_sizes = domain_sizes
+    try:
+        yield
+    finally:
+        for layer in layers:
+            layer.domain_sizes = None
+
+
+def joint_forward(module, src_x, trg_x):
+    """Run `module` once on the concatenated source and target batch; returns the (source, target) outputs."""
+    domain_sizes = [len(src_x), len(trg_x)]
+    with domain_split(module, domain_sizes):
+        out = module(torch.cat((src_x, trg_x), dim=0))
+    return torch.split(out, domain_sizes, dim=0)
+
+
+def freeze_prefix(backbone, last_block):
+    """Freeze the blocks of a backbone with sequential `blocks` (e.g. CNN) up to last_block; returns their number."""
+    blocks = getattr(backbone, "blocks", None)
+    if blocks is None:
+        raise ValueError("{} has no sequential blocks to freeze".format(type(backbone).__name__))
+    if last_block not in blocks:
+        raise ValueError("Unknown block {}, expected one of {}".format(last_block, blocks))
+    num_blocks = blocks.index(last_block) + 1
+    for name in blocks[:num_blocks]:
+        getattr(backbone, name).requires_grad_(False)
+    return num_blocks
+
+
+def run_prefix(backbone, num_blocks, x):
+    """Output of the first num_blocks blocks of the backbone."""
+    for name in backbone.blocks[:num_blocks]:
+        x = getattr(backbone, name)(x)
+    return x
+
+
+@contextmanager
+def from_prefix_activations(backbone, num_blocks):
+    """Within this context the backbone takes the outputs of its first num_blocks blocks (e.g. cached) as input."""
+    if num_blocks == 0:
+        yield
+        return
+    backbone.first_block = num_blocks
+    try:
+        yield
+    finally:
+        backbone.first_block = 0
+
+
+def network_from_checkpoint(checkpoint, backbone="CNN"):
+    """
+    nn.Sequential(backbone, classifier) of a checkpoint saved by save_checkpoint (or the teacher registry), built
+    from its configs (widths included) and loaded with its network_dict.
+    """
+    configs = SimpleNamespace(**checkpoint["configs"])
+    hparams = checkpoint.get("hparams", {})
+    feature_extractor = convert_domain_batchnorm(get_backbone_class(backbone)(configs),
+                                                 hparams.get("domain_specific_bn", False))
+    network = nn.Sequential(feature_extractor, classifier(configs))
+    network.load_state_dict(checkpoint["network_dict"])
+    return network
+
+
 ##################################################
 ##########  OTHER NETWORKS  ######################
 ##################################################
@@ -522,7 +661,7 @@ class Discriminator_t(nn.Module):
         return out
 
 class Discriminator_fea(nn.Module):
-    """Discriminator model for source domain."""
+    """Discriminator between teacher and (adapted) student features; returns logits."""
 
     def __init__(self, configs):
         """Init discriminator."""
@@ -534,7 +673,6 @@ class Discriminator_fea(nn.Module):
             nn.Linear(configs.disc_hid_dim, configs.disc_hid_dim),
             nn.ReLU(),
             nn.Linear(configs.disc_hid_dim, 1),
-            nn.Sigmoid(),
         )
 
     def forward(self, input):
@@ -571,11 +709,18 @@ class ReverseLayerF(Function):
 
 #### Codes required by CDAN ##############
 class RandomLayer(nn.Module):
+    """Randomized multilinear map of CDAN: fixed random projections of each input, multiplied elementwise."""
+
     def __init__(self, input_dim_list=[], output_dim=1024):
         super(RandomLayer, self).__init__()
         self.input_num = len(input_dim_list)
         self.output_dim = output_dim
-        self.random_matrix = [torch.randn(input_dim_list[i], output_dim) for i in range(self.input_num)]
+        for i in range(self.input_num):
+            self.register_buffer("random_matrix_{}".format(i), torch.randn(input_dim_list[i], output_dim))
+
+    @property
+    def random_matrix(self):
+        return [getattr(self, "random_matrix_{}".format(i)) for i in range(self.input_num)]
 
     def forward(self, input_list):
         return_list = [torch.mm(input_list[i], self.random_matrix[i]) for i in range(self.input_num)]
@@ -584,22 +729,20 @@ class RandomLayer(nn.Module):
             return_tensor = torch.mul(return_tensor, single)
         return return_tensor
 
-    def cuda(self):
-        super(RandomLayer, self).cuda()
-        self.random_matrix = [val.cuda() for val in self.random_matrix]
-
 
 class Discriminator_CDAN(nn.Module):
     """Discriminator model for CDAN ."""
 
-    def __init__(self, configs):
-        """Init discriminator."""
+    def __init__(self, configs, input_dim=None):
+        """Init discriminator. input_dim defaults to the width of the feature x prediction outer product."""
         super(Discriminator_CDAN, self).__init__()
 
         self.restored = False
+        if input_dim is None:
+            input_dim = configs.features_len * configs.final_out_channels * configs.num_classes
 
         self.layer = nn.Sequential(
-            nn.Linear(configs.features_len * configs.final_out_channels * configs.num_classes, configs.disc_hid_dim),
+            nn.Linear(input_dim, configs.disc_hid_dim),
             nn.ReLU(),
             nn.Linear(configs.disc_hid_dim, configs.disc_hid_dim),
             nn.ReLU(),
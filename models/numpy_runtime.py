@@ -0,0 +1,98 @@
+"""
+PyTorch-free inference of the CNN student (CNN + classifier) exported by models.export.export_numpy. Only NumPy is
+imported, so the runtime loads in milliseconds on devices without torch:
+
+    from models.numpy_runtime import NumpyCNN
+    model = NumpyCNN.load("model.npz")
+    logits = model(windows)  # (N, input_channels, sequence_len) float32
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+FORMAT_VERSION = 1
+
+
+def conv1d(x, weight, bias, stride, padding):
+    """
+    Conv1d of channel-last windows x (N, L, C) with weight (C * K, O) as an im2col matrix product; returns (N, L', O).
+    """
+    n, _, channels = x.shape
+    if padding:
+        x = np.pad(x, ((0, 0), (padding, padding), (0, 0)))
+    kernel_size = weight.shape[0] // channels
+    # (N, L', C, K) view of the receptive fields, copied once into the im2col matrix
+    cols = sliding_window_view(x, kernel_size, axis=1)[:, ::stride]
+    length = cols.shape[1]
+    out = cols.reshape(n * length, channels * kernel_size) @ weight
+    out += bias
+    return out.reshape(n, length, -1)
+
+
+def max_pool1d(x, kernel_size, stride, padding):
+    """MaxPool1d of channel-last x (N, L, C), padded with -inf as torch does."""
+    if padding:
+        x = np.pad(x, ((0, 0), (padding, padding), (0, 0)), constant_values=-np.inf)
+    if kernel_size == stride:  # non-overlapping windows, as in the CNN
+        length = (x.shape[1] - kernel_size) // stride + 1
+        return x[:, :length * kernel_size].reshape(x.shape[0], length, kernel_size, -1).max(axis=2)
+    return sliding_window_view(x, kernel_size, axis=1)[:, ::stride].max(axis=-1)
+
+
+def adaptive_avg_pool1d(x, output_size):
+    """AdaptiveAvgPool1d of channel-last x (N, L, C), with the bins of torch."""
+    length = x.shape[1]
+    if output_size == 1:
+        return x.mean(axis=1, keepdims=True)
+    starts = [(i * length) // output_size for i in range(output_size)]
+    ends = [-(-(i + 1) * length // output_size) for i in range(output_size)]  # ceil
+    return np.stack([x[:, start:end].mean(axis=1) for start, end in zip(starts, ends)], axis=1)
+
+
+class NumpyCNN:
+    """
+    Conv1d(+folded BatchNorm) -> ReLU -> MaxPool1d blocks, AdaptiveAvgPool1d and the Linear classifier, computed in
+    float32 on channel-last activations.
+    """
+
+    def __init__(self, arrays):
+        if int(arrays["format_version"]) != FORMAT_VERSION:
+            raise ValueError("Unsupported NumPy model format {}".format(int(arrays["format_version"])))
+        self.blocks = []
+        for i in range(int(arrays["num_blocks"])):
+            weight = np.asarray(arrays["block{}.weight".format(i)], dtype=np.float32)
+            out_channels, in_channels, kernel_size = weight.shape
+            # (O, C, K) -> (C * K, O), the row order of the im2col matrix
+            weight = np.ascontiguousarray(weight.reshape(out_channels, in_channels * kernel_size).T)
+            config = [int(v) for v in arrays["block{}.config".format(i)]]  # stride, padding, pool kernel/stride/padding
+            self.blocks.append((weight, np.asarray(arrays["block{}.bias".format(i)], dtype=np.float32),
+                                *config))
+        self.features_len = int(arrays["features_len"])
+        self.fc_weight = np.ascontiguousarray(np.asarray(arrays["fc.weight"], dtype=np.float32).T)
+        self.fc_bias = np.asarray(arrays["fc.bias"], dtype=np.float32)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays)
+
+    def features(self, x):
+        x = np.ascontiguousarray(np.asarray(x, dtype=np.float32).transpose(0, 2, 1))
+        for weight, bias, stride, padding, pool_kernel, pool_stride, pool_padding in self.blocks:
+            x = conv1d(x, weight, bias, stride, padding)
+            np.maximum(x, 0, out=x)
+            x = max_pool1d(x, pool_kernel, pool_stride, pool_padding)
+        x = adaptive_avg_pool1d(x, self.features_len)
+        # flattened channel-major, as x.reshape(N, -1) of the (N, C, features_len) torch features
+        return x.transpose(0, 2, 1).reshape(x.shape[0], -1)
+
+    def forward(self, x):
+        return self.features(x) @ self.fc_weight + self.fc_bias
+
+    def __call__(self, x, batch_size=256):
+        """Logits of the windows x (N, input_channels, sequence_len), computed batch_size windows at a time."""
+        if len(x) <= batch_size:
+            return self.forward(x)
+        return np.concatenate([self.forward(x[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+
+    def predict(self, x, batch_size=256):
+        return self(x, batch_size).argmax(axis=1)
@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from models.models import run_prefix
+from models.teacher import frozen_teacher_outputs
+
+
+class PrefixActivationCache(object):
+    """
+    Outputs of the frozen prefix of a backbone (see models.freeze_prefix) on the source and target training sets,
+    and of the frozen teacher on its domains, computed once in eval mode and stored in half precision, in memory or
+    in memory-mapped .npy files under cache_dir.
+    batches() replaces one epoch of the training loaders, yielding (((src_act, src_y), (trg_act, trg_y)),
+    teacher_outputs) like AsyncTeacher; run the student under from_prefix_activations.
+    """
+
+    def __init__(self, backbone, num_blocks, src_dl, trg_dl, device, network_t=None, teacher_domains=(),
+                 cache_dir=None, dtype=torch.float16):
+        self.device = device
+        self.dtype = dtype
+        self.cache_dir = cache_dir
+        self.loaders = {"src": src_dl, "trg": trg_dl}
+        self.teacher_domains = teacher_domains if network_t is not None else ()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        training = [getattr(backbone, name).training for name in backbone.blocks[:num_blocks]]
+        for name in backbone.blocks[:num_blocks]:
+            getattr(backbone, name).eval()
+        if network_t is not None:
+            network_t.eval()
+        self.arrays = {domain: self._compute(domain, loader, backbone, num_blocks, network_t)
+                       for domain, loader in self.loaders.items()}
+        for name, mode in zip(backbone.blocks[:num_blocks], training):
+            getattr(backbone, name).train(mode)
+
+    def _allocate(self, domain, name, shape, dtype):
+        if not self.cache_dir:
+            return torch.empty(shape, dtype=dtype)
+        path = os.path.join(self.cache_dir, f"{domain}_{name}.npy")
+        np_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+        return torch.from_numpy(np.lib.format.open_memmap(path, mode="w+", dtype=np_dtype, shape=shape))
+
+    def _compute(self, domain, loader, backbone, num_blocks, network_t):
+        dataset = loader.dataset
+        ordered = DataLoader(dataset, batch_size=loader.batch_size, shuffle=False, drop_last=False)
+        arrays, start = {}, 0
+        with torch.no_grad():
+            for x, y in ordered:
+                x = x.float().to(self.device)
+                outputs = {"x": run_prefix(backbone, num_blocks, x), "y": y.long()}
+                if domain in self.teacher_domains:
+                    outputs["feat_t"], outputs["pred_t"] = frozen_teacher_outputs(network_t, x, x, (domain,))[domain]
+                for name, out in outputs.items():
+                    if name not in arrays:
+                        dtype = torch.long if name == "y" else self.dtype
+                        arrays[name] = self._allocate(domain, name, (len(dataset),) + tuple(out.shape[1:]), dtype)
+                    arrays[name][start:start + len(x)] = out.cpu()
+                start += len(x)
+        return arrays
+
+    def nbytes(self):
+        return sum(a.element_size() * a.nelement() for arrays in self.arrays.values() for a in arrays.values())
+
+    def _index_batches(self, domain):
+        loader = self.loaders[domain]
+        n = len(self.arrays[domain]["y"])
+        order = torch.randperm(n) if isinstance(loader.sampler, torch.utils.data.RandomSampler) else torch.arange(n)
+        num_batches = n // loader.batch_size if loader.drop_last else -(-n // loader.batch_size)
+        return [order[i * loader.batch_size:(i + 1) * loader.batch_size] for i in range(num_batches)]
+
+    def _get(self, domain, name, idx):
+        out = self.arrays[domain][name][idx].to(self.device)
+        return out if name == "y" else out.float()
+
+    def batches(self):
+        for src_idx, trg_idx in zip(self._index_batches("src"), self._index_batches("trg")):
+            batch = ((self._get("src", "x", src_idx), self._get("src", "y", src_idx)),
+                     (self._get("trg", "x", trg_idx), self._get("trg", "y", trg_idx)))
+            teacher_outputs = None
+            if self.teacher_domains:
+                teacher_outputs = {domain: (self._get(domain, "feat_t", idx), self._get(domain, "pred_t", idx))
+                                   for domain, idx in (("src", src_idx), ("trg", trg_idx))
+                                   if domain in self.teacher_domains}
+            yield batch, teacher_outputs
@@ -0,0 +1,131 @@
+import json
+import os
+
+import torch
+from torch import nn
+
+from models.teacher import GroupedLinear
+from utils import count_parameters, measure_latency
+
+
+def _macs_flops(layer, inputs, output):
+    """Analytic (MACs, FLOPs) of a leaf layer from its input and output shapes."""
+    out_numel = output.numel()
+    in_numel = inputs[0].numel() if inputs and torch.is_tensor(inputs[0]) else 0
+    if isinstance(layer, nn.Conv1d):
+        macs = out_numel * layer.in_channels // layer.groups * layer.kernel_size[0]
+        return macs, 2 * macs + (out_numel if layer.bias is not None else 0)
+    if isinstance(layer, nn.Linear):
+        macs = out_numel * layer.in_features
+        return macs, 2 * macs + (out_numel if layer.bias is not None else 0)
+    if isinstance(layer, GroupedLinear):
+        # K linear layers of weight (K, in, out): output (N, K, out)
+        macs = out_numel * layer.weight.shape[1]
+        return macs, 2 * macs + out_numel
+    if isinstance(layer, nn.modules.batchnorm._BatchNorm):
+        return out_numel, 2 * out_numel  # scale and shift
+    if isinstance(layer, (nn.MaxPool1d, nn.AvgPool1d)):
+        kernel_size = layer.kernel_size if isinstance(layer.kernel_size, int) else layer.kernel_size[0]
+        return 0, out_numel * kernel_size
+    if isinstance(layer, (nn.AdaptiveAvgPool1d, nn.AdaptiveMaxPool1d)):
+        return 0, in_numel
+    if isinstance(layer, (nn.ReLU, nn.LeakyReLU, nn.Sigmoid, nn.Tanh, nn.GELU)):
+        return 0, out_numel
+    return 0, 0
+
+
+def layer_profile(model, input_shape, device):
+    """
+    Per leaf layer of model on an input of input_shape: output shape, parameters, MACs and FLOPs (from the layer
+    shapes: Conv1d, Linear, GroupedLinear, BatchNorm, pooling and activations; functional ops such as residual
+    additions are not counted) and output activation size in bytes.
+    """
+    layers = []
+
+    def hook(layer, inputs, output):
+        if not torch.is_tensor(output):
+            return
+        macs, flops = _macs_flops(layer, inputs, output)
+        layers.append({"layer": names[layer], "type": type(layer).__name__, "output_shape": tuple(output.shape),
+                       "params": sum(p.numel() for p in layer.parameters(recurse=False)), "macs": macs,
+                       "flops": flops, "activation_bytes": output.numel() * output.element_size()})
+
+    names = {m: name for name, m in model.named_modules() if not list(m.children())}
+    handles = [m.register_forward_hook(hook) for m in names]
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(torch.zeros(*input_shape, device=device))
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(was_training)
+    return layers
+
+
+def count_flops(model, *inputs):
+    """Analytic FLOPs of model on inputs (see layer_profile)."""
+    flops = []
+
+    def hook(layer, layer_inputs, output):
+        if torch.is_tensor(output):
+            flops.append(_macs_flops(layer, layer_inputs, output)[1])
+
+    handles = [m.register_forward_hook(hook) for m in model.modules() if not list(m.children())]
+    try:
+        with torch.no_grad():
+            model(*inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return sum(flops)
+
+
+def profile_model(model, input_shape, device, batch_sizes=(1, 32, 256), iters=20, warmup=5):
+    """
+    Parameters, per-window MACs, FLOPs and activation memory of model (input_shape excludes the batch dimension),
+    and its CPU latency (ms per batch) at each of batch_sizes. Returns (summary, layers).
+    """
+    layers = layer_profile(model, (1,) + tuple(input_shape), device)
+    summary = {"params": count_parameters(model),
+               "macs": sum(layer["macs"] for layer in layers),
+               "flops": sum(layer["flops"] for layer in layers),
+               "activation_mb": sum(layer["activation_bytes"] for layer in layers) / 2 ** 20,
+               "peak_activation_mb": max(layer["activation_bytes"] for layer in layers) / 2 ** 20}
+    # timed on the CPU, the model is moved back afterwards (deepcopy fails on hook-based weight_norm)
+    cpu = torch.device("cpu")
+    model.to(cpu)
+    try:
+        for batch_size in batch_sizes:
+            summary["latency_ms_bs{}".format(batch_size)] = measure_latency(model, (batch_size,) + tuple(input_shape),
+                                                                            cpu, iters=iters, warmup=warmup)
+    finally:
+        model.to(device)
+    return summary, layers
+
+
+def compare_profiles(teacher, student):
+    """Compression ratios (teacher / student) of the parameters and FLOPs, and speedups of the latencies."""
+    comparison = {"params_compression": teacher["params"] / student["params"],
+                  "flops_compression": teacher["flops"] / student["flops"]}
+    for key in teacher:
+        if key.startswith("latency_ms_") and key in student:
+            comparison["speedup_" + key[len("latency_ms_"):]] = teacher[key] / student[key]
+    return comparison
+
+
+def log_profiles(networks, input_shape, device, log_dir, logger=None, batch_sizes=(1, 32, 256)):
+    """
+    Profile the networks ({name: network}, e.g. teacher and student) of a run, save model_profile.json in log_dir
+    and log the summaries, with the compression and speedup of the student over the teacher when both are given.
+    """
+    profiles = {name: profile_model(network, input_shape, device, batch_sizes)[0] for name, network in networks.items()}
+    if "teacher" in profiles and "student" in profiles:
+        profiles["student_vs_teacher"] = compare_profiles(profiles["teacher"], profiles["student"])
+    with open(os.path.join(log_dir, "model_profile.json"), "w") as f:
+        json.dump(profiles, f, indent=2)
+    if logger is not None:
+        for name, profile in profiles.items():
+            logger.debug(f'{name}: ' + ', '.join(f'{key}={value:.4g}' for key, value in profile.items()))
+    return profiles
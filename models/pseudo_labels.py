@@ -0,0 +1,74 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+
+class PseudoLabelStore(object):
+    """
+    Last prediction of every sample of the target training set, keyed by dataset index (see
+    Load_Dataset(return_index=True)): label, confidence (max softmax probability) and the epoch it was computed at
+    (-1: never). It is refreshed incrementally from the target logits update() computes anyway (through the
+    PseudoLabelBatch fields of batch()), and, with refresh_every=k > 0, by a full eval-mode pass every k epochs.
+    """
+
+    def __init__(self, num_samples, device, threshold=0.9, refresh_every=0):
+        self.device = device
+        self.threshold = threshold
+        self.refresh_every = refresh_every
+        self.labels = torch.full((num_samples,), -1, dtype=torch.long, device=device)
+        self.confidence = torch.zeros(num_samples, device=device)
+        self.epoch = torch.full((num_samples,), -1, dtype=torch.long, device=device)
+
+    @torch.no_grad()
+    def update(self, idx, logits, epoch):
+        confidence, labels = F.softmax(logits.detach().float(), dim=1).max(dim=1)
+        idx = idx.to(self.device)
+        self.labels[idx] = labels.to(self.device)
+        self.confidence[idx] = confidence.to(self.device)
+        self.epoch[idx] = epoch
+
+    def select(self, idx, threshold=None):
+        """Stored labels of the samples idx and the mask of those predicted with confidence >= threshold."""
+        threshold = self.threshold if threshold is None else threshold
+        idx = idx.to(self.device)
+        labels = self.labels[idx]
+        return labels, (labels >= 0) & (self.confidence[idx] >= threshold)
+
+    def batch(self, idx, epoch):
+        """Pseudo-label field of the target batch idx, passed to update() as pseudo_labels."""
+        return PseudoLabelBatch(self, idx, epoch)
+
+    def refresh_due(self, epoch):
+        return self.refresh_every > 0 and epoch % self.refresh_every == 0
+
+    @torch.no_grad()
+    def refresh(self, network, data_loader, epoch):
+        """Recompute all predictions with network in eval mode, data_loader yielding (x, y, index)."""
+        ordered = DataLoader(data_loader.dataset, batch_size=data_loader.batch_size, shuffle=False, drop_last=False)
+        training = network.training
+        network.eval()
+        for x, _, idx in ordered:
+            self.update(idx, network(x.float().to(self.device)), epoch)
+        network.train(training)
+
+    def stats(self):
+        """Share of the samples with a pseudo-label and of those above the threshold, for logging."""
+        labeled = self.labels >= 0
+        return {'pseudo_label_coverage': labeled.float().mean().item(),
+                'pseudo_label_selected': (labeled & (self.confidence >= self.threshold)).float().mean().item()}
+
+
+class PseudoLabelBatch(object):
+    """
+    Pseudo-labels of a target batch as stored before update(): labels and the confidence mask of select().
+    observe(logits) writes the batch predictions of update() back to the store.
+    """
+
+    def __init__(self, store, idx, epoch):
+        self.store = store
+        self.idx = idx
+        self.epoch = epoch
+        self.labels, self.mask = store.select(idx)
+
+    def observe(self, logits):
+        self.store.update(self.idx, logits, self.epoch)
@@ -0,0 +1,67 @@
+import copy
+import itertools
+
+import torch
+from torch import nn
+
+try:
+    from torch.fx import symbolic_trace
+    from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+except ImportError as e:
+    raise ImportError("INT8 quantization uses FX graph mode quantization with QConfigMapping, which requires "
+                      "PyTorch >= 1.13 (found {})".format(torch.__version__)) from e
+
+from models.export import fuse_for_inference
+
+
+def calibration_batches(data_loader, num_batches):
+    """Inputs of the first num_batches batches of a (possibly unlabeled, e.g. target training) data loader."""
+    for batch in itertools.islice(data_loader, num_batches):
+        x = batch[0] if isinstance(batch, (tuple, list)) else batch
+        yield x.float()
+
+
+def _drop_identities(module):
+    """FX graph of module without the nn.Identity left by BatchNorm folding, so Conv1d and ReLU get fused."""
+    graph_module = symbolic_trace(module)
+    for node in list(graph_module.graph.nodes):
+        if node.op == "call_module" and isinstance(graph_module.get_submodule(node.target), nn.Identity):
+            node.replace_all_uses_with(node.args[0])
+            graph_module.graph.erase_node(node)
+    graph_module.graph.lint()
+    graph_module.delete_all_unused_submodules()
+    graph_module.recompile()
+    return graph_module
+
+
+def quantize_static(network, batches, backend="fbgemm", dynamic_head=True):
+    """
+    Post-training INT8 quantization (CPU) of nn.Sequential(feature_extractor, classifier), after BatchNorm folding
+    (models.export.fuse_for_inference). The feature extractor is statically quantized through FX graph mode, so
+    residual additions of the ResNets are handled, with activation ranges observed on the calibration batches.
+    With dynamic_head the Linear classifier is dynamically quantized (weights INT8, activations quantized on the
+    fly), otherwise it is statically quantized with the rest.
+    """
+    torch.backends.quantized.engine = backend
+    fused = fuse_for_inference(network).cpu()
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    batches = iter(batches)
+    example = next(batches)
+
+    model = fused[0] if dynamic_head else fused
+    prepared = prepare_fx(_drop_identities(copy.deepcopy(model)), qconfig_mapping, (example,))
+    with torch.no_grad():
+        for x in itertools.chain([example], batches):
+            prepared(x)
+    quantized = convert_fx(prepared)
+
+    if not dynamic_head:
+        return quantized
+    classifier = quantize_dynamic(fused[1], {nn.Linear}, dtype=torch.qint8)
+    return nn.Sequential(quantized, classifier)
+
+
+def quantize_dynamic_heads(network):
+    """Fallback without calibration data: only the Linear layers are (dynamically) quantized, after BatchNorm folding."""
+    return quantize_dynamic(fuse_for_inference(network).cpu(), {nn.Linear}, dtype=torch.qint8)
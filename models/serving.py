@@ -0,0 +1,104 @@
+import asyncio
+import collections
+import time
+
+import numpy as np
+import torch
+
+# torch.inference_mode appeared in torch 1.9
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+
+class ServingMetrics(object):
+    """Latency percentiles (over the last window requests), throughput and batch sizes of a MicroBatcher."""
+
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.start = time.perf_counter()
+        self.requests = self.windows = self.batches = 0
+
+    def record_batch(self, latencies, num_windows):
+        self.latencies.extend(latencies)
+        self.requests += len(latencies)
+        self.windows += num_windows
+        self.batches += 1
+
+    def reset(self):
+        self.__init__(self.latencies.maxlen)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        latencies = np.array(self.latencies) * 1e3
+        percentiles = np.percentile(latencies, [50, 99]) if len(latencies) else [float("nan")] * 2
+        return {"requests": self.requests, "windows": self.windows, "batches": self.batches,
+                "mean_batch_windows": self.windows / max(self.batches, 1),
+                "latency_p50_ms": float(percentiles[0]), "latency_p99_ms": float(percentiles[1]),
+                "requests_per_s": self.requests / elapsed, "windows_per_s": self.windows / elapsed}
+
+
+class MicroBatcher(object):
+    """
+    Coalesces concurrent predict() calls of an asyncio server into micro-batches: a batch starts with the first
+    waiting request and closes when it holds max_batch_size windows or max_latency_ms after that request arrived.
+    The network runs in a worker thread, so requests keep queueing while a batch is computed.
+    """
+
+    def __init__(self, network, device, max_batch_size=64, max_latency_ms=5.0):
+        self.network = network.to(device).eval()
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1e3
+        self.metrics = ServingMetrics()
+        self.queue = None
+        self.worker = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+
+    async def predict(self, x):
+        """Logits (N, num_classes) of the windows x (N, C, L)."""
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((x, future, time.perf_counter()))
+        return await future
+
+    def forward(self, x):
+        with inference_mode():
+            return self.network(x.to(self.device)).cpu()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            requests = [await self.queue.get()]
+            num_windows = len(requests[0][0])
+            deadline = requests[0][2] + self.max_latency
+            while num_windows < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                num_windows += len(request[0])
+
+            try:
+                logits = await loop.run_in_executor(None, self.forward, torch.cat([x for x, _, _ in requests]))
+            except Exception as e:  # fail the requests of the batch, keep serving
+                for _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            for (x, future, _), out in zip(requests, logits.split([len(x) for x, _, _ in requests])):
+                if not future.done():
+                    future.set_result(out)
+            self.metrics.record_batch([end - arrival for _, _, arrival in requests], num_windows)
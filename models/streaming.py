@@ -0,0 +1,154 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from models.export import fuse_for_inference
+
+
+class _CausalConv(object):
+    """
+    Dilated causal Conv1d (BatchNorm folded) that keeps the last (kernel_size - 1) * dilation input samples of the
+    stream, i.e. the left context the zero padding + Chomp1d of the TCN provides at the start of a window.
+    """
+
+    def __init__(self, conv):
+        self.conv = conv
+        self.context = (conv.kernel_size[0] - 1) * conv.dilation[0]
+        self.state = None
+
+    def reset(self, batch_size, device):
+        # zeros, as the padding of a window starting with the stream
+        self.state = torch.zeros(batch_size, self.conv.in_channels, self.context, device=device)
+
+    def __call__(self, x):
+        x = torch.cat([self.state, x], dim=2)
+        self.state = x[:, :, -self.context:]
+        return F.conv1d(x, self.conv.weight, self.conv.bias, dilation=self.conv.dilation)
+
+
+class StreamingTCN(nn.Module):
+    """
+    Stateful inference of a trained TCN (and optionally its classifier) over continuous streams. Each call of step()
+    with the next hop samples (N, C_in, hop) of N streams returns the output of TCN.forward for the window ending at
+    the last of them, computing every layer only on the new samples plus its buffered past inputs, so the cost of a
+    step grows with hop instead of with the window length. The outputs equal the windowed ones once the stream is
+    longer than the receptive field (1 + 6 * (kernel_size - 1) samples, < sequence_len for all datasets).
+    """
+
+    def __init__(self, tcn, classifier=None):
+        super(StreamingTCN, self).__init__()
+        tcn = fuse_for_inference(tcn)
+        self.blocks = nn.ModuleList([tcn.conv_block1, tcn.conv_block2])
+        self.downsamples = nn.ModuleList([nn.Identity() if tcn.downsample0 is None else tcn.downsample0,
+                                          nn.Identity() if tcn.downsample1 is None else tcn.downsample1])
+        self.classifier = None if classifier is None else fuse_for_inference(classifier)
+        self.convs = [[_CausalConv(m) for m in block if isinstance(m, nn.Conv1d)] for block in self.blocks]
+        self.receptive_field = 1 + sum(conv.context for convs in self.convs for conv in convs)
+
+    def reset(self, batch_size=1, device=None):
+        """Start batch_size new streams."""
+        device = device or self.convs[0][0].conv.weight.device
+        for convs in self.convs:
+            for conv in convs:
+                conv.reset(batch_size, device)
+
+    @torch.no_grad()
+    def step(self, x, all_positions=False):
+        """
+        Output at the last sample of the chunk x (N, C_in, hop), or at all its samples (N, ..., hop) with
+        all_positions.
+        """
+        if self.convs[0][0].state is None or self.convs[0][0].state.size(0) != x.size(0):
+            self.reset(x.size(0), x.device)
+        for convs, downsample in zip(self.convs, self.downsamples):
+            h = x
+            for conv in convs:
+                h = F.relu(conv(h))
+            x = F.relu(h + downsample(x))
+        out = x if all_positions else x[:, :, -1]
+        if self.classifier is not None:
+            out = self.classifier(out.transpose(1, 2)).transpose(1, 2) if all_positions else self.classifier(out)
+        return out
+
+    def forward(self, stream, hop):
+        """Outputs (N, ..., L // hop) of a new stream (N, C_in, L) fed hop samples at a time."""
+        self.reset(stream.size(0), stream.device)
+        return torch.stack([self.step(stream[:, :, t:t + hop]) for t in range(0, stream.size(2) - hop + 1, hop)],
+                           dim=-1)
+
+
+class SlidingWindowCNN(nn.Module):
+    """
+    Inference of a CNN or CNN_T (and its classifier) on all windows of window_len samples, hop samples apart, of long
+    streams: conv_block1..3 run once over each stream, and adaptive_pool + classifier on the slice of the shared
+    feature map under every window. The hop has to be a multiple of the product of the conv and pool strides
+    (alignment) so the window positions fall on the same sampling grid as in a per-window forward.
+
+    The feature positions whose receptive field lies inside the window (exact_positions) equal the per-window ones;
+    the others see the neighbouring stream samples instead of the window's zero (conv) / -inf (pool) padding, so the
+    logits approximate the per-window ones (compare with per_window_features).
+    """
+    blocks = ("conv_block1", "conv_block2", "conv_block3")
+
+    def __init__(self, feature_extractor, classifier, window_len):
+        super(SlidingWindowCNN, self).__init__()
+        self.feature_extractor = fuse_for_inference(feature_extractor)
+        self.classifier = fuse_for_inference(classifier)
+        self.window_len = window_len
+
+        layers = [m for name in self.blocks for m in getattr(self.feature_extractor, name)
+                  if isinstance(m, (nn.Conv1d, nn.MaxPool1d))]
+        conv = layers[0]
+        with torch.no_grad():
+            self.num_positions = self.conv_stack(torch.zeros(1, conv.in_channels, window_len,
+                                                             device=conv.weight.device)).size(2)
+        # window samples [lo, hi] in the receptive field of every final feature position
+        lo, hi = torch.arange(self.num_positions), torch.arange(self.num_positions)
+        self.alignment = 1
+        for layer in reversed(layers):
+            kernel_size, stride, padding, dilation = (v[0] if isinstance(v, tuple) else v for v in (
+                layer.kernel_size, layer.stride, layer.padding, layer.dilation))
+            lo, hi = lo * stride - padding, hi * stride - padding + (kernel_size - 1) * dilation
+            self.alignment *= stride
+        self.exact_positions = ((lo >= 0) & (hi < window_len)).nonzero().view(-1).tolist()
+
+    def conv_stack(self, x):
+        for name in self.blocks:
+            x = getattr(self.feature_extractor, name)(x)
+        return x
+
+    def check_hop(self, hop):
+        if hop % self.alignment:
+            raise ValueError("The hop ({}) has to be a multiple of the CNN alignment ({})".format(hop, self.alignment))
+
+    def num_windows(self, stream_len, hop):
+        return (stream_len - self.window_len) // hop + 1
+
+    @torch.no_grad()
+    def window_features(self, stream, hop):
+        """Feature maps (N, num_windows, C, num_positions) of the windows, sliced from the map of the whole stream."""
+        self.check_hop(hop)
+        num_windows = self.num_windows(stream.size(2), hop)
+        features = self.conv_stack(stream)
+        features = features.unfold(2, self.num_positions, hop // self.alignment)[:, :, :num_windows]
+        if features.size(2) < num_windows:
+            raise RuntimeError("The stream feature map does not cover the last window")
+        return features.transpose(1, 2)
+
+    @torch.no_grad()
+    def per_window_features(self, stream, hop):
+        """Reference feature maps (N, num_windows, C, num_positions), each window run through the CNN on its own."""
+        windows = stream.unfold(2, self.window_len, hop).transpose(1, 2)
+        maps = self.conv_stack(windows.reshape(-1, *windows.shape[2:]))
+        return maps.view(*windows.shape[:2], *maps.shape[1:])
+
+    @torch.no_grad()
+    def head(self, features):
+        """Logits (N, num_windows, num_classes) of window feature maps (N, num_windows, C, num_positions)."""
+        n, num_windows = features.shape[:2]
+        x = self.feature_extractor.adaptive_pool(features.reshape(n * num_windows, *features.shape[2:]))
+        return self.classifier(x.reshape(x.size(0), -1)).view(n, num_windows, -1)
+
+    def forward(self, stream, hop):
+        """Logits (N, num_windows, num_classes) of the windows of streams (N, C_in, L)."""
+        return self.head(self.window_features(stream, hop))
@@ -0,0 +1,326 @@
+import copy
+import glob
+import inspect
+import os
+import queue
+import threading
+
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+from models.models import joint_forward, convert_domain_batchnorm
+
+
+def frozen_teacher_outputs(network_t, src_x, trg_x, domains=("src", "trg")):
+    """
+    Features and logits of a frozen teacher (nn.Sequential(feature_extractor, classifier) or a TeacherEnsemble)
+    for the given domains. Returns {domain: (features, logits)}.
+    """
+    inputs = [(domain, x) for domain, x in (("src", src_x), ("trg", trg_x)) if domain in domains]
+    reduce = getattr(network_t, "reduce", None)
+    with torch.no_grad():
+        if len(inputs) == 2:
+            feats = joint_forward(network_t[0], inputs[0][1], inputs[1][1])
+        else:
+            feats = (network_t[0](inputs[0][1]),)
+        logits = torch.split(network_t[1](torch.cat(feats, dim=0)), [len(f) for f in feats], dim=0)
+        outputs = {}
+        for (domain, _), feat, pred in zip(inputs, feats, logits):
+            outputs[domain] = reduce(feat, pred) if reduce is not None else (feat, pred)
+    return outputs
+
+
+class GroupedLinear(nn.Module):
+    """K linear layers of the same shape applied as one batched matmul: (N, K * in) -> (N, K, out)."""
+
+    def __init__(self, linears):
+        super(GroupedLinear, self).__init__()
+        self.num_groups = len(linears)
+        self.weight = nn.Parameter(torch.stack([linear.weight.detach().t() for linear in linears]))
+        self.bias = nn.Parameter(torch.stack([linear.bias.detach() for linear in linears]).unsqueeze(1))
+
+    def forward(self, x):
+        x = x.reshape(x.shape[0], self.num_groups, -1).transpose(0, 1)
+        return torch.baddbmm(self.bias, x, self.weight).transpose(0, 1)
+
+
+def _fuse_modules(modules, state):
+    """Fuse K modules of identical structure into one module running the K copies side by side on the channels."""
+    module, k = modules[0], len(modules)
+    if isinstance(module, nn.Conv1d):
+        # the first convolution sees the shared input, the following ones only their own teacher's channels
+        first = state.pop("first_conv", False)
+        if first and module.groups != 1:
+            raise ValueError("The first convolution of the teachers must not be grouped")
+        fused = nn.Conv1d(module.in_channels if first else module.in_channels * k, module.out_channels * k,
+                          module.kernel_size, stride=module.stride, padding=module.padding,
+                          dilation=module.dilation, groups=module.groups if first else module.groups * k,
+                          bias=module.bias is not None, padding_mode=module.padding_mode)
+        names = ["weight", "bias"]
+    elif isinstance(module, nn.BatchNorm1d):
+        fused = nn.BatchNorm1d(module.num_features * k, eps=module.eps, momentum=module.momentum,
+                               affine=module.affine, track_running_stats=module.track_running_stats)
+        names = ["weight", "bias", "running_mean", "running_var"]
+        if module.track_running_stats:
+            fused.num_batches_tracked.copy_(module.num_batches_tracked)
+    elif isinstance(module, nn.Linear):
+        return GroupedLinear(modules)
+    elif len(list(module.children())) > 0:
+        if len(list(module.parameters(recurse=False))) > 0:
+            raise ValueError("Cannot fuse teacher modules of type {}".format(type(module).__name__))
+        fused = copy.copy(module)
+        fused._modules = module._modules.copy()
+        for name, _ in module.named_children():
+            fused._modules[name] = _fuse_modules([getattr(m, name) for m in modules], state)
+        return fused
+    elif len(list(module.parameters(recurse=False))) > 0:
+        raise ValueError("Cannot fuse teacher layers of type {}".format(type(module).__name__))
+    else:
+        return copy.deepcopy(module)
+
+    with torch.no_grad():
+        for name in names:
+            tensor = getattr(fused, name)
+            if tensor is not None:
+                tensor.copy_(torch.cat([getattr(m, name) for m in modules], dim=0))
+    return fused
+
+
+class TeacherEnsemble(nn.Sequential):
+    """
+    K frozen teachers of one architecture (nn.Sequential(feature_extractor, classifier)) fused into a single network:
+    their convolutions and batch norms are stacked along the channels (grouped convolutions after the first layer)
+    and their classifiers run as one batched matmul, so the ensemble costs about one K-times wider teacher forward.
+    self[0](x) gives the K feature vectors concatenated, self[1] the (N, K, num_classes) logits, and reduce()
+    averages both over the teachers with the optional per-teacher weights.
+    """
+
+    def __init__(self, teachers, weights=None):
+        feature_extractor = _fuse_modules([teacher[0] for teacher in teachers], {"first_conv": True})
+        classifier = _fuse_modules([teacher[1] for teacher in teachers], {})
+        super(TeacherEnsemble, self).__init__(convert_domain_batchnorm(feature_extractor), classifier)
+        self.num_teachers = len(teachers)
+        weights = torch.ones(self.num_teachers) if weights is None else torch.as_tensor(weights, dtype=torch.float)
+        if len(weights) != self.num_teachers:
+            raise ValueError("Got {} weights for {} teachers".format(len(weights), self.num_teachers))
+        self.register_buffer("weights", weights / weights.sum())
+
+    def reduce(self, feats, logits):
+        """Weighted average of the per-teacher features and logits."""
+        feats = feats.reshape(feats.shape[0], self.num_teachers, -1)
+        return torch.einsum("nkd,k->nd", feats, self.weights), torch.einsum("nkc,k->nc", logits, self.weights)
+
+    def forward(self, x):
+        feats = self[0](x)
+        return self.reduce(feats, self[1](feats))[1]
+
+
+def teacher_checkpoint_paths(patterns, teacher_dir, src_id, trg_id):
+    """
+    Teacher checkpoints of a scenario from comma-separated paths or glob patterns, relative to teacher_dir unless
+    absolute, where {src} and {trg} are replaced by the scenario domains,
+    e.g. "seed_*/{src}_to_{trg}_checkpoint.pt".
+    """
+    paths = []
+    for pattern in patterns.split(","):
+        pattern = os.path.join(teacher_dir, pattern.strip().format(src=src_id, trg=trg_id))
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError("No teacher checkpoint matches {}".format(pattern))
+        paths.extend(matches)
+    return paths
+
+
+_checkpoints = {}
+
+
+def load_checkpoint(path):
+    """
+    torch.load a checkpoint once per process (memory-mapped where supported), e.g. the teacher shared by all runs of
+    a scenario. The returned tensors are shared, copy them (load_state_dict does) before modifying.
+    """
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in _checkpoints:
+        checkpoint = None
+        if "mmap" in inspect.signature(torch.load).parameters:
+            try:
+                checkpoint = torch.load(path, map_location="cpu", mmap=True)
+            except RuntimeError:  # legacy (non-zip) serialization
+                pass
+        if checkpoint is None:
+            checkpoint = torch.load(path, map_location="cpu")
+        _checkpoints[key] = checkpoint
+    return _checkpoints[key]
+
+
+def load_teacher(network_t, checkpoint_paths, weights=None):
+    """
+    Load a single teacher checkpoint into network_t, or fuse several ones of its architecture into a TeacherEnsemble.
+    Returns the teacher network.
+    """
+    if len(checkpoint_paths) == 1:
+        network_t.load_state_dict(load_checkpoint(checkpoint_paths[0])["network_dict"])
+        return network_t
+    teachers = []
+    for path in checkpoint_paths:
+        teacher = copy.deepcopy(network_t)
+        teacher.load_state_dict(load_checkpoint(path)["network_dict"])
+        teachers.append(teacher)
+    return TeacherEnsemble(teachers, weights)
+
+
+def _to_device(batch, device):
+    (src_x, src_y), (trg_x, trg_y) = batch
+    return ((src_x.float().to(device), src_y.long().to(device)),
+            (trg_x.float().to(device), trg_y.long().to(device)))
+
+
+def _process_worker(network_t, domains, num_threads, in_queue, out_queue):
+    torch.set_num_threads(num_threads)
+    network_t.eval()
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        epoch, ((src_x, _), (trg_x, _)) = item
+        out_queue.put((epoch, frozen_teacher_outputs(network_t, src_x, trg_x, domains)))
+
+
+def _put(q, item, stop):
+    """Puts item in the bounded queue q unless stop is set first. Returns whether it was put."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+class AsyncTeacher(object):
+    """
+    Producer/consumer pipeline for a frozen teacher: a background worker runs `network_t` on upcoming
+    (source, target) batches and hands them over, with the teacher outputs, through a bounded queue, so that
+    teacher and student compute overlap.
+    backend: 'thread'  -> worker thread sharing the teacher weights; it shares the intra-op thread pool of the
+                          process with the student (the thread count is global, so num_threads does not apply)
+             'process' -> worker process holding a copy of the teacher (CPU only), with num_threads intra-op threads
+    Call it on an iterable of ((src_x, src_y), (trg_x, trg_y)) batches to get (batch, teacher_outputs) pairs.
+    """
+
+    def __init__(self, network_t, domains, device, backend="thread", num_threads=1, queue_size=2):
+        if backend not in ("thread", "process"):
+            raise ValueError("Unknown teacher backend: {}".format(backend))
+        if backend == "process" and torch.device(device).type != "cpu":
+            raise ValueError("The process teacher backend only runs on CPU, use the thread backend on {}".format(device))
+        self.network_t = network_t.eval()
+        self.domains = domains
+        self.device = device
+        self.backend = backend
+        self.num_threads = num_threads
+        self.queue_size = queue_size
+        self.worker = None
+        # batches of an epoch whose generator was abandoned are still in flight, their outputs are told apart by it
+        self.epoch = 0
+
+        if backend == "process":
+            ctx = mp.get_context("spawn")
+            self.in_queue = ctx.Queue(queue_size)
+            self.out_queue = ctx.Queue(queue_size)
+            self.worker = ctx.Process(target=_process_worker, daemon=True,
+                                      args=(network_t, domains, num_threads, self.in_queue, self.out_queue))
+            self.worker.start()
+
+    def __call__(self, batches):
+        batches = iter(batches)
+        # the first batch is fetched here so that the loaders draw their shuffling seeds in the main thread
+        first = next(batches, None)
+        if first is None:
+            return
+        batches = _chain(first, batches)
+        if self.backend == "thread":
+            yield from self._thread_pipeline(batches)
+        else:
+            yield from self._process_pipeline(batches)
+
+    def _thread_pipeline(self, batches):
+        handoff = queue.Queue(self.queue_size)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for batch in batches:
+                    batch = _to_device(batch, self.device)
+                    (src_x, _), (trg_x, _) = batch
+                    if not _put(handoff, (batch, frozen_teacher_outputs(self.network_t, src_x, trg_x, self.domains)),
+                                stop):
+                        return
+                _put(handoff, None, stop)
+            except BaseException as e:
+                _put(handoff, e, stop)
+
+        threading.Thread(target=produce, daemon=True).start()
+        try:
+            while True:
+                item = handoff.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # an abandoned generator releases the producer instead of leaving it blocked on the full queue
+            stop.set()
+
+    def _process_pipeline(self, batches):
+        pending = queue.Queue()
+        stop = threading.Event()
+        self.epoch += 1
+        epoch = self.epoch
+
+        def feed():
+            try:
+                for batch in batches:
+                    batch = _to_device(batch, "cpu")
+                    pending.put(batch)
+                    if not _put(self.in_queue, (epoch, batch), stop):
+                        return
+                pending.put(None)
+            except BaseException as e:
+                pending.put(e)
+
+        threading.Thread(target=feed, daemon=True).start()
+        try:
+            while True:
+                batch = pending.get()
+                if batch is None:
+                    return
+                if isinstance(batch, BaseException):
+                    raise batch
+                yield _to_device(batch, self.device), self._worker_output(epoch)
+        finally:
+            stop.set()
+
+    def _worker_output(self, epoch):
+        while True:
+            try:
+                output_epoch, outputs = self.out_queue.get(timeout=1.)
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    raise RuntimeError("The teacher worker exited with code {}".format(self.worker.exitcode))
+                continue
+            # outputs left over by an abandoned epoch are dropped
+            if output_epoch == epoch:
+                return outputs
+
+    def close(self):
+        if self.worker is not None:
+            self.in_queue.put(None)
+            self.worker.join()
+            self.worker = None
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
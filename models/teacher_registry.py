@@ -0,0 +1,161 @@
+import collections
+import copy
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+import torch
+
+from algorithms.algorithms import get_algorithm_class
+from configs.hparams import get_hparams_class
+from dataloader.dataloader import data_generator
+from models.models import CNN
+from utils import AverageMeter, fix_randomness, evaluate_network, train_epoch
+
+logger = logging.getLogger(__name__)
+
+# legacy checkpoint names <src>_to_<trg><suffix> under <save_dir>/<dataset>/Teacher_CNN, per teacher kind
+LEGACY_SUFFIXES = {"uda": "_checkpoint.pt", "src_only": "_checkpoint_src_only.pt"}
+
+# teacher architecture fields of the dataset configs, part of the registry key
+TEACHER_CONFIG_FIELDS = ["input_channels", "sequence_len", "num_classes", "kernel_size", "stride", "dropout",
+                         "mid_channels_t", "final_out_channels_t", "features_len_t"]
+
+
+def teacher_configs(configs):
+    """Copy of the dataset configs where the CNN backbone and classifier take the teacher (CNN_T) widths."""
+    configs = copy.deepcopy(configs)
+    configs.mid_channels = configs.mid_channels_t
+    configs.final_out_channels = configs.final_out_channels_t
+    configs.features_len = configs.features_len_t
+    return configs
+
+
+class TeacherRegistry(object):
+    """
+    On-disk index of pretrained teachers, <save_dir>/teacher_registry.json, keyed by dataset, scenario, teacher kind
+    ('uda': trained with the UDA method teacher_da_method, 'src_only': trained on the source only) and a hash of the
+    teacher architecture and training setup.
+    get() returns the checkpoint of a teacher: the indexed one, else the legacy <src>_to_<trg>_checkpoint*.pt file,
+    else (train_missing) a teacher trained here through the same-domain / UDA path and registered for later runs.
+    A teacher is trained by one process at a time, the others of a sweep wait for its checkpoint (a crashed training
+    leaves its <checkpoint>.lock file behind, delete it to train again).
+    """
+
+    def __init__(self, save_dir, data_path, device, train_missing=True, teacher_da_method="DANN", seed=0,
+                 lock_poll=10.):
+        self.save_dir = save_dir
+        self.data_path = data_path
+        self.device = device
+        self.train_missing = train_missing
+        self.teacher_da_method = teacher_da_method
+        self.seed = seed
+        self.lock_poll = lock_poll
+        self.index_path = os.path.join(save_dir, "teacher_registry.json")
+
+    def read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def register(self, key, entry):
+        # re-read before writing, other processes of a sweep may have registered teachers meanwhile
+        index = self.read_index()
+        index[key] = entry
+        tmp_path = self.index_path + ".tmp{}".format(os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def training_setup(self, dataset, configs, kind):
+        hparams_class = get_hparams_class(dataset)()
+        da_method = "Lower_Upper_bounds" if kind == "src_only" else self.teacher_da_method
+        hparams = {**hparams_class.train_params, **hparams_class.alg_hparams.get(da_method, {})}
+        setup = {"dataset": dataset, "kind": kind, "da_method": da_method, "hparams": hparams, "seed": self.seed,
+                 "configs": {field: getattr(configs, field) for field in TEACHER_CONFIG_FIELDS}}
+        return setup, hashlib.sha1(json.dumps(setup, sort_keys=True).encode()).hexdigest()[:12]
+
+    def get(self, dataset, configs, src_id, trg_id, kind):
+        """Checkpoint path of the teacher of a scenario."""
+        if kind not in LEGACY_SUFFIXES:
+            raise ValueError("Unknown teacher kind: {}".format(kind))
+        setup, config_hash = self.training_setup(dataset, configs, kind)
+        key = "/".join([dataset, f"{src_id}_to_{trg_id}", kind, config_hash])
+
+        entry = self.read_index().get(key)
+        if entry is not None and os.path.exists(entry["path"]):
+            return entry["path"]
+
+        teacher_dir = os.path.join(self.save_dir, dataset, "Teacher_CNN")
+        legacy_path = os.path.join(teacher_dir, src_id + "_to_" + trg_id + LEGACY_SUFFIXES[kind])
+        if os.path.exists(legacy_path):
+            path, setup = legacy_path, {**setup, "legacy": True}
+        elif self.train_missing:
+            path = os.path.join(teacher_dir, "registry", f"{src_id}_to_{trg_id}_{kind}_{config_hash}.pt")
+            self.train_once(setup, configs, src_id, trg_id, path)
+        else:
+            raise FileNotFoundError(f"No {kind} teacher registered for {dataset} {src_id}_to_{trg_id} "
+                                    f"and no {legacy_path}")
+
+        self.register(key, {"path": path, "created": datetime.now().strftime("%d_%m_%Y_%H_%M_%S"), **setup})
+        return path
+
+    def train_once(self, setup, configs, src_id, trg_id, path):
+        """Train the teacher saved at path unless it exists, or wait for the process holding its lock file."""
+        lock_path = path + ".lock"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        waiting = False
+        while not os.path.exists(path):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not waiting:
+                    logger.warning(f"Waiting for the teacher trained by another process ({lock_path})")
+                    waiting = True
+                time.sleep(self.lock_poll)
+                continue
+            try:
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                if not os.path.exists(path):
+                    self.train(setup, configs, src_id, trg_id, path)
+            finally:
+                os.remove(lock_path)
+
+    def train(self, setup, configs, src_id, trg_id, path):
+        """
+        Train a CNN_T-shaped teacher for the scenario with the epoch loop of the UDA trainer, keep the epoch of best
+        source test accuracy and save it as a checkpoint with a network_dict.
+        """
+        logger.warning(f"Training missing {setup['kind']} teacher for {setup['dataset']} {src_id}_to_{trg_id} "
+                       f"with {setup['da_method']}")
+        fix_randomness(self.seed)
+        configs = teacher_configs(configs)
+        hparams = setup["hparams"]
+        algorithm_class = get_algorithm_class(setup["da_method"])
+        data_path = os.path.join(self.data_path, setup["dataset"])
+        src_train_dl, src_test_dl = data_generator(data_path, src_id, configs, hparams)
+        trg_train_dl, _ = data_generator(data_path, trg_id, configs, hparams, algorithm_class.uses_target_index)
+
+        algorithm = algorithm_class(CNN, configs, hparams, self.device)
+        algorithm.to(self.device)
+        loss_avg_meters = collections.defaultdict(lambda: AverageMeter())
+        best_acc, best_state = -1., None
+        for epoch in range(1, hparams["num_epochs"] + 1):
+            train_epoch(algorithm, src_train_dl, trg_train_dl, epoch, self.device, loss_avg_meters)
+            # the target labels are not available to a UDA teacher, it is selected on the source
+            network = algorithm.eval_network()
+            src_acc, _ = evaluate_network(network, src_test_dl, self.device)
+            if src_acc > best_acc:
+                best_acc = src_acc
+                best_state = {k: v.detach().clone() for k, v in network.state_dict().items()}
+        logger.warning(f"Teacher selected at source test accuracy {best_acc:.2f}")
+
+        # nn.Sequential(CNN, classifier) at the teacher widths has the state dict of nn.Sequential(CNN_T, classifier_T)
+        tmp_path = path + ".tmp{}".format(os.getpid())
+        torch.save({"network_dict": best_state, "configs": configs.__dict__, "hparams": hparams}, tmp_path)
+        os.replace(tmp_path, path)
@@ -0,0 +1,245 @@
+import os
+import glob
+import json
+import time
+import queue
+import struct
+import inspect
+import argparse
+import resource
+import threading
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from models.models import network_from_checkpoint
+from models.export import fuse_for_inference
+from models.serving import inference_mode
+
+
+class FileSamples(object):
+    '''
+    Samples of a C-ordered .npy or raw file, read chunk by chunk with plain file reads: unlike a memory map, the
+    pages of the chunks already processed do not stay in the resident memory of the process
+    '''
+
+    def __init__(self, path, dtype, sample_shape, offset=0):
+        self.path, self.dtype, self.sample_shape, self.offset = path, np.dtype(dtype), tuple(sample_shape), offset
+        self.sample_size = int(np.prod(self.sample_shape))
+        self.num_samples = (os.path.getsize(path) - offset) // (self.sample_size * self.dtype.itemsize)
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(self.num_samples)
+        with open(self.path, "rb") as f:
+            f.seek(self.offset + start * self.sample_size * self.dtype.itemsize)
+            samples = np.fromfile(f, dtype=self.dtype, count=(stop - start) * self.sample_size)
+        return samples.reshape(-1, *self.sample_shape)
+
+
+def open_samples(path, window, memmap_dtype):
+    '''
+    Samples (N, ...) of a file, read lazily: .npy and raw files (any other extension, memmap_dtype windows of the
+    checkpoint shape) chunk by chunk, .pt files (a tensor/array or a dict with "samples", as the datasets)
+    memory-mapped by torch >= 2.1 for the zip format and fully loaded otherwise
+    '''
+    if path.endswith(".npy"):
+        samples = np.load(path, mmap_mode="r")  # reads the header only
+        if not samples.flags.c_contiguous:
+            return samples
+        return FileSamples(path, samples.dtype, samples.shape[1:], samples.offset)
+    if path.endswith(".pt"):
+        kwargs = {"mmap": True} if "mmap" in inspect.signature(torch.load).parameters else {}
+        try:
+            data = torch.load(path, map_location="cpu", **kwargs)
+        except RuntimeError:  # legacy (non-zip) serialization
+            data = torch.load(path, map_location="cpu")
+        return data["samples"] if isinstance(data, dict) else data
+    return FileSamples(path, memmap_dtype, window)
+
+
+def to_windows(x, window):
+    '''
+    Float32 windows (N, C, L) of a chunk of samples, as Load_Dataset does: channels moved to the second dimension.
+    The chunk is copied out of the (memory-mapped) file, so it is read by the calling thread
+    '''
+    if isinstance(x, np.ndarray):
+        x = torch.from_numpy(np.array(x, dtype=np.float32) if isinstance(x, np.memmap) else x.astype(np.float32, copy=False))
+    else:
+        x = torch.as_tensor(x).to(torch.float32, copy=True)
+    if x.dim() == 2:
+        x = x.unsqueeze(1)
+    if tuple(x.shape[1:]) != window and tuple(x.shape[1:]) == window[::-1]:
+        x = x.permute(0, 2, 1)
+    if tuple(x.shape[1:]) != window:
+        raise ValueError("Samples of shape {} do not match the windows {} of the checkpoint".format(
+            tuple(x.shape[1:]), window))
+    return x.contiguous()
+
+
+def read_chunks(paths, window, chunk_size, memmap_dtype, chunks):
+    '''
+    Worker thread: puts (file_index, first sample index, windows) of chunk_size samples of every file in order on
+    the bounded queue chunks (the next file is read while the model runs on the current one), then None
+    '''
+    try:
+        for file_index, path in enumerate(paths):
+            samples = open_samples(path, window, memmap_dtype)
+            for start in range(0, len(samples), chunk_size):
+                chunks.put((file_index, start, to_windows(samples[start:start + chunk_size], window)))
+            del samples
+        chunks.put(None)
+    except Exception as e:  # re-raised by the consumer
+        chunks.put(e)
+
+
+# bytes of the .npy header of the output columns, reserved before their rows, which are not counted in advance
+NPY_HEADER_SIZE = 256
+
+
+def npy_header(dtype, shape):
+    '''
+    .npy (version 1.0) header of a C-ordered array, padded to NPY_HEADER_SIZE bytes
+    '''
+    text = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False,
+                 "shape": tuple(int(n) for n in shape)})
+    return np.lib.format.MAGIC_PREFIX + b"\x01\x00" + struct.pack("<H", NPY_HEADER_SIZE - 10) + \
+        (text.ljust(NPY_HEADER_SIZE - 11) + "\n").encode("latin1")
+
+
+class NpyColumns(object):
+    '''
+    One .npy file per output column, its rows appended chunk by chunk and its shape written to the header on close
+    '''
+
+    def __init__(self, output_dir, columns):
+        self.columns = columns
+        self.files = {name: open(os.path.join(output_dir, name + ".npy"), "wb") for name in columns}
+        for name, (dtype, shape) in columns.items():
+            self.files[name].write(npy_header(dtype, (0,) + shape))
+        self.row = 0
+
+    def write(self, values):
+        for name, value in values.items():
+            np.ascontiguousarray(value, dtype=self.columns[name][0]).tofile(self.files[name])
+        self.row += len(next(iter(values.values())))
+
+    def close(self):
+        for name, (dtype, shape) in self.columns.items():
+            self.files[name].seek(0)
+            self.files[name].write(npy_header(dtype, (self.row,) + shape))
+            self.files[name].close()
+
+
+class ParquetColumns(object):
+    '''
+    A Parquet file with one row group per chunk (requires pyarrow)
+    '''
+
+    def __init__(self, output_dir, columns):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        fields = [pyarrow.field(name, pyarrow.list_(pyarrow.from_numpy_dtype(dtype), shape[0]) if shape
+                                else pyarrow.from_numpy_dtype(dtype)) for name, (dtype, shape) in columns.items()]
+        self.writer = pyarrow.parquet.ParquetWriter(os.path.join(output_dir, "predictions.parquet"),
+                                                    pyarrow.schema(fields))
+
+    def write(self, values):
+        arrays = [self.pa.FixedSizeListArray.from_arrays(value.reshape(-1), value.shape[1]) if value.ndim > 1
+                  else self.pa.array(value) for value in values.values()]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, names=list(values)))
+
+    def close(self):
+        self.writer.close()
+
+
+def predict(network, chunks, writer, batch_size, device, embeddings):
+    '''
+    Runs the chunks of the queue through feature_extractor + classifier and writes their predictions; returns the
+    number of windows
+    '''
+    feature_extractor, classifier = network
+    num_windows = 0
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return num_windows
+        if isinstance(chunk, Exception):
+            raise chunk
+        file_index, start, x = chunk
+        outputs = {"prediction": [], "confidence": [], "embedding": []}
+        with inference_mode():
+            for i in range(0, len(x), batch_size):
+                features = feature_extractor(x[i:i + batch_size].to(device, non_blocking=True))
+                confidence, prediction = F.softmax(classifier(features), dim=1).max(dim=1)
+                outputs["prediction"].append(prediction.cpu().numpy())
+                outputs["confidence"].append(confidence.cpu().numpy())
+                if embeddings:
+                    outputs["embedding"].append(features.cpu().numpy())
+        values = {"file_index": np.full(len(x), file_index, dtype=np.int32),
+                  "sample_index": np.arange(start, start + len(x), dtype=np.int64)}
+        values.update({name: np.concatenate(value) for name, value in outputs.items() if value})
+        writer.write(values)
+        num_windows += len(x)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint',             required=True,                      type=str, help='checkpoint.pt saved by save_checkpoint')
+    parser.add_argument('--backbone',               default='CNN',                      type=str, help='Backbone of the checkpoint: (CNN - RESNET18 - TCN - RESNET34 -RESNET1D_WANG)')
+    parser.add_argument('--input_dir',              required=True,                      type=str, help='Directory of .pt/.npy sample files and raw (memmap) dumps')
+    parser.add_argument('--pattern',                default='*.pt,*.npy',               type=str, help='Comma-separated glob patterns of the sample files in input_dir')
+    parser.add_argument('--memmap_dtype',           default='float32',                  type=str, help='dtype of raw sample files (windows of the checkpoint shape)')
+    parser.add_argument('--output_dir',             default='predictions',              type=str, help='Directory of the output columns and report')
+    parser.add_argument('--output_format',          default='npy',                      type=str, help='npy (one file per column) or parquet (requires pyarrow)')
+    parser.add_argument('--embeddings',             action='store_true',                           help='Also write the feature_extractor outputs')
+    parser.add_argument('--chunk_size',             default=8192,                       type=int, help='Windows read from a file at a time')
+    parser.add_argument('--prefetch_chunks',        default=2,                          type=int, help='Chunks read ahead by the worker thread')
+    parser.add_argument('--batch_size',             default=1024,                       type=int, help='Windows per forward pass')
+    parser.add_argument('--device',                 default='cpu',                      type=str, help='cpu or cuda')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    configs = checkpoint["configs"]
+    window = (configs["input_channels"], configs["sequence_len"])
+    network = fuse_for_inference(network_from_checkpoint(checkpoint, args.backbone)).to(device)
+
+    paths = sorted({path for pattern in args.pattern.split(",")
+                    for path in glob.glob(os.path.join(args.input_dir, pattern.strip()))})
+    if not paths:
+        raise FileNotFoundError("No sample file matches {} in {}".format(args.pattern, args.input_dir))
+    with inference_mode():
+        embedding_dim = network[0](torch.zeros(1, *window, device=device)).size(1)
+    columns = {"file_index": (np.int32, ()), "sample_index": (np.int64, ()), "prediction": (np.int64, ()),
+               "confidence": (np.float32, ())}
+    if args.embeddings:
+        columns["embedding"] = (np.float32, (embedding_dim,))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    writer = {"npy": NpyColumns, "parquet": ParquetColumns}[args.output_format](args.output_dir, columns)
+    chunks = queue.Queue(maxsize=args.prefetch_chunks)
+    reader = threading.Thread(target=read_chunks, args=(paths, window, args.chunk_size, args.memmap_dtype, chunks),
+                              daemon=True)
+    start = time.perf_counter()
+    reader.start()
+    try:
+        num_windows = predict(network, chunks, writer, args.batch_size, device, args.embeddings)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+
+    report = {"checkpoint": args.checkpoint, "files": paths, "windows": num_windows, "seconds": elapsed,
+              "windows_per_s": num_windows / elapsed,
+              "input_mb_per_s": num_windows * int(np.prod(window)) * 4 / 2 ** 20 / elapsed,
+              # ru_maxrss is in KB on Linux
+              "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if device.type == "cuda":
+        report["peak_cuda_mb"] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    with open(os.path.join(args.output_dir, "predict_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({k: v for k, v in report.items() if k != "files"}, indent=2))
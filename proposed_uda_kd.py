@@ -17,7 +17,7 @@ from configs.hparams import get_hparams_class
 
 from configs.sweep_params import sweep_alg_hparams
 from utils import fix_randomness, copy_Files, starting_logs, save_checkpoint, _calc_metrics
-from utils import calc_dev_risk, calculate_risk
+from utils import calc_dev_risk, calculate_risk, add_kd_arguments
 import warnings
 
 import sklearn.exceptions
@@ -26,12 +26,12 @@ warnings.filterwarnings("ignore", category=sklearn.exceptions.UndefinedMetricWar
 import collections
 from algorithms.algorithms import get_algorithm_class
 from models.models import get_backbone_class
-from utils import AverageMeter
+from utils import AverageMeter, StudentsEvaluationMixin, KDTrainerMixin
 
 
 torch.backends.cudnn.benchmark = True  # to fasten TCN
 
-class adv_cross_domain_kd_trainer(object):
+class adv_cross_domain_kd_trainer(StudentsEvaluationMixin, KDTrainerMixin):
     """
    This class contain the main training functions for our AdAtime
     """
@@ -61,6 +61,9 @@ class adv_cross_domain_kd_trainer(object):
         # Specify runs
         self.num_runs = args.num_runs
 
+        # Teachers, student fine-tuning, frozen teacher pipeline, student widths and profiling (add_kd_arguments)
+        self.init_kd_options(args)
+
         # get dataset and base model configs
         self.dataset_configs, self.hparams_class = self.get_configs()
 
@@ -70,6 +73,9 @@ class adv_cross_domain_kd_trainer(object):
         # Specify number of hparams
         self.default_hparams = {**self.hparams_class.alg_hparams[self.da_method],
                                 **self.hparams_class.train_params}
+        # exit heads after conv_block1/2 of the CNN student, trained for the early-exit cascade
+        if args.early_exit:
+            self.default_hparams["early_exit"] = True
 
     def sweep(self):
         # sweep configurations
@@ -105,11 +111,15 @@ class adv_cross_domain_kd_trainer(object):
 
         self.metrics = {'accuracy': [], 'f1_score': [], 'src_risk': [], 'few_shot_trg_risk': [],
                         'trg_risk': [], 'dev_risk': []}
+        self.students_results = []
 
         for i in scenarios:
             src_id = i[0]
             trg_id = i[1]
 
+            # Pre-trained teacher(s) of the scenario, shared by all runs
+            teacher_paths = self.get_teacher_paths(src_id, trg_id)
+
             for run_id in range(self.num_runs):  # specify number of consecutive runs
                 # fixing random seed
                 fix_randomness(run_id)
@@ -121,41 +131,11 @@ class adv_cross_domain_kd_trainer(object):
                 # Load data
                 self.load_data(src_id, trg_id)
 
-                # get student algorithm
-                algorithm_class = get_algorithm_class(self.da_method)
-                backbone_fe = get_backbone_class(self.backbone)
-
-                algorithm = algorithm_class(backbone_fe, self.dataset_configs, self.hparams, self.device)
-
-                # Load Pre-trained Teacher model
-                best_teacher = src_id+'_to_'+trg_id+'_checkpoint.pt'
-                model_t_name = os.path.join(self.save_dir,self.dataset,'Teacher_CNN',best_teacher)
-                checkpoint = torch.load(model_t_name)
-                algorithm.network_t.load_state_dict(checkpoint["network_dict"])
-
-                algorithm.to(self.device)
+                # train the student(s) of the run, one per student width
+                algorithm, students = self.train_students(teacher_paths, src_id, trg_id)
 
-                # Average meters
-                loss_avg_meters = collections.defaultdict(lambda: AverageMeter())
-
-                # training..
-                for epoch in range(1, self.hparams["num_epochs"] + 1):
-                    joint_loaders = enumerate(zip(self.src_train_dl, self.trg_train_dl))
-                    len_dataloader = min(len(self.src_train_dl), len(self.trg_train_dl))
-                    algorithm.train()
-
-                    for step, ((src_x, src_y), (trg_x, _)) in joint_loaders:
-                        src_x, src_y, trg_x = src_x.float().to(self.device), src_y.long().to(self.device), \
-                                              trg_x.float().to(self.device)
-                        losses = algorithm.update(src_x, src_y, trg_x, step, epoch, len_dataloader)
-                        for key, val in losses.items():
-                            loss_avg_meters[key].update(val, src_x.size(0))
-
-                    # logging
-                    self.logger.debug(f'[Epoch : {epoch}/{self.hparams["num_epochs"]}]')
-                    for key, val in loss_avg_meters.items():
-                        self.logger.debug(f'{key}\t: {val.avg:2.4f}')
-                    self.logger.debug(f'-------------------------------------')
+                if len(students) > 1:
+                    self.evaluate_students(students, scenarios)
 
                 self.algorithm = algorithm
                 save_checkpoint(self.home_path, self.algorithm, scenarios, self.dataset_configs,
@@ -167,6 +147,8 @@ class adv_cross_domain_kd_trainer(object):
 
         # logging metrics
         self.calc_overall_results()
+        if self.students_results:
+            self.calc_students_results()
         average_metrics = {metric: np.mean(value) for (metric, value) in self.metrics.items()}
         wandb.log(average_metrics)
         wandb.log({'hparams': wandb.Table(
@@ -176,8 +158,8 @@ class adv_cross_domain_kd_trainer(object):
         wandb.log({'std_results': wandb.Table(dataframe=self.std_results_df, allow_mixed_types=True)})
 
     def evaluate(self):
-        feature_extractor = self.algorithm.feature_extractor.to(self.device)
-        classifier = self.algorithm.classifier.to(self.device)
+        network = self.algorithm.eval_network().to(self.device)
+        feature_extractor, classifier = network[0], network[1]
 
         feature_extractor.eval()
         classifier.eval()
@@ -231,10 +213,12 @@ class adv_cross_domain_kd_trainer(object):
                                           self.home_path,
                                           self.dataset_configs.class_names)
         if self.is_sweep:
-            self.src_risk = calculate_risk(self.algorithm, self.src_test_dl, self.device)
-            self.trg_risk = calculate_risk(self.algorithm, self.trg_test_dl, self.device)
-            self.few_shot_trg_risk = calculate_risk(self.algorithm, self.few_shot_dl, self.device)
-            self.dev_risk = calc_dev_risk(self.algorithm, self.src_train_dl, self.trg_train_dl, self.src_test_dl,
+            # the risks of the evaluated and saved network (the averaged one with weight averaging)
+            network = self.algorithm.eval_network()
+            self.src_risk = calculate_risk(network, self.src_test_dl, self.device)
+            self.trg_risk = calculate_risk(network, self.trg_test_dl, self.device)
+            self.few_shot_trg_risk = calculate_risk(network, self.few_shot_dl, self.device)
+            self.dev_risk = calc_dev_risk(network, self.src_train_dl, self.trg_train_dl, self.src_test_dl,
                                           self.dataset_configs, self.device)
 
             run_metrics = {'accuracy': self.acc,
@@ -317,6 +301,10 @@ parser.add_argument('--backbone',               default='CNN',
 parser.add_argument('--num_runs',               default=3,                          type=int, help='Number of consecutive run with different seeds')
 parser.add_argument('--device',                 default='cuda:0',                   type=str, help='cpu or cuda')
 
+# ========= Teachers and students (KD trainers) =====
+add_kd_arguments(parser)
+parser.add_argument('--early_exit',             action='store_true',                          help='Train exit heads after conv_block1/2 of the CNN student (UDA_KD), see early_exit_cascade.py')
+
 # ======== sweep settings =====================
 parser.add_argument('--is_sweep',               default=False,                      type=bool, help='singe run or sweep')
 parser.add_argument('--num_sweeps',             default=20,                         type=str, help='Number of sweep runs')
@@ -0,0 +1,95 @@
+import os
+import argparse
+import warnings
+
+import pandas as pd
+import torch
+import torch.nn as nn
+import sklearn.exceptions
+
+from configs.data_model_configs import get_dataset_class
+from configs.hparams import get_hparams_class
+from dataloader.dataloader import data_generator
+from models.models import network_from_checkpoint, CNN_T, classifier_T
+from models.quantization import calibration_batches, quantize_static, quantize_dynamic_heads
+from models.teacher import teacher_checkpoint_paths, load_teacher
+from utils import fix_randomness, evaluate_network, measure_latency, state_dict_size
+
+warnings.filterwarnings("ignore", category=sklearn.exceptions.UndefinedMetricWarning)
+
+
+def quantize_scenario(args, configs, src_id, trg_id, device):
+    '''
+    Quantizes the student of a scenario with calibration batches of the unlabeled target training set, and reports
+    the target test accuracy, F1, size and single-window latency of the INT8 and FP32 students and of the teacher
+    '''
+    fix_randomness(args.seed)
+    hparams = {"batch_size": get_hparams_class(args.dataset)().train_params["batch_size"]}
+    trg_train_dl, trg_test_dl = data_generator(os.path.join(args.data_path, args.dataset), trg_id, configs, hparams)
+
+    student = network_from_checkpoint(torch.load(args.student_checkpoint.format(src=src_id, trg=trg_id),
+                                                 map_location="cpu"), args.backbone).eval()
+    models = {"student_fp32": student,
+              "student_int8": quantize_static(student, calibration_batches(trg_train_dl, args.num_calibration_batches),
+                                              args.backend, dynamic_head=not args.static_head),
+              "student_int8_linear_only": quantize_dynamic_heads(student)}
+    if args.teacher_checkpoints:
+        teacher_dir = os.path.join(args.save_dir, args.dataset, "Teacher_CNN")
+        teacher = nn.Sequential(CNN_T(configs), classifier_T(configs))
+        models["teacher_fp32"] = load_teacher(teacher, teacher_checkpoint_paths(args.teacher_checkpoints, teacher_dir,
+                                                                                 src_id, trg_id)).eval()
+
+    window = (1, configs.input_channels, configs.sequence_len)
+    results = []
+    for name, model in models.items():
+        acc, f1 = evaluate_network(model, trg_test_dl, device)
+        results.append({"scenario": f"{src_id}_to_{trg_id}", "model": name, "acc": acc, "f1": f1,
+                        "size_kb": state_dict_size(model) / 1024,
+                        "latency_ms": measure_latency(model, window, device, iters=args.latency_iters)})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # ========  Experiments Name ================
+    parser.add_argument('--save_dir',               default='experiments_logs',         type=str, help='Directory containing all experiments')
+    parser.add_argument('--experiment_description', default='HAR',                      type=str, help='Name of your experiment (HAR, HHAR_SA, FD, EEG')
+    parser.add_argument('--run_description',        default='INT8_CNN',                 type=str, help='name of your runs, ')
+
+    # ========= Checkpoints ======================
+    parser.add_argument('--student_checkpoint',     required=True,                      type=str, help='Trained student checkpoint.pt, with {src}/{trg} placeholders')
+    parser.add_argument('--teacher_checkpoints',    default='{src}_to_{trg}_checkpoint.pt', type=str, help='Teacher checkpoints under <save_dir>/<dataset>/Teacher_CNN with {src}/{trg} placeholders (empty: no teacher)')
+
+    # ========= Select the DATASET ==============
+    parser.add_argument('--data_path',              default=r'./data',                  type=str, help='Path containing dataset')
+    parser.add_argument('--dataset',                default='HAR',                      type=str, help='Dataset of choice: (HAR, HHAR_SA, FD, EEG)')
+    parser.add_argument('--scenarios',              default='',                         type=str, help='Comma-separated scenarios, e.g. 2_to_11 (default: those of the dataset configs)')
+    parser.add_argument('--backbone',               default='CNN',                      type=str, help='Backbone of the student: (CNN - RESNET18 - TCN - RESNET34 -RESNET1D_WANG)')
+
+    # ========= Quantization =====================
+    parser.add_argument('--num_calibration_batches', default=10,                        type=int, help='Unlabeled target training batches observed for the activation ranges')
+    parser.add_argument('--backend',                default='fbgemm',                   type=str, help='Quantized engine: (fbgemm - qnnpack for ARM)')
+    parser.add_argument('--static_head',            action='store_true',                          help='Statically quantize the classifier too (default: dynamic quantization of the Linear head)')
+    parser.add_argument('--latency_iters',          default=200,                        type=int, help='Single-window forward passes timed per model')
+    parser.add_argument('--seed',                   default=0,                          type=int, help='Random seed of the calibration batches')
+
+    args = parser.parse_args()
+
+    # quantized kernels run on the CPU
+    device = torch.device("cpu")
+    configs = get_dataset_class(args.dataset)()
+    scenarios = configs.scenarios
+    if args.scenarios:
+        scenarios = [tuple(scenario.split("_to_")) for scenario in args.scenarios.split(",")]
+    log_dir = os.path.join(args.save_dir, args.experiment_description, args.run_description)
+    os.makedirs(log_dir, exist_ok=True)
+
+    results = pd.DataFrame([row for src_id, trg_id in scenarios
+                            for row in quantize_scenario(args, configs, src_id, trg_id, device)])
+    mean_results = results.groupby("model", sort=False).mean(numeric_only=True).reset_index()
+    with pd.ExcelWriter(os.path.join(log_dir, "quantization_results.xlsx")) as writer:
+        results.to_excel(writer, sheet_name="scenarios", index=False)
+        mean_results.to_excel(writer, sheet_name="mean", index=False)
+    print(results.to_string(index=False, float_format="%.3f"))
+    print(mean_results.to_string(index=False, float_format="%.3f"))
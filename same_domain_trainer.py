@@ -133,6 +133,8 @@ class same_domain_Trainer(object):
 
                         losses = algorithm.update(src_x, src_y)
 
+                        algorithm.update_weight_averaging()
+
                         for key, val in losses.items():
                             loss_avg_meters[key].update(val, src_x.size(0))
 
@@ -159,8 +161,8 @@ class same_domain_Trainer(object):
             allow_mixed_types=True)})
 
     def evaluate(self):
-        feature_extractor = self.algorithm.feature_extractor.to(self.device)
-        classifier = self.algorithm.classifier.to(self.device)
+        network = self.algorithm.eval_network().to(self.device)
+        feature_extractor, classifier = network[0], network[1]
 
         feature_extractor.eval()
         classifier.eval()
@@ -0,0 +1,128 @@
+import json
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+
+import numpy as np
+import torch
+
+from models.models import network_from_checkpoint
+from models.export import fuse_for_inference
+from models.serving import MicroBatcher
+
+
+def parse_windows(headers, body, window):
+    '''
+    Windows (N, C, L) of a request body: float32 (little-endian) bytes with Content-Type application/octet-stream,
+    otherwise JSON {"x": one (C, L) window or a list of them}
+    '''
+    if headers.get("content-type", "").startswith("application/octet-stream"):
+        x = np.frombuffer(body, dtype="<f4")
+        if x.size == 0 or x.size % int(np.prod(window)):
+            raise ValueError("The body holds {} floats, not windows of {}".format(x.size, window))
+        x = x.reshape(-1, *window)
+    else:
+        payload = json.loads(body)
+        if not isinstance(payload, dict) or "x" not in payload:
+            raise ValueError('Expected a JSON object {"x": window or list of windows}')
+        x = np.asarray(payload["x"], dtype=np.float32)
+        x = x[None] if x.ndim == 2 else x
+        if x.ndim != 3 or x.shape[1:] != window:
+            raise ValueError("Expected windows of shape {}, got {}".format(window, x.shape))
+    return torch.from_numpy(x.copy())
+
+
+async def route(method, target, headers, body, batcher, window):
+    path = urlsplit(target).path
+    if path == "/predict" and method == "POST":
+        try:
+            x = parse_windows(headers, body, window)
+        except (ValueError, TypeError) as e:
+            return 400, {"error": str(e)}
+        logits = await batcher.predict(x)
+        return 200, {"logits": logits.tolist(), "predictions": logits.argmax(dim=1).tolist()}
+    if path == "/metrics" and method == "GET":
+        return 200, batcher.metrics.summary()
+    if path == "/metrics" and method == "DELETE":
+        batcher.metrics.reset()
+        return 200, {}
+    if path == "/health" and method == "GET":
+        return 200, {"status": "ok", "window": list(window)}
+    return 404, {"error": "{} {} not found".format(method, path)}
+
+
+async def handle_connection(reader, writer, batcher, window):
+    '''
+    Minimal HTTP/1.1 with keep-alive: POST /predict, GET /metrics (DELETE resets them) and GET /health
+    '''
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode("latin-1").split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            status, payload = await route(method, target, headers, body, batcher, window)
+            content = json.dumps(payload).encode()
+            keep_alive = headers.get("connection", "").lower() != "close"
+            head = "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n"
+            writer.write(head.format(status, "OK" if status == 200 else "Error", len(content),
+                                     "keep-alive" if keep_alive else "close").encode("latin-1") + content)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(args, network, window):
+    batcher = MicroBatcher(network, torch.device(args.device), args.max_batch_size, args.max_latency_ms)
+    batcher.start()
+
+    async def handler(reader, writer):
+        await handle_connection(reader, writer, batcher, window)
+
+    if args.unix_socket:
+        server = await asyncio.start_unix_server(handler, path=args.unix_socket)
+        address = args.unix_socket
+    else:
+        server = await asyncio.start_server(handler, args.host, args.port)
+        address = "http://{}:{}".format(args.host, args.port)
+    print("Serving {} on {} (windows {}, max batch {}, max latency {} ms)".format(
+        args.checkpoint, address, window, args.max_batch_size, args.max_latency_ms), flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint',             required=True,                      type=str, help='checkpoint.pt saved by save_checkpoint')
+    parser.add_argument('--backbone',               default='CNN',                      type=str, help='Backbone of the checkpoint: (CNN - RESNET18 - TCN - RESNET34 -RESNET1D_WANG)')
+    parser.add_argument('--host',                   default='127.0.0.1',                type=str, help='HTTP host')
+    parser.add_argument('--port',                   default=8000,                       type=int, help='HTTP port')
+    parser.add_argument('--unix_socket',            default='',                         type=str, help='Serve HTTP on this Unix socket path instead of host:port')
+    parser.add_argument('--max_batch_size',         default=64,                         type=int, help='Largest micro-batch, in windows')
+    parser.add_argument('--max_latency_ms',         default=5.0,                        type=float, help='Longest wait of the first request of a micro-batch for others')
+    parser.add_argument('--device',                 default='cpu',                      type=str, help='cpu or cuda')
+    args = parser.parse_args()
+
+    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    window = (checkpoint["configs"]["input_channels"], checkpoint["configs"]["sequence_len"])
+    network = fuse_for_inference(network_from_checkpoint(checkpoint, args.backbone))
+    try:
+        asyncio.run(serve(args, network, window))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,98 @@
+import os
+import time
+import argparse
+import warnings
+
+import pandas as pd
+import torch
+import sklearn.exceptions
+
+from algorithms.tta import TestTimeAdaptation
+from configs.data_model_configs import get_dataset_class
+from configs.hparams import get_hparams_class
+from dataloader.dataloader import data_generator
+from models.models import network_from_checkpoint
+from utils import fix_randomness, evaluate_network
+
+warnings.filterwarnings("ignore", category=sklearn.exceptions.UndefinedMetricWarning)
+
+
+def adapt_scenario(args, configs, src_id, trg_id, device, log_dir):
+    '''
+    Adapts the trained checkpoint of a scenario on the unlabeled target training set, without any source data,
+    and evaluates it on the target test set before and after, next to the full UDA checkpoint if given.
+    '''
+    fix_randomness(args.seed)
+    checkpoint = torch.load(args.checkpoint.format(src=src_id, trg=trg_id), map_location="cpu")
+    hparams = {"batch_size": args.batch_size or get_hparams_class(args.dataset)().train_params["batch_size"]}
+    trg_train_dl, trg_test_dl = data_generator(os.path.join(args.data_path, args.dataset), trg_id, configs, hparams)
+
+    network = network_from_checkpoint(checkpoint, args.backbone).to(device)
+    results = {"scenario": f"{src_id}_to_{trg_id}"}
+    results["acc_before"], results["f1_before"] = evaluate_network(network, trg_test_dl, device)
+
+    tta = TestTimeAdaptation(network, args.tta_mode, lr=args.lr, reset_stats=not args.keep_source_stats,
+                             momentum=args.bn_momentum)
+    start = time.perf_counter()
+    num_samples = sum(tta.adapt_stream(trg_train_dl) for _ in range(args.num_epochs))
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    results["adapt_time_s"] = time.perf_counter() - start
+    results["adapt_samples"] = num_samples
+    results["acc_tta"], results["f1_tta"] = evaluate_network(network, trg_test_dl, device)
+
+    if args.uda_checkpoint:
+        uda_checkpoint = torch.load(args.uda_checkpoint.format(src=src_id, trg=trg_id), map_location="cpu")
+        uda_network = network_from_checkpoint(uda_checkpoint, args.backbone).to(device)
+        results["acc_uda"], results["f1_uda"] = evaluate_network(uda_network, trg_test_dl, device)
+
+    scenario_log_dir = os.path.join(log_dir, f"{src_id}_to_{trg_id}")
+    os.makedirs(scenario_log_dir, exist_ok=True)
+    torch.save({**checkpoint, "network_dict": network.state_dict(), "tta": vars(args)},
+               os.path.join(scenario_log_dir, "checkpoint.pt"))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # ========  Experiments Name ================
+    parser.add_argument('--save_dir',               default='experiments_logs',         type=str, help='Directory containing all experiments')
+    parser.add_argument('--experiment_description', default='HAR',                      type=str, help='Name of your experiment (HAR, HHAR_SA, FD, EEG')
+    parser.add_argument('--run_description',        default='TTA_CNN',                  type=str, help='name of your runs, ')
+
+    # ========= Checkpoints ======================
+    parser.add_argument('--checkpoint',             required=True,                      type=str, help='Trained checkpoint.pt to adapt, with {src}/{trg} placeholders (e.g. a source-only run)')
+    parser.add_argument('--uda_checkpoint',         default='',                         type=str, help='checkpoint.pt of a full UDA run ({src}/{trg} placeholders) to compare with')
+
+    # ========= Select the DATASET ==============
+    parser.add_argument('--data_path',              default=r'./data',                  type=str, help='Path containing dataset')
+    parser.add_argument('--dataset',                default='HAR',                      type=str, help='Dataset of choice: (HAR, HHAR_SA, FD, EEG)')
+    parser.add_argument('--scenarios',              default='',                         type=str, help='Comma-separated scenarios to adapt, e.g. 2_to_11 (default: those of the dataset configs)')
+    parser.add_argument('--backbone',               default='CNN',                      type=str, help='Backbone of the checkpoints: (CNN - RESNET18 - TCN - RESNET34 -RESNET1D_WANG)')
+
+    # ========= Test-time adaptation ==============
+    parser.add_argument('--tta_mode',               default='bn',                       type=str, help='bn: recalibrate the BatchNorm statistics - entropy: also fit the BatchNorm affine parameters')
+    parser.add_argument('--lr',                     default=1e-3,                       type=float, help='Learning rate of the BatchNorm affine parameters (entropy mode)')
+    parser.add_argument('--num_epochs',             default=1,                          type=int, help='Passes over the target training stream')
+    parser.add_argument('--batch_size',             default=0,                          type=int, help='Target stream batch size (default: batch_size of the dataset hparams)')
+    parser.add_argument('--keep_source_stats',      action='store_true',                          help='Update the source BatchNorm statistics with --bn_momentum instead of re-estimating them')
+    parser.add_argument('--bn_momentum',            default=0.1,                        type=float, help='BatchNorm momentum with --keep_source_stats')
+    parser.add_argument('--seed',                   default=0,                          type=int, help='Random seed of the target stream order')
+    parser.add_argument('--device',                 default='cuda:0',                   type=str, help='cpu or cuda')
+
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    configs = get_dataset_class(args.dataset)()
+    scenarios = configs.scenarios
+    if args.scenarios:
+        scenarios = [tuple(scenario.split("_to_")) for scenario in args.scenarios.split(",")]
+    log_dir = os.path.join(args.save_dir, args.experiment_description, args.run_description)
+    os.makedirs(log_dir, exist_ok=True)
+
+    results = pd.DataFrame([adapt_scenario(args, configs, src_id, trg_id, device, log_dir)
+                            for src_id, trg_id in scenarios])
+    results.loc[len(results)] = ["mean"] + list(results.iloc[:, 1:].mean())
+    results.to_excel(os.path.join(log_dir, "tta_results.xlsx"), index=False)
+    print(results.to_string(index=False, float_format="%.2f"))
@@ -0,0 +1,214 @@
+import os
+import argparse
+import warnings
+import itertools
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+import sklearn.exceptions
+
+from configs.data_model_configs import get_dataset_class, with_student_arch
+from configs.hparams import get_hparams_class
+from dataloader.dataloader import data_generator
+from algorithms.algorithms import UDA_KD
+from models.models import CNN, CNN_T, classifier, classifier_T, convert_domain_batchnorm
+from models.profiler import profile_model
+from models.teacher import teacher_checkpoint_paths, load_teacher
+from models.teacher_registry import TeacherRegistry
+from utils import fix_randomness, evaluate_network, _logger
+
+warnings.filterwarnings("ignore", category=sklearn.exceptions.UndefinedMetricWarning)
+
+
+def candidate_archs(configs, widths, kernel_sizes, num_blocks, features_lens):
+    '''
+    CNN students of the search space: num_blocks blocks of width channels for the first one and twice as many
+    for the others (as the CNN), the kernel size of the dataset for the first block (matched to its sampling rate)
+    and kernel_size for the others, and features_len positions of the last block
+    '''
+    archs = []
+    for blocks, width, kernel_size, features_len in itertools.product(num_blocks, widths, kernel_sizes, features_lens):
+        arch = {"num_blocks": blocks, "width": width, "kernel_size": kernel_size, "features_len": features_len,
+                "channels": (width,) + (width * 2,) * (blocks - 1),
+                "kernels": (configs.kernel_size,) + (kernel_size,) * (blocks - 1)}
+        if all((a["channels"], a["kernels"], a["features_len"]) != (arch["channels"], arch["kernels"], features_len)
+               for a in archs):
+            archs.append(arch)
+    return archs
+
+
+def arch_configs(configs, arch):
+    '''
+    Dataset configs of a candidate student
+    '''
+    return with_student_arch(configs, arch["channels"], arch["kernels"], arch["features_len"])
+
+
+def prune_candidates(archs, configs, args):
+    '''
+    Parameters, FLOPs and CPU latency (at --latency_batch_size, timed on the untrained student: the latency does not
+    depend on the weights) of every candidate, and whether it fits the budgets and is trained
+    '''
+    window = (configs.input_channels, configs.sequence_len)
+    rows = []
+    for arch in archs:
+        student_configs = arch_configs(configs, arch)
+        network = nn.Sequential(CNN(student_configs), classifier(student_configs))
+        summary, _ = profile_model(network, window, torch.device("cpu"), batch_sizes=(args.latency_batch_size,),
+                                   iters=args.latency_iters)
+        row = {key: arch[key] for key in ("num_blocks", "width", "kernel_size", "features_len")}
+        row.update({"params": summary["params"], "mflops": summary["flops"] / 1e6,
+                    "latency_ms": summary["latency_ms_bs{}".format(args.latency_batch_size)]})
+        if args.latency_budget_ms and row["latency_ms"] > args.latency_budget_ms:
+            row["status"] = "over_latency"
+        elif args.param_budget and row["params"] > args.param_budget:
+            row["status"] = "over_params"
+        else:
+            row["status"] = "trained"
+        rows.append(row)
+    return rows
+
+
+def train_candidate(args, configs, hparams, loaders, teacher, device):
+    '''
+    Short UDA_KD training of a candidate on a scenario, terminated once its source test accuracy has not improved for
+    --patience epochs. Returns the target test accuracy and F1 of its best epoch (on the source), the source accuracy
+    and the number of epochs run
+    '''
+    src_train_dl, src_test_dl, trg_train_dl, trg_test_dl = loaders
+    fix_randomness(args.seed)
+    algorithm = UDA_KD(CNN, configs, hparams, device, network_t=teacher)
+    algorithm.to(device)
+
+    len_dataloader = min(len(src_train_dl), len(trg_train_dl))
+    best_src_acc, best_state, stale = -1., None, 0
+    for epoch in range(1, hparams["num_epochs"] + 1):
+        algorithm.train()
+        for step, ((src_x, src_y), (trg_x, _)) in enumerate(zip(src_train_dl, trg_train_dl)):
+            algorithm.update(src_x.float().to(device), src_y.long().to(device), trg_x.float().to(device), step, epoch,
+                             len_dataloader)
+            algorithm.update_weight_averaging()
+
+        network = algorithm.eval_network()
+        src_acc, _ = evaluate_network(network, src_test_dl, device)
+        if src_acc > best_src_acc:
+            best_src_acc, stale = src_acc, 0
+            best_state = {k: v.detach().clone() for k, v in network.state_dict().items()}
+        else:
+            stale += 1
+            if stale >= args.patience:
+                break
+
+    network.load_state_dict(best_state)
+    acc, f1 = evaluate_network(network, trg_test_dl, device)
+    return {"acc": acc, "f1": f1, "src_acc": best_src_acc, "epochs": epoch}
+
+
+def pareto_front(results, x="latency_ms", y="acc"):
+    '''
+    Rows of results no other row dominates, i.e. is at least as fast and as accurate and strictly better in one, by
+    increasing latency
+    '''
+    results = results.sort_values([x, y], ascending=[True, False])
+    front, best = [], -np.inf
+    for index, row in results.iterrows():
+        if row[y] > best:
+            front.append(index)
+            best = row[y]
+    return results.loc[front]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # ========  Experiments Name ================
+    parser.add_argument('--save_dir',               default='experiments_logs',         type=str, help='Directory containing all experiments')
+    parser.add_argument('--experiment_description', default='Student_search',           type=str, help='Name of your experiment')
+    parser.add_argument('--run_description',        default='UDA_KD_CNN',               type=str, help='name of your runs, ')
+    parser.add_argument('--teacher_checkpoints',    default='',                         type=str, help='Teacher checkpoints under <save_dir>/<dataset>/Teacher_CNN with {src}/{trg} placeholders (default: the teacher registry)')
+    parser.add_argument('--teacher_da_method',      default='DANN',                     type=str, help='UDA method training missing domain-adapted teachers of the registry')
+    parser.add_argument('--no_teacher_training',    action='store_true',                          help='Fail instead of training teachers missing from the registry')
+
+    # ========= Select the DATASET ==============
+    parser.add_argument('--data_path',              default=r'./data',                  type=str, help='Path containing dataset')
+    parser.add_argument('--dataset',                default='HAR',                      type=str, help='Comma-separated datasets: (HAR, HHAR_SA, FD, EEG)')
+    parser.add_argument('--scenarios',              default='',                         type=str, help='Comma-separated scenarios, e.g. 2_to_11 (default: those of the dataset configs)')
+
+    # ========= Search space and budgets =========
+    parser.add_argument('--widths',                 default='4,8,16,32',                type=str, help='Comma-separated channels of the first block (twice as many in the others)')
+    parser.add_argument('--kernel_sizes',           default='3,5,8',                    type=str, help='Comma-separated kernel sizes of the blocks after the first')
+    parser.add_argument('--num_blocks',             default='2,3,4',                    type=str, help='Comma-separated numbers of conv blocks')
+    parser.add_argument('--features_lens',          default='1,2',                      type=str, help='Comma-separated positions of the last block kept in the features')
+    parser.add_argument('--latency_budget_ms',      default=0.,                         type=float, help='CPU latency budget (ms per batch of --latency_batch_size), 0: none')
+    parser.add_argument('--param_budget',           default=0,                          type=int, help='Parameter budget of the student, 0: none')
+    parser.add_argument('--latency_batch_size',     default=1,                          type=int, help='Batch size of the latency budget')
+    parser.add_argument('--latency_iters',          default=50,                         type=int, help='Timed forward passes per candidate')
+
+    # ========= Short trainings =================
+    parser.add_argument('--epochs',                 default=10,                         type=int, help='Maximum training epochs per candidate')
+    parser.add_argument('--patience',               default=3,                          type=int, help='Epochs without source accuracy improvement before a training is terminated')
+    parser.add_argument('--seed',                   default=0,                          type=int, help='Random seed of every training')
+    parser.add_argument('--device',                 default='cuda:0',                   type=str, help='cpu or cuda')
+
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    log_dir = os.path.join(args.save_dir, args.experiment_description, args.run_description)
+    os.makedirs(log_dir, exist_ok=True)
+    logger = _logger(os.path.join(log_dir, f"logs_{datetime.now().strftime('%d_%m_%Y_%H_%M_%S')}.log"))
+    teacher_registry = TeacherRegistry(args.save_dir, args.data_path, device, train_missing=not args.no_teacher_training,
+                                       teacher_da_method=args.teacher_da_method)
+
+    for dataset in args.dataset.split(","):
+        configs = get_dataset_class(dataset)()
+        hparams_class = get_hparams_class(dataset)()
+        hparams = {**hparams_class.alg_hparams["UDA_KD"], **hparams_class.train_params, "num_epochs": args.epochs}
+        scenarios = configs.scenarios
+        if args.scenarios:
+            scenarios = [tuple(scenario.split("_to_")) for scenario in args.scenarios.split(",")]
+
+        # candidates over a budget are pruned on their measured latency / size before any training
+        archs = candidate_archs(configs, [int(w) for w in args.widths.split(",")],
+                                [int(k) for k in args.kernel_sizes.split(",")],
+                                [int(n) for n in args.num_blocks.split(",")],
+                                [int(f) for f in args.features_lens.split(",")])
+        candidates = prune_candidates(archs, configs, args)
+        survivors = [i for i, row in enumerate(candidates) if row["status"] == "trained"]
+        logger.debug(f"==== {dataset}: {len(survivors)}/{len(candidates)} candidates within the budget ====")
+
+        teacher_dir = os.path.join(args.save_dir, dataset, "Teacher_CNN")
+        scenario_rows = []
+        for src_id, trg_id in scenarios:
+            data_path = os.path.join(args.data_path, dataset)
+            src_train_dl, src_test_dl = data_generator(data_path, src_id, configs, hparams)
+            trg_train_dl, trg_test_dl = data_generator(data_path, trg_id, configs, hparams)
+            loaders = (src_train_dl, src_test_dl, trg_train_dl, trg_test_dl)
+            # the frozen teacher of the scenario, as UDA_KD builds it, is shared by all the candidates
+            if args.teacher_checkpoints:
+                teacher_paths = teacher_checkpoint_paths(args.teacher_checkpoints, teacher_dir, src_id, trg_id)
+            else:
+                teacher_paths = [teacher_registry.get(dataset, configs, src_id, trg_id, UDA_KD.teacher_kind)]
+            teacher = nn.Sequential(convert_domain_batchnorm(CNN_T(configs)), classifier_T(configs))
+            teacher = load_teacher(teacher, teacher_paths)
+            for i in survivors:
+                row = train_candidate(args, arch_configs(configs, archs[i]), hparams, loaders, teacher, device)
+                row.update({"candidate": i, "scenario": f"{src_id}_to_{trg_id}"})
+                scenario_rows.append(row)
+                logger.debug(f"{src_id}_to_{trg_id} candidate {i} ({archs[i]['channels']}, {archs[i]['kernels']}, "
+                             f"features_len={archs[i]['features_len']}): acc={row['acc']:.2f} epochs={row['epochs']}")
+
+        results = pd.DataFrame(candidates)
+        scenario_results = pd.DataFrame(scenario_rows)
+        if len(scenario_results):
+            results = results.join(scenario_results.drop(columns="scenario").groupby("candidate").mean())
+        front = pareto_front(results[results["status"] == "trained"]) if len(scenario_results) else results.iloc[:0]
+
+        with pd.ExcelWriter(os.path.join(log_dir, f"search_{dataset}.xlsx")) as writer:
+            front.to_excel(writer, sheet_name="pareto", index_label="candidate")
+            results.to_excel(writer, sheet_name="candidates", index_label="candidate")
+            scenario_results.to_excel(writer, sheet_name="scenarios", index=False)
+        logger.debug(f"==== {dataset}: Pareto frontier of accuracy vs latency ====")
+        logger.debug(front.to_string(float_format="%.3f"))
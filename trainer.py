@@ -9,9 +9,9 @@ from dataloader.dataloader import data_generator, few_shot_data_generator, gener
 from configs.data_model_configs import get_dataset_class
 from configs.hparams import get_hparams_class
 
-from configs.sweep_params import sweep_alg_hparams
+from configs.sweep_params import sweep_alg_hparams, sweep_pseudo_label_hparams
 from utils import fix_randomness, copy_Files, starting_logs, save_checkpoint, _calc_metrics
-from utils import calc_dev_risk, calculate_risk
+from utils import calc_dev_risk, calculate_risk, train_epoch
 import warnings
 
 import sklearn.exceptions
@@ -20,6 +20,8 @@ warnings.filterwarnings("ignore", category=sklearn.exceptions.UndefinedMetricWar
 import collections
 from algorithms.algorithms import get_algorithm_class
 from models.models import get_backbone_class
+from models.pseudo_labels import PseudoLabelStore
+from models.profiler import log_profiles
 from utils import AverageMeter
 
 torch.backends.cudnn.benchmark = True  # to fasten TCN
@@ -55,6 +57,14 @@ class cross_domain_trainer(object):
         # Specify runs
         self.num_runs = args.num_runs
 
+        # target self-training from stored pseudo-labels
+        self.pseudo_labels = args.pseudo_labels
+        self.pseudo_label_threshold = args.pseudo_label_threshold
+        self.pseudo_label_refresh = args.pseudo_label_refresh
+
+        # save the model profile of every run
+        self.profile = args.profile
+
         # get dataset and base model configs
         self.dataset_configs, self.hparams_class = self.get_configs()
 
@@ -72,7 +82,8 @@ class cross_domain_trainer(object):
             'method': self.hp_search_strategy,
             'metric': {'name': self.metric_to_minimize, 'goal': 'minimize'},
             'name': self.da_method,
-            'parameters': {**sweep_alg_hparams[self.da_method]}
+            'parameters': {**sweep_alg_hparams[self.da_method],
+                           **(sweep_pseudo_label_hparams if self.pseudo_labels else {})}
         }
         sweep_id = wandb.sweep(sweep_config, project=self.sweep_project_wandb, entity=self.wandb_entity)
 
@@ -122,34 +133,30 @@ class cross_domain_trainer(object):
                 algorithm = algorithm_class(backbone_fe, self.dataset_configs, self.hparams, self.device)
                 algorithm.to(self.device)
 
-                ######## Measure model complexity in terms of Flops and Parameters#################
-                # from thop import profile
-                # import torch
-                # input = torch.randn(1, 9, 128).to(self.device)
-                # flops, para = profile(algorithm.network, inputs=(input,))
-                # print("Model_t Flops ={}, Parameters={}".format(flops/1e6,para/1e6))
-                ######## End #################
+                # Parameters, FLOPs, activation memory and CPU latency of the model, saved with the run
+                if self.profile:
+                    log_profiles({"student": algorithm.network},
+                                 (self.dataset_configs.input_channels, self.dataset_configs.sequence_len),
+                                 self.device, self.scenario_log_dir, self.logger)
+
+                pseudo_label_store = None
+                if self.pseudo_labels:
+                    pseudo_label_store = PseudoLabelStore(len(self.trg_train_dl.dataset), self.device,
+                                                          self.pseudo_label_threshold, self.pseudo_label_refresh)
 
                 # Average meters
                 loss_avg_meters = collections.defaultdict(lambda: AverageMeter())
 
                 # training..
                 for epoch in range(1, self.hparams["num_epochs"] + 1):
-                    joint_loaders = enumerate(zip(self.src_train_dl, self.trg_train_dl))
-                    len_dataloader = min(len(self.src_train_dl), len(self.trg_train_dl))
-                    algorithm.train()
+                    train_epoch(algorithm, self.src_train_dl, self.trg_train_dl, epoch, self.device, loss_avg_meters,
+                                pseudo_label_store)
 
-                    for step, ((src_x, src_y), (trg_x, _)) in joint_loaders:
-                        src_x, src_y, trg_x = src_x.float().to(self.device), src_y.long().to(self.device), \
-                                              trg_x.float().to(self.device)
-
-                        if self.da_method == "DANN" or self.da_method == "CoDATS":
-                            losses = algorithm.update(src_x, src_y, trg_x, step, epoch, len_dataloader)
-                        else:
-                            losses = algorithm.update(src_x, src_y, trg_x)
-
-                        for key, val in losses.items():
-                            loss_avg_meters[key].update(val, src_x.size(0))
+                    if pseudo_label_store is not None:
+                        if pseudo_label_store.refresh_due(epoch):
+                            pseudo_label_store.refresh(algorithm.eval_network(), self.trg_train_dl, epoch)
+                        for key, val in pseudo_label_store.stats().items():
+                            loss_avg_meters[key].update(val, 1)
 
                     # logging
                     self.logger.debug(f'[Epoch : {epoch}/{self.hparams["num_epochs"]}]')
@@ -176,8 +183,8 @@ class cross_domain_trainer(object):
         wandb.log({'std_results': wandb.Table(dataframe=self.std_results_df, allow_mixed_types=True)})
 
     def evaluate(self):
-        feature_extractor = self.algorithm.feature_extractor.to(self.device)
-        classifier = self.algorithm.classifier.to(self.device)
+        network = self.algorithm.eval_network().to(self.device)
+        feature_extractor, classifier = network[0], network[1]
 
         feature_extractor.eval()
         classifier.eval()
@@ -214,8 +221,9 @@ class cross_domain_trainer(object):
     def load_data(self, src_id, trg_id):
         self.src_train_dl, self.src_test_dl = data_generator(self.data_path, src_id, self.dataset_configs,
                                                              self.hparams)
+        return_index = self.pseudo_labels or get_algorithm_class(self.da_method).uses_target_index
         self.trg_train_dl, self.trg_test_dl = data_generator(self.data_path, trg_id, self.dataset_configs,
-                                                             self.hparams)
+                                                             self.hparams, return_index)
         self.few_shot_dl = few_shot_data_generator(self.trg_test_dl)
 
         # self.src_train_dl = generator_percentage_of_data(self.src_train_dl_)
@@ -234,10 +242,12 @@ class cross_domain_trainer(object):
                                           self.home_path,
                                           self.dataset_configs.class_names)
         if self.is_sweep:
-            self.src_risk = calculate_risk(self.algorithm, self.src_test_dl, self.device)
-            self.trg_risk = calculate_risk(self.algorithm, self.trg_test_dl, self.device)
-            self.few_shot_trg_risk = calculate_risk(self.algorithm, self.few_shot_dl, self.device)
-            self.dev_risk = calc_dev_risk(self.algorithm, self.src_train_dl, self.trg_train_dl, self.src_test_dl,
+            # the risks of the evaluated and saved network (the averaged one with weight averaging)
+            network = self.algorithm.eval_network()
+            self.src_risk = calculate_risk(network, self.src_test_dl, self.device)
+            self.trg_risk = calculate_risk(network, self.trg_test_dl, self.device)
+            self.few_shot_trg_risk = calculate_risk(network, self.few_shot_dl, self.device)
+            self.dev_risk = calc_dev_risk(network, self.src_train_dl, self.trg_train_dl, self.src_test_dl,
                                           self.dataset_configs, self.device)
 
             run_metrics = {'accuracy': self.acc,
@@ -25,6 +25,10 @@ parser.add_argument('--backbone',               default='CNN',
 # ========= Experiment settings ===============
 parser.add_argument('--num_runs',               default = 3,                          type=int, help='Number of consecutive run with different seeds')
 parser.add_argument('--device',                 default='cuda:0',                   type=str, help='cpu or cuda')
+parser.add_argument('--pseudo_labels',          action='store_true',                          help='Self-train on confident target pseudo-labels (weight: pseudo_label_wt hparam, default 1)')
+parser.add_argument('--pseudo_label_threshold', default=0.9,                        type=float, help='Confidence threshold of the pseudo-labels used for self-training')
+parser.add_argument('--pseudo_label_refresh',   default=0,                          type=int, help='Recompute all pseudo-labels every k epochs (0: only from the target batches of the updates)')
+parser.add_argument('--profile',                action='store_true',                          help='Profile the models of every run (parameters, FLOPs, activation memory, CPU latency) into model_profile.json')
 
 # ======== sweep settings =====================
 parser.add_argument('--is_sweep',               default=False,                      type=bool, help='singe run or sweep')
@@ -2,18 +2,23 @@ import torch
 import torch.nn.functional as F
 from torch import nn as nn
 
+import io
+import inspect
+import collections
 import random
 import os
 import sys
+import time
 import logging
 import numpy as np
 import pandas as pd
 from shutil import copy
+from copy import deepcopy
 from datetime import datetime
 
 from skorch import NeuralNetClassifier  # for DIV Risk
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import classification_report, accuracy_score
+from sklearn.metrics import classification_report, accuracy_score, f1_score
 
 
 class AverageMeter(object):
@@ -84,9 +89,12 @@ def save_checkpoint(home_path, algorithm, selected_scenarios, dataset_configs, l
         "configs": dataset_configs.__dict__,
         "hparams": dict(hparams),
         "model_dict": algorithm.state_dict(),
-        "network_dict": algorithm.network.state_dict(),
+        "network_dict": algorithm.eval_network().state_dict(),
         # "discriminator": algorithm.domain_classifier.state_dict()
     }
+    if getattr(algorithm, "exit_blocks", ()):
+        # early-exit heads matching the network_dict (averaged with it under weight averaging)
+        save_dict["exit_heads_dict"] = algorithm.eval_exit_heads().state_dict()
     # save classification report
     save_path = os.path.join(home_path, log_dir, "checkpoint.pt")
 
@@ -228,11 +236,14 @@ def get_weight_gpu(source_feature, target_feature, validation_feature, configs,
     return domain_out[:, :1] / domain_out[:, 1:] * N_s * 1.0 / N_t
 
 
-def calc_dev_risk(target_model, src_train_dl, tgt_train_dl, src_valid_dl, configs, device):
-    src_train_feats = target_model.feature_extractor(src_train_dl.dataset.x_data.float().to(device))
-    tgt_train_feats = target_model.feature_extractor(tgt_train_dl.dataset.x_data.float().to(device))
-    src_valid_feats = target_model.feature_extractor(src_valid_dl.dataset.x_data.float().to(device))
-    src_valid_pred = target_model.classifier(src_valid_feats)
+def calc_dev_risk(network, src_train_dl, tgt_train_dl, src_valid_dl, configs, device):
+    '''
+    DEV risk of network, nn.Sequential(feature_extractor, classifier) (the algorithm's eval_network())
+    '''
+    src_train_feats = network[0](src_train_dl.dataset.x_data.float().to(device))
+    tgt_train_feats = network[0](tgt_train_dl.dataset.x_data.float().to(device))
+    src_valid_feats = network[0](src_valid_dl.dataset.x_data.float().to(device))
+    src_valid_pred = network[1](src_valid_feats)
 
     dev_weights = get_weight_gpu(src_train_feats.to(device), tgt_train_feats.to(device),
                                  src_valid_feats.to(device), configs, device)
@@ -242,7 +253,10 @@ def calc_dev_risk(target_model, src_train_dl, tgt_train_dl, src_valid_dl, config
     return dev_risk
 
 
-def calculate_risk(target_model, risk_dataloader, device):
+def calculate_risk(network, risk_dataloader, device):
+    '''
+    Cross-entropy of network, nn.Sequential(feature_extractor, classifier) (the algorithm's eval_network())
+    '''
     if type(risk_dataloader) == tuple:
         x_data = torch.cat((risk_dataloader[0].dataset.x_data, risk_dataloader[1].dataset.x_data), axis=0)
         y_data = torch.cat((risk_dataloader[0].dataset.y_data, risk_dataloader[1].dataset.y_data), axis=0)
@@ -250,27 +264,381 @@ def calculate_risk(target_model, risk_dataloader, device):
         x_data = risk_dataloader.dataset.x_data
         y_data = risk_dataloader.dataset.y_data
 
-    feat = target_model.feature_extractor(x_data.float().to(device))
-    pred = target_model.classifier(feat)
+    feat = network[0](x_data.float().to(device))
+    pred = network[1](feat)
     cls_loss = F.cross_entropy(pred, y_data.long().to(device))
     return cls_loss.item()
 
 
-# For DIRT-T
-class EMA:
-    def __init__(self, decay):
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def state_dict_size(model):
+    """Size in bytes of the serialized state dict of model, e.g. to compare FP32 and quantized models."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def train_epoch(algorithm, src_train_dl, trg_train_dl, epoch, device, loss_avg_meters, pseudo_label_store=None):
+    '''
+    One epoch of algorithm.update() over the zipped source and target loaders, in whichever of the update signatures
+    the algorithm has: source only, target batch, or target batch with the step / epoch / number of steps.
+    Adds the losses to loss_avg_meters
+    '''
+    update_params = inspect.signature(algorithm.update).parameters
+    len_dataloader = min(len(src_train_dl), len(trg_train_dl))
+    algorithm.train()
+
+    for step, ((src_x, src_y), trg_batch) in enumerate(zip(src_train_dl, trg_train_dl)):
+        src_x, src_y = src_x.float().to(device), src_y.long().to(device)
+        if "trg_x" not in update_params:
+            losses = algorithm.update(src_x, src_y)
+        else:
+            trg_x = trg_batch[0].float().to(device)
+
+            # target batches carry their dataset indices for the pseudo-labels or algorithms using them
+            kwargs = {}
+            if pseudo_label_store is not None:
+                kwargs["pseudo_labels"] = pseudo_label_store.batch(trg_batch[2], epoch)
+            if algorithm.uses_target_index:
+                kwargs["trg_idx"] = trg_batch[2]
+            if "step" in update_params:
+                kwargs.update(step=step, epoch=epoch, len_dataloader=len_dataloader)
+            losses = algorithm.update(src_x, src_y, trg_x, **kwargs)
+
+        algorithm.update_weight_averaging()
+
+        for key, val in losses.items():
+            loss_avg_meters[key].update(val, src_x.size(0))
+
+
+def evaluate_network(network, data_loader, device):
+    """Accuracy and macro F1 (in %) of a network (or any callable) on a labeled data loader."""
+    if hasattr(network, 'eval'):
+        network.eval()
+    pred_labels, true_labels = [], []
+    with torch.no_grad():
+        for batch in data_loader:
+            predictions = network(batch[0].float().to(device))
+            pred_labels.append(predictions.argmax(dim=1).cpu().numpy())
+            true_labels.append(batch[1].view(-1).numpy())
+    pred_labels, true_labels = np.concatenate(pred_labels), np.concatenate(true_labels)
+    return accuracy_score(true_labels, pred_labels) * 100, f1_score(true_labels, pred_labels, average='macro') * 100
+
+
+def measure_latency(model, input_shape, device, iters=50, warmup=10):
+    """
+    Mean forward time (ms) of model in eval mode on an all-zero input of input_shape (drawing no random numbers, so
+    seeded runs are unaffected). model may be any callable, e.g. a frozen TorchScript module.
+    """
+    was_training = getattr(model, 'training', None)
+    if was_training is not None:
+        model.eval()
+    x = torch.zeros(*input_shape, device=device)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    if was_training is not None:
+        model.train(was_training)
+    return (time.perf_counter() - start) / iters * 1e3
+
+
+class WeightAveraging(object):
+    """
+    Keeps a separate averaged copy of `model` for evaluation. Like the EMA it replaces, it is not a module: the
+    averaged copy stays out of the state dict and parameters of the algorithm owning it, whether or not it exists
+    yet, and is saved explicitly as the network_dict of the checkpoints (see save_checkpoint).
+    mode: 'ema'    -> exponential moving average with `decay`
+          'swa'    -> uniform average of the weights seen every `swa_freq` steps after `swa_start` steps
+          'polyak' -> uniform average of the weights seen at every step
+    The update runs as a few multi-tensor (torch._foreach_*) ops over all parameters; buffers such as
+    BatchNorm running statistics are copied from the live model.
+    """
+
+    def __init__(self, model, mode='ema', decay=0.998, swa_start=0, swa_freq=1):
+        if mode not in ('ema', 'swa', 'polyak'):
+            raise ValueError("Unknown weight averaging mode: {}".format(mode))
+        self.mode = mode
         self.decay = decay
-        self.shadow = {}
-
-    def register(self, model):
-        for name, param in model.named_parameters():
-            if param.requires_grad:
-                self.shadow[name] = param.data.clone()
-        self.params = self.shadow.keys()
-
-    def __call__(self, model):
-        if self.decay > 0:
-            for name, param in model.named_parameters():
-                if name in self.params and param.requires_grad:
-                    self.shadow[name] -= (1 - self.decay) * (self.shadow[name] - param.data)
-                    param.data = self.shadow[name]
+        self.swa_start = swa_start if mode == 'swa' else 0
+        self.swa_freq = swa_freq if mode == 'swa' else 1
+        self.step = 0
+        self.num_averaged = 0
+
+        self.averaged_model = deepcopy(model)
+        self.averaged_model.requires_grad_(False)
+        self._model_params = None
+
+    def _collect(self, model):
+        # parameter tensors are updated in place by the optimizers, so the lists can be built once
+        if self._model_params is None:
+            self._model_params = [p.detach() for p in model.parameters()]
+            self._averaged_params = [p.detach() for p in self.averaged_model.parameters()]
+            self._model_buffers = list(model.buffers())
+            self._averaged_buffers = list(self.averaged_model.buffers())
+        return self._model_params, self._averaged_params
+
+    @torch.no_grad()
+    def update(self, model):
+        self.step += 1
+        if self.step <= self.swa_start or (self.step - self.swa_start) % self.swa_freq != 0:
+            return
+
+        params, averaged = self._collect(model)
+        if self.mode == 'ema':
+            weight = 1. - self.decay
+        else:
+            weight = 1. / (self.num_averaged + 1)
+        # averaged <- averaged + weight * (params - averaged)
+        torch._foreach_mul_(averaged, 1. - weight)
+        torch._foreach_add_(averaged, params, alpha=weight)
+        self.num_averaged += 1
+
+        if not self._model_buffers:
+            return
+        if hasattr(torch, '_foreach_copy_'):
+            torch._foreach_copy_(self._averaged_buffers, self._model_buffers)
+        else:
+            for averaged_buffer, buffer in zip(self._averaged_buffers, self._model_buffers):
+                averaged_buffer.copy_(buffer)
+
+
+class StudentsEvaluationMixin(object):
+    """
+    Evaluation of the students of several widths trained together by the KD trainers, which provide evaluate(),
+    students_results and the logging paths
+    """
+
+    def evaluate_students(self, students, scenarios):
+        '''
+        Accuracy, F1, parameter count and latency (batch of one) of every student width trained in this run
+        '''
+        df = pd.DataFrame(columns=["width", "params", "latency_ms", "acc", "f1"])
+        input_shape = (1, self.dataset_configs.input_channels, self.dataset_configs.sequence_len)
+        for width, student in students.items():
+            student_log_dir = os.path.join(self.scenario_log_dir, f"student_{width}")
+            os.makedirs(student_log_dir, exist_ok=True)
+            save_checkpoint(self.home_path, student, scenarios, student.configs, student_log_dir, self.hparams)
+
+            self.algorithm = student
+            self.evaluate()
+            acc, f1 = _calc_metrics(self.trg_pred_labels, self.trg_true_labels, student_log_dir, self.home_path,
+                                    self.dataset_configs.class_names)
+            network = student.eval_network()
+            df.loc[len(df)] = [width, count_parameters(network), measure_latency(network, input_shape, self.device),
+                               acc, f1]
+
+        df.to_excel(os.path.join(self.home_path, self.scenario_log_dir, "students.xlsx"), index=False)
+        self.students_results.append(df)
+
+    def calc_students_results(self):
+        '''
+        Accuracy vs parameter count vs latency of each student width, averaged over scenarios and runs
+        '''
+        results = pd.concat(self.students_results).astype(float).groupby('width').mean().reset_index()
+        results.to_excel(os.path.join(self.exp_log_dir, "Students_results.xlsx"), index=False)
+        import wandb
+        wandb.log({'students_results': wandb.Table(dataframe=results, allow_mixed_types=True)})
+
+
+def add_kd_arguments(parser):
+    '''
+    Arguments shared by the KD trainers (proposed_uda_kd.py, jku_mobileda_aad.py), read by KDTrainerMixin: teachers,
+    student fine-tuning, frozen teacher pipeline, student widths and profiling
+    '''
+    parser.add_argument('--teacher_checkpoints',    default='',                         type=str, help='Teacher checkpoints: comma-separated paths/globs under <save_dir>/<dataset>/Teacher_CNN with {src}/{trg} placeholders; several ones are distilled as an ensemble')
+    parser.add_argument('--teacher_da_method',      default='DANN',                     type=str, help='UDA method training missing domain-adapted teachers of the registry')
+    parser.add_argument('--no_teacher_training',    action='store_true',                          help='Fail instead of training teachers missing from the registry')
+    parser.add_argument('--teacher_weights',        default='',                         type=str, help='Comma-separated per-teacher weights of the ensemble (default: uniform)')
+    parser.add_argument('--student_checkpoint',     default='',                         type=str, help='checkpoint.pt of a previous run ({src}/{trg} placeholders) initializing the student')
+    parser.add_argument('--freeze_prefix',          default='',                         type=str, help='Freeze the CNN blocks up to this one (e.g. conv_block2) and train from their cached activations')
+    parser.add_argument('--activation_cache_dir',   default='',                         type=str, help='Directory of memory-mapped activation caches (default: in memory)')
+    parser.add_argument('--async_teacher',          default='none',                     type=str, help='Run the frozen teacher in a background worker: (none - thread - process)')
+    parser.add_argument('--teacher_threads',        default=1,                          type=int, help='Intra-op threads of the background teacher process (--async_teacher process)')
+    parser.add_argument('--student_widths',         default='',                         type=str, help='Comma-separated student widths trained together, e.g. 16,32,64 (empty: feature_dim)')
+    parser.add_argument('--teacher_queue_size',     default=2,                          type=int, help='Number of teacher batches computed ahead of the student')
+    parser.add_argument('--profile',                action='store_true',                          help='Profile the models of every run (parameters, FLOPs, activation memory, CPU latency) into model_profile.json')
+
+
+class KDTrainerMixin(object):
+    """
+    Teacher resolution and student training of the KD trainers, which provide dataset, da_method, backbone, device,
+    dataset_configs, hparams, the loaders and the logging paths. The options come from add_kd_arguments()
+    """
+
+    def init_kd_options(self, args):
+        from models.teacher_registry import TeacherRegistry
+
+        # Teacher checkpoints (comma-separated paths or globs, several ones form an ensemble) and ensemble weights
+        self.teacher_checkpoints = args.teacher_checkpoints
+        self.teacher_weights = [float(w) for w in args.teacher_weights.split(',')] if args.teacher_weights else None
+        self.teacher_registry = TeacherRegistry(self.save_dir, args.data_path, self.device,
+                                                train_missing=not args.no_teacher_training,
+                                                teacher_da_method=args.teacher_da_method)
+
+        # Fine-tuning of an existing student from cached activations of its frozen backbone prefix
+        self.student_checkpoint = args.student_checkpoint
+        self.freeze_prefix = args.freeze_prefix
+        self.activation_cache_dir = args.activation_cache_dir
+
+        # Frozen teacher pipeline
+        self.async_teacher = args.async_teacher
+        self.teacher_threads = args.teacher_threads
+        self.teacher_queue_size = args.teacher_queue_size
+
+        # save the model profile of every run
+        self.profile = args.profile
+
+        # Student widths trained side by side from one teacher pass, e.g. "16,32,64" (empty: a single student)
+        self.student_widths = [int(w) for w in args.student_widths.split(',')] if args.student_widths else []
+        if self.student_widths and args.backbone == "TCN":
+            raise ValueError("--student_widths sets the CNN/RESNET feature width, it does not apply to TCN")
+
+    def get_teacher_paths(self, src_id, trg_id):
+        '''
+        Checkpoints of the pre-trained teacher(s) of a scenario: --teacher_checkpoints, else the registered teacher of
+        the kind the algorithm distills from, trained and registered if missing
+        '''
+        from algorithms.algorithms import get_algorithm_class
+        from models.teacher import teacher_checkpoint_paths
+
+        if self.teacher_checkpoints:
+            teacher_dir = os.path.join(self.save_dir, self.dataset, 'Teacher_CNN')
+            return teacher_checkpoint_paths(self.teacher_checkpoints, teacher_dir, src_id, trg_id)
+        teacher_kind = get_algorithm_class(self.da_method).teacher_kind
+        return [self.teacher_registry.get(self.dataset, self.dataset_configs, src_id, trg_id, teacher_kind)]
+
+    def build_students(self, teacher_paths):
+        '''
+        Student algorithm(s), one per student width, sharing the frozen teacher loaded from teacher_paths. Returns
+        the first student, which runs the teacher, and {width: student}
+        '''
+        from algorithms.algorithms import get_algorithm_class
+        from configs.data_model_configs import with_feature_dim
+        from models.models import get_backbone_class
+        from models.teacher import load_teacher
+
+        algorithm_class = get_algorithm_class(self.da_method)
+        backbone_fe = get_backbone_class(self.backbone)
+
+        student_widths = self.student_widths or [None]
+        if len(student_widths) > 1 and not algorithm_class.teacher_domains:
+            raise ValueError(f"{self.da_method} trains its teacher, multiple students need a frozen one")
+        students = collections.OrderedDict()
+        for width in student_widths:
+            configs = self.dataset_configs if width is None else with_feature_dim(self.dataset_configs, width)
+            if students:
+                # the other students are built on the teacher of the first instead of allocating their own
+                students[width] = algorithm_class(backbone_fe, configs, self.hparams, self.device,
+                                                  network_t=algorithm.network_t)
+            else:
+                students[width] = algorithm = algorithm_class(backbone_fe, configs, self.hparams, self.device)
+
+        # Load Pre-trained Teacher model (read from disk once per process)
+        if len(teacher_paths) > 1 and not algorithm.teacher_domains:
+            raise ValueError(f"{self.da_method} trains its teacher, a teacher ensemble must be frozen")
+        algorithm.set_teacher(load_teacher(algorithm.network_t, teacher_paths, self.teacher_weights))
+
+        # all students distill from the same frozen teacher, which runs once per batch
+        for student in students.values():
+            student.share_teacher(algorithm)
+            student.to(self.device)
+        return algorithm, students
+
+    def update_student(self, student, src_x, src_y, trg_x, step, epoch, len_dataloader, teacher_outputs):
+        '''
+        One update() of a student, with the teacher outputs of the batch (None: computed by the student)
+        '''
+        return student.update(src_x, src_y, trg_x, step, epoch, len_dataloader, teacher_outputs=teacher_outputs)
+
+    def train_students(self, teacher_paths, src_id, trg_id):
+        '''
+        Builds the students of a run (build_students) and trains them together for num_epochs: fine-tuned from
+        --student_checkpoint on the cached activations of a frozen prefix (--freeze_prefix), with the frozen teacher
+        run in a background worker (--async_teacher) or once per batch for all of them. Returns the first student and
+        {width: student}
+        '''
+        from models.models import freeze_prefix, from_prefix_activations
+        from models.prefix_cache import PrefixActivationCache
+        from models.profiler import log_profiles
+        from models.teacher import AsyncTeacher, load_checkpoint
+
+        algorithm, students = self.build_students(teacher_paths)
+
+        # Fine-tune an existing student, training on cached outputs of its frozen prefix blocks and of the teacher
+        if self.student_checkpoint:
+            student_checkpoint = self.student_checkpoint.format(src=src_id, trg=trg_id)
+            algorithm.network.load_state_dict(load_checkpoint(student_checkpoint)["network_dict"])
+        num_frozen, prefix_cache = 0, None
+        if self.freeze_prefix:
+            if len(students) > 1 or not algorithm.teacher_domains:
+                raise ValueError("--freeze_prefix needs a single student and a frozen teacher")
+            num_frozen = freeze_prefix(algorithm.feature_extractor, self.freeze_prefix)
+            cache_dir = self.activation_cache_dir and os.path.join(self.activation_cache_dir, f'{src_id}_to_{trg_id}')
+            prefix_cache = PrefixActivationCache(algorithm.feature_extractor, num_frozen, self.src_train_dl,
+                                                 self.trg_train_dl, self.device, algorithm.network_t,
+                                                 algorithm.teacher_domains, cache_dir=cache_dir)
+
+        # Parameters, FLOPs, activation memory and CPU latency of the teacher and the student, with the
+        # compression ratio and speedup of the student, saved with the run
+        if self.profile:
+            log_profiles({"teacher": algorithm.network_t, "student": algorithm.network},
+                         (self.dataset_configs.input_channels, self.dataset_configs.sequence_len), self.device,
+                         self.scenario_log_dir, self.logger)
+
+        # Run the frozen teacher in a background worker, overlapping with the student
+        async_teacher = None
+        if self.async_teacher != 'none' and algorithm.teacher_domains:
+            async_teacher = AsyncTeacher(algorithm.network_t, algorithm.teacher_domains, self.device,
+                                         backend=self.async_teacher, num_threads=self.teacher_threads,
+                                         queue_size=self.teacher_queue_size)
+
+        # Average meters
+        loss_avg_meters = collections.defaultdict(lambda: AverageMeter())
+
+        # training..
+        for epoch in range(1, self.hparams["num_epochs"] + 1):
+            joint_loaders = zip(self.src_train_dl, self.trg_train_dl)
+            if prefix_cache is not None:
+                joint_loaders = prefix_cache.batches()
+            elif async_teacher is not None:
+                joint_loaders = async_teacher(joint_loaders)
+            else:
+                joint_loaders = ((batch, None) for batch in joint_loaders)
+            len_dataloader = min(len(self.src_train_dl), len(self.trg_train_dl))
+            for student in students.values():
+                student.train()
+
+            for step, (((src_x, src_y), (trg_x, _)), teacher_outputs) in enumerate(joint_loaders):
+                src_x, src_y, trg_x = src_x.float().to(self.device), src_y.long().to(self.device), \
+                                      trg_x.float().to(self.device)
+                if teacher_outputs is None and len(students) > 1:
+                    teacher_outputs = algorithm.teacher_outputs(src_x, trg_x)
+
+                for width, student in students.items():
+                    with from_prefix_activations(student.feature_extractor, num_frozen):
+                        losses = self.update_student(student, src_x, src_y, trg_x, step, epoch, len_dataloader,
+                                                     teacher_outputs)
+                    student.update_weight_averaging()
+
+                    for key, val in losses.items():
+                        loss_avg_meters[key if width is None else f'{key}_{width}'].update(val, src_x.size(0))
+
+            # logging
+            self.logger.debug(f'[Epoch : {epoch}/{self.hparams["num_epochs"]}]')
+            for key, val in loss_avg_meters.items():
+                self.logger.debug(f'{key}\t: {val.avg:2.4f}')
+            self.logger.debug(f'-------------------------------------')
+
+        if async_teacher is not None:
+            async_teacher.close()
+        return algorithm, students